@@ -0,0 +1,183 @@
+"""
+Search the songs containing a chord sequence with at most k edits.
+
+An edit is a chord substitution, insertion or deletion. Every substring of a
+song is a prefix of one of its suffixes, so walking the paths of a tree of all
+suffixes (the PAT-tree, or the trie implied by a suffix array) while keeping
+the edit distance DP column of the query against the path finds every
+approximate occurrence:
+
+    column[i] = edit distance between query[:i] and the path so far
+
+When column[-1] <= k the path is an occurrence, with that cost, in every song
+below it. When min(column) > k no extension of the path can be, so the walk
+stops there, and only the cells up to the last one <= k are computed.
+
+Paths are walked best-first by min(column), which never decreases along a
+path. Once top-N songs are found, k is lowered to the cost of the N-th best,
+and the walk stops when no path left can reach it, or when the budget of
+visited positions is spent.
+
+Reference:
+
+- Ukkonen (1993), Approximate string-matching over suffix trees
+"""
+
+from argparse import ArgumentTypeError
+import heapq
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+from musical_things import ChordSeq
+
+
+FolksongKey = str
+
+
+State = TypeVar('State')
+# the chords on the link to a child, the child, and [lo, hi) of the ids below the child
+Edge = Tuple[Sequence[int], State, int, int]
+
+# visited positions (one per chord of a walked link) of a query before giving up
+DEFAULT_NODE_BUDGET = 100000
+
+
+def non_negative_int(s: str) -> int:
+    """
+        An argparse type for -k and --node-budget
+    """
+    value = int(s)
+    if value < 0:
+        raise ArgumentTypeError(f'must not be negative: {value}')
+    return value
+
+def positive_int(s: str) -> int:
+    """
+        An argparse type for --top
+    """
+    value = int(s)
+    if value <= 0:
+        raise ArgumentTypeError(f'must be positive: {value}')
+    return value
+
+
+def next_edit_column(column: List[int], q: ChordSeq, chord: int, max_edits: int) -> List[int]:
+    """
+        The DP column after appending chord to the path.
+
+        Only the cells up to the last one not larger than max_edits are kept (Ukkonen's cut-off):
+        the cells after it are all larger too, and are taken as max_edits + 1,
+        which does not change any cell that is not larger than max_edits.
+    """
+    column_len = len(column)
+    cell = column[0] + 1
+    new_column = [cell]
+    last_kept = 0 if cell <= max_edits else -1
+    for i in range(1, min(column_len + 1, len(q) + 1)):
+        # match or substitute
+        cell = column[i-1] + (q[i-1] != chord)
+        if i < column_len and column[i] < cell:
+            # chord is inserted
+            cell = column[i] + 1
+        if new_column[i-1] < cell:
+            # q[i-1] is deleted
+            cell = new_column[i-1] + 1
+        new_column.append(cell)
+        if cell <= max_edits:
+            last_kept = i
+    del new_column[last_kept+1:]
+    return new_column
+
+
+class ApproximateMatches:
+    """
+        The best cost of every id found so far
+    """
+    def __init__(self, max_edits: int) -> None:
+        self.best_costs = dict()
+        # number of ids whose best cost is c
+        self.cost_counts = [0] * (max_edits + 1)
+
+    def add(self, cost: int, ids: Iterable[int]) -> None:
+        best_costs = self.best_costs
+        cost_counts = self.cost_counts
+        for i in ids:
+            old_cost = best_costs.get(i)
+            if old_cost is None:
+                best_costs[i] = cost
+                cost_counts[cost] += 1
+            elif cost < old_cost:
+                best_costs[i] = cost
+                cost_counts[old_cost] -= 1
+                cost_counts[cost] += 1
+
+    def nth_cost(self, n: int) -> Optional[int]:
+        """
+            The cost of the n-th best id, or None if fewer than n ids are found
+        """
+        found = 0
+        for cost, count in enumerate(self.cost_counts):
+            found += count
+            if found >= n:
+                return cost
+        return None
+
+
+def approximate_search(
+        q: ChordSeq,
+        max_edits: int,
+        top_n: Optional[int],
+        node_budget: Optional[int],
+        root: State,
+        root_range: Tuple[int, int],
+        ids: Sequence[int],
+        id_to_key: Callable[[int], FolksongKey],
+        edges: Callable[[State], Iterable[Edge]]) -> List[Tuple[FolksongKey, int]]:
+    """
+        Walk the tree given by root and edges best-first.
+        ids[lo:hi] are the ids of the songs below a node.
+        Return (key, cost) of the top_n (all if None) songs, sorted by cost and then key.
+    """
+    m = len(q)
+    matches = ApproximateMatches(max_edits)
+    root_column = list(range(min(m, max_edits) + 1))
+    if m <= max_edits:
+        # deleting the whole query
+        matches.add(m, ids[root_range[0]:root_range[1]])
+    visited = 0
+    counter = 0
+    # once top_n songs are found, a path costing more than the n-th best is of no use
+    bound = max_edits
+    if top_n is not None and matches.nth_cost(top_n) is not None:
+        bound = matches.nth_cost(top_n)
+    # (min of column, insertion order, state, column, cost already added for all ids below state)
+    heap = [(0, counter, root, root_column, m)]
+    while len(heap) > 0:
+        lower_bound, _, state, column, added_cost = heapq.heappop(heap)
+        if lower_bound > bound:
+            # the heap is ordered by lower bound, so nothing left can be better
+            break
+        for link, child, lo, hi in edges(state):
+            child_column = column
+            child_added_cost = added_cost
+            for c in link:
+                visited += 1
+                child_column = next_edit_column(child_column, q, c, bound)
+                if len(child_column) == 0:
+                    # every cell is larger than bound
+                    break
+                if len(child_column) == m + 1 and child_column[m] < child_added_cost:
+                    matches.add(child_column[m], ids[lo:hi])
+                    child_added_cost = child_column[m]
+                    if top_n is not None:
+                        nth_cost = matches.nth_cost(top_n)
+                        if nth_cost is not None and nth_cost < bound:
+                            bound = nth_cost
+            else:
+                counter += 1
+                heapq.heappush(heap, (min(child_column), counter, child, child_column, child_added_cost))
+        if node_budget is not None and visited >= node_budget:
+            break
+    ranked = sorted((cost, id_to_key(i)) for i, cost in matches.best_costs.items())
+    if top_n is not None:
+        ranked = ranked[:top_n]
+    return [(key, cost) for cost, key in ranked]
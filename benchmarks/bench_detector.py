@@ -0,0 +1,84 @@
+"""
+Chord detection time on the longest songs of a corpus
+
+    python3 -m benchmarks.bench_detector path/to/dataset/directory
+
+Use -k to tile every melody k times and see how detection time grows with song length.
+"""
+
+from argparse import ArgumentParser, Namespace
+from time import perf_counter
+
+from detector import abs_note_seq_to_chrod_seq, old_abs_note_seq_to_chrod_seq, denormalize_note_seq
+from make_database import read_folksongs
+from musical_things import MusicNote, NoteSeq
+
+
+def read_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument(
+        'dataset_path',
+        type=str
+    )
+    parser.add_argument(
+        '-n',
+        dest='song_number',
+        type=int,
+        default=50,
+        help='Number of longest songs to detect'
+    )
+    parser.add_argument(
+        '-k',
+        dest='tile',
+        type=int,
+        default=1,
+        help='Tile every melody k times'
+    )
+    parser.add_argument(
+        '-r',
+        dest='repeat',
+        type=int,
+        default=3,
+        help='Report the best of r runs'
+    )
+    return parser.parse_args()
+
+
+def tile_note_seq(note_seq, k):
+    if k == 1:
+        return note_seq
+    length = note_seq.end()
+    return NoteSeq.from_notes(
+        MusicNote(n.start + i * length, n.end + i * length, n.pitch)
+        for i in range(k)
+        for n in note_seq
+    )
+
+
+def main():
+    args = read_args()
+    folksong_list, total_record = read_folksongs(args.dataset_path)
+    print(f'successfully parsed {len(folksong_list)} out of {total_record} records')
+    folksong_list = [f for f in folksong_list if len(f.melody) > 0]
+    longest = sorted(folksong_list, key=lambda f: len(f.melody), reverse=True)[:args.song_number]
+    songs = [
+        (tile_note_seq(denormalize_note_seq(f.melody, f.tonic), args.tile), f.metre)
+        for f in longest
+    ]
+    note_number = sum(len(s) for s, _ in songs)
+    print(f'{len(songs)} songs, {note_number} notes, {note_number / len(songs):.0f} notes per song')
+
+    for name, detect in [
+            ('new', lambda s, m: abs_note_seq_to_chrod_seq(s, m, 0.3, 1.0, 8.0)),
+            ('old', old_abs_note_seq_to_chrod_seq)]:
+        times = []
+        for _ in range(args.repeat):
+            begin_time = perf_counter()
+            for note_seq, metre in songs:
+                detect(note_seq, metre)
+            times.append(perf_counter() - begin_time)
+        print(f'{name}: {min(times):.3f} s, {min(times) / len(songs) * 1e3:.2f} ms per song')
+
+
+if __name__ == '__main__':
+    main()
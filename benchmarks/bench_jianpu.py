@@ -0,0 +1,65 @@
+"""
+Jianpu parsing throughput over all melodies of a corpus, in notes per second
+
+    python3 -m benchmarks.bench_jianpu path/to/dataset/directory
+
+Compares the table-driven scanner (jianpu_to_note_seq) with the reference parser
+(jianpu_to_note_seq_by_char), and checks that they give the same note sequences.
+"""
+
+from argparse import ArgumentParser, Namespace
+from time import perf_counter
+
+from jianpu import jianpu_to_note_seq, jianpu_to_note_seq_by_char
+from make_database import read_folksongs
+
+
+def read_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument(
+        'dataset_path',
+        type=str
+    )
+    parser.add_argument(
+        '-r',
+        dest='repeat',
+        type=int,
+        default=3,
+        help='Report the best of r runs'
+    )
+    return parser.parse_args()
+
+
+def note_tuples(note_seq):
+    return [(n.start, n.end, n.pitch) for n in note_seq]
+
+
+def main():
+    args = read_args()
+    folksong_list, total_record = read_folksongs(args.dataset_path)
+    print(f'successfully parsed {len(folksong_list)} out of {total_record} records')
+    melodies = [(f.melody_str, f.time_unit, f.metre) for f in folksong_list]
+    note_number = sum(len(f.melody) for f in folksong_list)
+    char_number = sum(len(melody_str) for melody_str, _, _ in melodies)
+    print(f'{len(melodies)} melodies, {note_number} notes, {char_number} characters')
+
+    for melody_str, time_unit, metre in melodies:
+        assert (
+            note_tuples(jianpu_to_note_seq(melody_str, time_unit, metre))
+            == note_tuples(jianpu_to_note_seq_by_char(melody_str, time_unit, metre))
+        ), f'different note sequences of {melody_str}'
+
+    for name, parse in [
+            ('scanner', jianpu_to_note_seq),
+            ('reference', jianpu_to_note_seq_by_char)]:
+        times = []
+        for _ in range(args.repeat):
+            begin_time = perf_counter()
+            for melody_str, time_unit, metre in melodies:
+                parse(melody_str, time_unit, metre)
+            times.append(perf_counter() - begin_time)
+        print(f'{name}: {min(times):.3f} s, {note_number / min(times):.0f} notes per second')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Build and query time of PATTree on a corpus
+
+    python3 -m benchmarks.bench_pattree path/to/dataset/directory
+
+Chords are detected once, then the PAT-tree is built and queried with random
+substrings of the detected chord sequences.
+"""
+
+from argparse import ArgumentParser, Namespace
+import random
+from time import perf_counter
+
+from database import PATTree
+from detector import normalized_note_seq_to_chrod_seq, old_normalized_note_seq_to_chrod_seq
+from make_database import read_folksongs
+
+
+def read_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument(
+        'dataset_path',
+        type=str
+    )
+    parser.add_argument(
+        '--old',
+        dest='old_chord_detection',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-n',
+        dest='query_number',
+        type=int,
+        default=10000
+    )
+    parser.add_argument(
+        '-r',
+        dest='repeat',
+        type=int,
+        default=3,
+        help='Report the best of r runs'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = read_args()
+    folksong_list, total_record = read_folksongs(args.dataset_path)
+    print(f'successfully parsed {len(folksong_list)} out of {total_record} records')
+    chord_seqs = {}
+    for f in folksong_list:
+        if args.old_chord_detection:
+            chord_seqs[f.key] = old_normalized_note_seq_to_chrod_seq(f.melody, f.tonic, f.metre)
+        else:
+            chord_seqs[f.key] = normalized_note_seq_to_chrod_seq(f.melody, f.tonic, f.metre, 0.3, 1.0, 8.0)
+    print('total chords:', sum(len(cs) for cs in chord_seqs.values()))
+
+    rng = random.Random(args.seed)
+    nonempty_chord_seqs = [cs for cs in chord_seqs.values() if len(cs) > 0]
+    queries = []
+    for _ in range(args.query_number):
+        cs = rng.choice(nonempty_chord_seqs)
+        begin = rng.randrange(len(cs))
+        queries.append(cs[begin:begin+rng.randint(1, 8)])
+
+    build_times = []
+    search_times = []
+    for _ in range(args.repeat):
+        begin_time = perf_counter()
+        pat_tree = PATTree()
+        for key, cs in chord_seqs.items():
+            pat_tree.insert(cs, key)
+        pat_tree.finalize()
+        build_times.append(perf_counter() - begin_time)
+
+        begin_time = perf_counter()
+        for q in queries:
+            pat_tree.search(q)
+        search_times.append(perf_counter() - begin_time)
+
+    print('PAT-tree number of nodes:', len(pat_tree))
+    print(f'build: {min(build_times):.3f} s')
+    print(f'search: {min(search_times):.3f} s for {len(queries)} queries, '
+          f'{min(search_times) / len(queries) * 1e6:.1f} us per query')
+
+
+if __name__ == '__main__':
+    main()
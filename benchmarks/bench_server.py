@@ -0,0 +1,145 @@
+"""
+Load generator for search.py --serve
+
+    python3 ./search.py path/to/database/file --serve
+    python3 -m benchmarks.bench_server path/to/query.json [more queries...] -n 2000 -c 8
+
+c connections send the query files round-robin, n requests in total, each
+waiting for its response before sending the next. Throughput and latency
+percentiles of the responses are reported.
+"""
+
+from argparse import ArgumentParser, Namespace
+import asyncio
+import json
+from time import perf_counter
+from typing import List
+
+from search_server import SEARCH_PATH
+
+
+def read_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument(
+        'query_file_paths',
+        type=str,
+        nargs='+'
+    )
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='127.0.0.1'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8000
+    )
+    parser.add_argument(
+        '--unix-socket',
+        dest='unix_socket_path',
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        '-n',
+        dest='request_number',
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        '-c',
+        dest='concurrency',
+        type=int,
+        default=8,
+        help='Number of connections sending requests at the same time'
+    )
+    parser.add_argument(
+        '--keys-only',
+        action='store_true',
+        help='Ask for the keys without the records'
+    )
+    return parser.parse_args()
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """
+        Nearest-rank percentile of sorted values, p in [0, 100]
+    """
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+async def run_connection(
+        args: Namespace,
+        requests: List[bytes],
+        next_request: List[int],
+        latencies: List[float],
+        errors: List[int]) -> None:
+    if args.unix_socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(args.unix_socket_path)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while next_request[0] < args.request_number:
+            request = requests[next_request[0] % len(requests)]
+            next_request[0] += 1
+            begin_time = perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    content_length = int(value)
+            await reader.readexactly(content_length)
+            latencies.append(perf_counter() - begin_time)
+            if status != 200:
+                errors[0] += 1
+    finally:
+        writer.close()
+
+
+async def run(args: Namespace) -> None:
+    requests = []
+    for query_file_path in args.query_file_paths:
+        query_song = json.load(open(query_file_path, 'r', encoding='utf8'))
+        body = json.dumps({
+            'metre': query_song['metre'],
+            'melody': query_song['melody'],
+            'records': not args.keys_only
+        }).encode('utf8')
+        requests.append(
+            f'POST {SEARCH_PATH} HTTP/1.1\r\n'
+            f'Host: {args.host}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'\r\n'.encode('latin-1') + body
+        )
+    next_request = [0]
+    latencies: List[float] = []
+    errors = [0]
+    begin_time = perf_counter()
+    await asyncio.gather(*[
+        run_connection(args, requests, next_request, latencies, errors)
+        for _ in range(args.concurrency)
+    ])
+    elapsed = perf_counter() - begin_time
+
+    latencies.sort()
+    print(f'{len(latencies)} requests, {errors[0]} errors, {args.concurrency} connections, {elapsed:.3f} s')
+    print(f'throughput: {len(latencies) / elapsed:.1f} requests/s')
+    for p in (50, 90, 99):
+        print(f'p{p} latency: {percentile(latencies, p) * 1000:.2f} ms')
+    print(f'max latency: {latencies[-1] * 1000:.2f} ms')
+
+
+def main():
+    asyncio.run(run(read_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+Time and peak memory of every stage of building and searching a database,
+on synthetic corpora of several sizes, written to JSON
+
+    python3 -m benchmarks.bench_suite -n 6000 --scales 1 10 100 -o result.json
+    python3 -m benchmarks.bench_suite -n 6000 --scales 1 10 --baseline result.json
+
+A corpus of n * scale songs is written by benchmarks.make_corpus for every scale,
+with the same generator options and seed, and these stages are run on it in order:
+
+    parse           read_folksongs over the .sm files, jianpu included
+    jianpu          jianpu_to_note_seq of every melody
+    detect          key and chord detection of every song, a chunk at a time as in a build
+    pattree_insert  PATTree.insert of every chord sequence, and finalize
+    pattree_search  PATTree.search of random chord substrings
+    build           the whole MusicDatabase build from the parsed folksongs
+    pickle_dump     pickling the database to a file
+    pickle_load     unpickling it
+
+The time of a stage is the best of r runs. Its peak memory is the peak of the memory
+allocated by one more run, traced by tracemalloc, so it does not count what the earlier
+stages hold. The JSON has the revision and the options of the run, so that the results
+of two revisions can be compared with --baseline.
+"""
+
+from argparse import ArgumentParser, Namespace
+from datetime import datetime, timezone
+import gc
+import json
+import os
+import pickle
+import platform
+import random
+import subprocess
+import tempfile
+from time import perf_counter
+import tracemalloc
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+from benchmarks.make_corpus import DEFAULT_SONG_NUMBER, add_corpus_arguments, write_corpus
+from database import DETECTION_CHUNK_SIZE, MusicDatabase, PATTree, detect_chunk
+import detector
+from jianpu import jianpu_to_note_seq
+from make_database import read_folksongs
+
+R = TypeVar('R')
+
+
+def read_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-n',
+        dest='song_number',
+        type=int,
+        default=DEFAULT_SONG_NUMBER,
+        help='Number of songs of the corpus at scale 1'
+    )
+    parser.add_argument(
+        '--scales',
+        type=int,
+        nargs='+',
+        default=[1, 10],
+        help='Sizes of the corpora, in multiples of n'
+    )
+    add_corpus_arguments(parser)
+    parser.add_argument(
+        '--corpus-dir',
+        type=str,
+        default=None,
+        help='Write the corpora in this directory and keep them, instead of a temporary directory'
+    )
+    parser.add_argument(
+        '-q',
+        dest='query_number',
+        type=int,
+        default=10000,
+        help='Number of searched chord substrings'
+    )
+    parser.add_argument(
+        '-r',
+        dest='repeat',
+        type=int,
+        default=1,
+        help='Report the best of r runs'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        type=str,
+        default='bench_suite.json'
+    )
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default=None,
+        help='A JSON written by an earlier run, to compare with'
+    )
+    return parser.parse_args()
+
+
+def git_revision() -> Optional[str]:
+    """
+        The commit of the repository, with -dirty if it has uncommitted changes, or None outside git
+    """
+    repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo_path, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_path, capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if status.strip() else '')
+
+
+def run_stage(fn: Callable[[], R], repeat: int) -> Tuple[R, float, int]:
+    """
+        The result of fn, the best time of repeat runs, and the peak of the memory
+        allocated by one more run
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        begin_time = perf_counter()
+        result = fn()
+        times.append(perf_counter() - begin_time)
+    result = None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, min(times), peak
+
+
+def build_pat_tree(chord_seqs: List[Tuple[str, bytes]]) -> PATTree:
+    pat_tree = PATTree()
+    for key, chord_seq in chord_seqs:
+        pat_tree.insert(chord_seq, key)
+    pat_tree.finalize()
+    return pat_tree
+
+
+def bench_scale(corpus_path: str, scale: int, args: Namespace, work_path: str) -> dict:
+    stages = dict()
+
+    def record(name: str, seconds: float, peak: int, items: int, unit: str) -> None:
+        stages[name] = {
+            'seconds': seconds,
+            'peak_bytes': peak,
+            'items': items,
+            'unit': unit,
+            'per_second': items / seconds if seconds > 0 else None,
+        }
+        print(f'{scale}x {name}: {seconds:.3f} s, {peak / 2**20:.1f} MiB peak, {items / seconds:.0f} {unit} per second')
+
+    (folksong_list, total_record), seconds, peak = run_stage(lambda: read_folksongs(corpus_path), args.repeat)
+    record('parse', seconds, peak, total_record, 'records')
+
+    melodies = [(f.melody_str, f.time_unit, f.metre) for f in folksong_list]
+    note_seqs, seconds, peak = run_stage(lambda: [jianpu_to_note_seq(*m) for m in melodies], args.repeat)
+    note_number = sum(len(note_seq) for note_seq in note_seqs)
+    record('jianpu', seconds, peak, note_number, 'notes')
+    del note_seqs, melodies
+
+    songs = [(f.melody, f.tonic, f.metre) for f in folksong_list]
+    chunks, seconds, peak = run_stage(
+        lambda: [
+            detect_chunk((songs[i:i+DETECTION_CHUNK_SIZE], 0.3, 1.0, 8.0, False, False))
+            for i in range(0, len(songs), DETECTION_CHUNK_SIZE)
+        ],
+        args.repeat
+    )
+    record('detect', seconds, peak, len(songs), 'songs')
+    chord_seqs = [
+        (f.key, chord_seq)
+        for f, chord_seq in zip(folksong_list, (cs for chunk in chunks for cs in chunk.chord_seqs))
+    ]
+    chord_number = sum(len(chord_seq) for _, chord_seq in chord_seqs)
+    del chunks, songs
+
+    pat_tree, seconds, peak = run_stage(lambda: build_pat_tree(chord_seqs), args.repeat)
+    record('pattree_insert', seconds, peak, chord_number, 'chords')
+
+    rng = random.Random(args.seed)
+    nonempty_chord_seqs = [chord_seq for _, chord_seq in chord_seqs if len(chord_seq) > 0]
+    queries = []
+    for _ in range(args.query_number if nonempty_chord_seqs else 0):
+        chord_seq = rng.choice(nonempty_chord_seqs)
+        begin = rng.randrange(len(chord_seq))
+        queries.append(chord_seq[begin:begin+rng.randint(1, 8)])
+    _, seconds, peak = run_stage(lambda: [len(pat_tree.search(q)) for q in queries], args.repeat)
+    record('pattree_search', seconds, peak, len(queries), 'queries')
+    del pat_tree, queries, nonempty_chord_seqs, chord_seqs
+
+    md, seconds, peak = run_stage(lambda: MusicDatabase(folksong_list, 0.3, 1.0, 8.0), args.repeat)
+    record('build', seconds, peak, len(folksong_list), 'songs')
+    song_number = len(folksong_list)
+    del folksong_list
+
+    pickle_path = os.path.join(work_path, f'md_{scale}x.pickle')
+    def dump() -> int:
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(md, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return os.path.getsize(pickle_path)
+    pickle_size, seconds, peak = run_stage(dump, args.repeat)
+    record('pickle_dump', seconds, peak, pickle_size, 'bytes')
+    del md
+
+    def load() -> MusicDatabase:
+        with open(pickle_path, 'rb') as f:
+            return pickle.load(f)
+    _, seconds, peak = run_stage(load, args.repeat)
+    record('pickle_load', seconds, peak, pickle_size, 'bytes')
+    os.remove(pickle_path)
+
+    return {
+        'scale': scale,
+        'songs': song_number,
+        'records': total_record,
+        'notes': note_number,
+        'chords': chord_number,
+        'pickle_bytes': pickle_size,
+        'stages': stages,
+    }
+
+
+def compare(result: dict, baseline: dict) -> None:
+    print(f'compared with {baseline.get("revision")} ({baseline.get("date")}):')
+    baseline_scales = {s['scale']: s for s in baseline['scales']}
+    for s in result['scales']:
+        b = baseline_scales.get(s['scale'])
+        if b is None:
+            continue
+        if b['songs'] != s['songs']:
+            print(f'  {s["scale"]}x: {b["songs"]} songs in the baseline, {s["songs"]} here')
+        for name, stage in s['stages'].items():
+            b_stage = b['stages'].get(name)
+            if b_stage is None:
+                continue
+            print(
+                f'  {s["scale"]}x {name}: '
+                f'{b_stage["seconds"]:.3f} -> {stage["seconds"]:.3f} s ({stage["seconds"] / b_stage["seconds"]:.2f}x), '
+                f'{b_stage["peak_bytes"] / 2**20:.1f} -> {stage["peak_bytes"] / 2**20:.1f} MiB peak'
+            )
+
+
+def main():
+    args = read_args()
+    result = {
+        'revision': git_revision(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': detector.np is not None,
+        'options': {
+            'song_number': args.song_number,
+            'file_number': args.file_number,
+            'bars': args.bars,
+            'metres': args.metres,
+            'triplet_density': args.triplet_density,
+            'tie_density': args.tie_density,
+            'seed': args.seed,
+            'query_number': args.query_number,
+            'repeat': args.repeat,
+        },
+        'scales': [],
+    }
+    with tempfile.TemporaryDirectory() as work_path:
+        corpus_dir = args.corpus_dir or work_path
+        for scale in args.scales:
+            corpus_path = os.path.join(corpus_dir, f'corpus_{scale}x')
+            write_corpus(
+                corpus_path, args.song_number * scale, args.file_number, tuple(args.bars),
+                args.metres, args.triplet_density, args.tie_density, args.seed
+            )
+            result['scales'].append(bench_scale(corpus_path, scale, args, work_path))
+            # write after every scale, so a long run that is stopped keeps the scales it finished
+            with open(args.output, 'w', encoding='utf8') as f:
+                json.dump(result, f, indent=2)
+    print(f'results written to {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf8') as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+Write a synthetic corpus of .sm files in the format of the Essen Folksong Database
+
+    python3 -m benchmarks.make_corpus path/to/output/directory -n 6000 --files 21
+
+Every record has a subsection line, CUT, TRD, KEY, MEL and TXT fields and ends with >>,
+like the records of the real files. The melodies are random but well formed: every
+measure is filled with notes, rests, ties and triplets to the length of its metre,
+the first measure may be an anacrusis, and the melody is wrapped a phrase per line.
+The same arguments and seed write the same files, so a corpus can be scaled 10x or
+100x by its song number alone.
+"""
+
+from argparse import ArgumentParser, Namespace
+import os
+import random
+from typing import List, Sequence, Tuple
+
+# about the number of records parsed from the 21 files of the real dataset
+DEFAULT_SONG_NUMBER = 6000
+DEFAULT_FILE_NUMBER = 21
+DEFAULT_BARS = (4, 40)
+DEFAULT_METRES = ['2/4', '3/4', '4/4', '6/8', '3/8', '2/4 3/4']
+DEFAULT_TONICS = ['C', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'A', 'Bb']
+
+# time units of a quarter note, as written in KEY: quarter, eighth and sixteenth
+TIME_UNITS = [4, 8, 16]
+# (suffix, length in time units) of a note, and how often it is drawn
+NOTE_LENGTHS = [('', 1), ('_', 2), ('_.', 3), ('__', 4)]
+NOTE_LENGTH_WEIGHTS = [50, 30, 10, 10]
+
+ANACRUSIS_PROBABILITY = 0.3
+REST_PROBABILITY = 0.05
+OCTAVE_PROBABILITY = 0.1
+ACCIDENTAL_PROBABILITY = 0.05
+# measures per line of MEL
+PHRASE_MEASURES = (2, 4)
+
+
+def add_corpus_arguments(parser: ArgumentParser) -> None:
+    """
+        The options of write_corpus but the song number, shared with bench_suite
+    """
+    parser.add_argument(
+        '--files',
+        dest='file_number',
+        type=int,
+        default=DEFAULT_FILE_NUMBER
+    )
+    parser.add_argument(
+        '--bars',
+        type=int,
+        nargs=2,
+        default=DEFAULT_BARS,
+        metavar=('MIN', 'MAX'),
+        help='Range of the number of measures of a song'
+    )
+    parser.add_argument(
+        '--metres',
+        type=str,
+        nargs='+',
+        default=DEFAULT_METRES,
+        help='Metres drawn for the songs, an additive metre like "2/4 3/4" is quoted'
+    )
+    parser.add_argument(
+        '--triplet-density',
+        type=float,
+        default=0.05,
+        help='Probability that the next two time units of a measure are a triplet'
+    )
+    parser.add_argument(
+        '--tie-density',
+        type=float,
+        default=0.05,
+        help='Probability that a note is followed by a tie'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0
+    )
+
+def read_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument(
+        'output_path',
+        type=str
+    )
+    parser.add_argument(
+        '-n',
+        dest='song_number',
+        type=int,
+        default=DEFAULT_SONG_NUMBER
+    )
+    add_corpus_arguments(parser)
+    return parser.parse_args()
+
+
+def random_pitch(rng: random.Random, accidental: bool = True, rest: bool = True) -> str:
+    if rest and rng.random() < REST_PROBABILITY:
+        return '0'
+    pitch = rng.choice('1234567')
+    r = rng.random()
+    if r < OCTAVE_PROBABILITY:
+        pitch = '-' + pitch
+    elif r < 2 * OCTAVE_PROBABILITY:
+        pitch = '+' + pitch
+    if accidental and rng.random() < ACCIDENTAL_PROBABILITY:
+        pitch += rng.choice('#b')
+    return pitch
+
+def random_measure(
+        rng: random.Random,
+        length: int,
+        triplet_density: float,
+        tie_density: float,
+        leading_rest: bool = True) -> str:
+    """
+        Notes, rests, ties and triplets of length time units in total.
+        The first measure of a melody has no leading rest, the parser needs a note in it.
+    """
+    tokens: List[str] = []
+    left = length
+    while left > 0:
+        rest = leading_rest or len(tokens) > 0
+        if left >= 2 and rng.random() < triplet_density:
+            tokens.append('(' + ''.join(random_pitch(rng, False, rest or i > 0) for i in range(3)) + ')')
+            left -= 2
+            continue
+        suffix, note_length = rng.choices(NOTE_LENGTHS, NOTE_LENGTH_WEIGHTS)[0]
+        if note_length > left:
+            suffix, note_length = '', 1
+        pitch = random_pitch(rng, rest=rest)
+        tokens.append(pitch + suffix)
+        left -= note_length
+        # a tie holds the last note, not a rest
+        if left > 0 and pitch != '0' and rng.random() < tie_density:
+            tokens.append('^')
+            left -= 1
+    return ''.join(tokens)
+
+def measure_lengths(metre: str, time_unit: int) -> List[int]:
+    """
+        The lengths in time units of the measures allowed by metre, one per metre of an additive metre
+    """
+    lengths = []
+    for m in metre.split():
+        numerator, denominator = map(int, m.split('/'))
+        lengths.append(numerator * time_unit // denominator)
+    return lengths
+
+def random_record(
+        rng: random.Random,
+        subset: str,
+        index: int,
+        bars: Tuple[int, int],
+        metres: Sequence[str],
+        triplet_density: float,
+        tie_density: float) -> str:
+    metre = rng.choice(metres)
+    largest_denominator = max(int(m.split('/')[1]) for m in metre.split())
+    time_unit = rng.choice([u for u in TIME_UNITS if u >= largest_denominator] or [largest_denominator])
+    lengths = measure_lengths(metre, time_unit)
+    measures = [
+        random_measure(rng, rng.choice(lengths), triplet_density, tie_density, leading_rest=(i > 0))
+        for i in range(rng.randint(*bars))
+    ]
+    if rng.random() < ANACRUSIS_PROBABILITY:
+        measures[0] = random_measure(rng, max(1, lengths[0] // 2), triplet_density, tie_density, leading_rest=False)
+
+    lines = []
+    i = 0
+    while i < len(measures):
+        phrase_length = rng.randint(*PHRASE_MEASURES)
+        lines.append('  '.join(measures[i:i+phrase_length]))
+        i += phrase_length
+    melody = '\n    '.join(lines)
+
+    signature = f'S{index:06d}'
+    tonic = rng.choice(DEFAULT_TONICS)
+    return (
+        f'{subset}\n'
+        f'CUT[Song {index}]\n'
+        f'TRD[synthetic]\n'
+        f'KEY[{signature:<7}{time_unit:02d}{tonic:>3} {metre}]\n'
+        f'MEL[{melody}  //]\n'
+        f'TXT[la la {index}]\n'
+        '>>\n'
+    )
+
+def write_corpus(
+        output_path: str,
+        song_number: int = DEFAULT_SONG_NUMBER,
+        file_number: int = DEFAULT_FILE_NUMBER,
+        bars: Tuple[int, int] = DEFAULT_BARS,
+        metres: Sequence[str] = DEFAULT_METRES,
+        triplet_density: float = 0.05,
+        tie_density: float = 0.05,
+        seed: int = 0) -> List[str]:
+    """
+        Write song_number records over file_number .sm files in output_path,
+        and return the paths of the files
+    """
+    assert song_number >= 0 and file_number > 0
+    assert 1 <= bars[0] <= bars[1]
+    os.makedirs(output_path, exist_ok=True)
+    rng = random.Random(seed)
+    file_paths = []
+    for file_index in range(file_number):
+        subset = f'SYNTH{file_index + 1:02d}'
+        file_path = os.path.join(output_path, f'synth{file_index + 1:02d}.sm')
+        with open(file_path, 'w', encoding='utf8') as f:
+            for index in range(file_index * song_number // file_number, (file_index + 1) * song_number // file_number):
+                f.write(random_record(rng, subset, index + 1, bars, metres, triplet_density, tie_density))
+                f.write('\n')
+        file_paths.append(file_path)
+    return file_paths
+
+
+def main():
+    args = read_args()
+    file_paths = write_corpus(
+        args.output_path, args.song_number, args.file_number, tuple(args.bars),
+        args.metres, args.triplet_density, args.tie_density, args.seed
+    )
+    print(f'{args.song_number} songs written to {len(file_paths)} files in {args.output_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -37,19 +37,38 @@ Reference:
 
 """
 
-from typing import List, Mapping, Set, Tuple
+from array import array
+from collections import deque
+from collections.abc import Sized
+from concurrent.futures import ProcessPoolExecutor
+import copy
+from functools import lru_cache
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Set, Tuple, TypeVar
 
 from tqdm import tqdm
 
-from musical_things import MusicNote, Chord, Metre, NOTE_NAME_TO_NUMBER, NOTE_NAME, chord_to_str
+import profiling
+
+from musical_things import NoteSeq, NoteSeqLike, ChordSeq, Metre, MusicKey, NOTE_NAME_TO_NUMBER, NOTE_NAME, chord_to_str
 from detector import (
+    get_detector_config,
+    abs_note_seq_to_music_key,
+    denormalize_note_seq,
+    BarProfiles,
+    abs_note_seq_to_bar_profiles,
+    bar_profiles_to_chrod_seqs,
     normalized_note_seq_to_music_key,
-    abs_note_seq_to_chrod_seq,
-    normalized_note_seq_to_chrod_seq,
+    abs_note_seqs_to_chrod_seqs,
     old_abs_note_seq_to_chrod_seq,
     old_normalized_note_seq_to_chrod_seq
 )
 from jianpu import jianpu_to_note_seq
+from approximate_search import approximate_search, DEFAULT_NODE_BUDGET
+from suffix_array import SuffixArrayIndex
+from qgram_index import QGramIndex
+from result_cache import ResultCache, CacheInfo
+from relative_index import RelativeChordIndex, RELATIVE_CHORDS
 
 
 FolksongKey = str
@@ -59,6 +78,16 @@ KEY_TAG = 'KEY'
 MELODY_TAG = 'MEL'
 LYRICS_TAG = 'TXT'
 
+# number of decoded melodies kept for folksongs that do not hold their own
+MELODY_CACHE_SIZE = 1024
+
+@lru_cache(maxsize=MELODY_CACHE_SIZE)
+def decode_melody(key: str, melody_str: str, time_unit: float, metre: Metre) -> NoteSeq:
+    # key is part of the cache key only so that different songs never share an entry
+    with profiling.stage('jianpu_decode'):
+        return jianpu_to_note_seq(melody_str, time_unit, metre)
+
+
 class Folksong:
     def __init__(self,
             subset: str,
@@ -67,19 +96,34 @@ class Folksong:
             time_unit: int,
             tonic: int,
             metre: Metre,
-            melody: List[MusicNote],
+            melody: Optional[NoteSeq],
             melody_str: str,
             lyrics: str) -> None:
+        """
+            If melody is None, it is decoded from melody_str when it is first used.
+        """
         self.subset = subset
         self.title = title
         self.signature = signature
         self.time_unit = time_unit
         self.tonic = tonic
         self.metre = metre
-        self.melody = melody
+        self._melody = melody
         self.melody_str = melody_str
         self.lyrics = lyrics
 
+    @property
+    def melody(self) -> NoteSeq:
+        if self._melody is None:
+            return decode_melody(self.key, self.melody_str, self.time_unit, self.metre)
+        return self._melody
+
+    def __setstate__(self, state: dict) -> None:
+        # folksongs pickled before melodies could be decoded lazily
+        if 'melody' in state:
+            state['_melody'] = state.pop('melody')
+        self.__dict__.update(state)
+
     def __str__(self):
         return f'{self.subset} - {self.signature}\n'\
             f'Title: {self.title}\n'\
@@ -159,7 +203,8 @@ class Folksong:
                 melody_str = melody_str.replace('  ', '|').replace(' ', '') # use "|"as measure line
                 melody_str = melody_str.lstrip('|') # remove empty measures at beggining
                 try:
-                    melody = jianpu_to_note_seq(melody_str, time_unit, metre)
+                    with profiling.stage('jianpu_decode'):
+                        melody = jianpu_to_note_seq(melody_str, time_unit, metre)
                 except Exception as e:
                     print(deseperated_lines)
                     print(f'{title}\n{signature}\n{time_unit}\n{tonic}\n{metre}\n{melody_str}\n{lyrics}')
@@ -169,11 +214,133 @@ class Folksong:
                 lyrics = l[4:-1]
         return cls(filename, title, signature, time_unit, tonic, metre, melody, melody_str, lyrics)
 
+class FolksongStore(Mapping[FolksongKey, Folksong]):
+    """
+        The folksongs of a database as one column per attribute, in insertion order.
+        A Folksong is only created when it is looked up, and its melody is decoded from the
+        jianpu string when it is used, so a loaded database holds no note at all.
+    """
+    def __init__(self, Folksong_list: List[Folksong] = ()) -> None:
+        self.keys_column: List[FolksongKey] = []
+        self.subsets: List[str] = []
+        self.titles: List[str] = []
+        self.signatures: List[str] = []
+        self.time_units = array('d')
+        self.tonics = array('b')
+        # few distinct metres: store each once, and its index per folksong
+        self.metre_table: List[Metre] = []
+        self.metre_ids = array('H')
+        self.melody_strs: List[str] = []
+        self.lyrics: List[str] = []
+        self.build_index()
+        self.extend(Folksong_list)
+
+    def build_index(self) -> None:
+        self.rows = {k: i for i, k in enumerate(self.keys_column)}
+        # repr tells 3 from 3.0, which are printed differently
+        self.metre_ids_by_repr = {repr(m): i for i, m in enumerate(self.metre_table)}
+
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__)
+        del state['rows']
+        del state['metre_ids_by_repr']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.build_index()
+
+    def copy(self) -> 'FolksongStore':
+        """
+            A store with its own columns, sharing their strings
+        """
+        store = FolksongStore()
+        store.__setstate__({name: copy.copy(column) for name, column in self.__getstate__().items()})
+        return store
+
+    def extend(self, Folksong_list: List[Folksong]) -> None:
+        for f in Folksong_list:
+            key = f.key
+            if key in self.rows:
+                raise AssertionError(f'{key} repeated at {f}')
+            self.rows[key] = len(self.keys_column)
+            self.keys_column.append(key)
+            self.subsets.append(f.subset)
+            self.titles.append(f.title)
+            self.signatures.append(f.signature)
+            self.time_units.append(f.time_unit)
+            self.tonics.append(f.tonic)
+            metre_id = self.metre_ids_by_repr.get(repr(f.metre))
+            if metre_id is None:
+                metre_id = len(self.metre_table)
+                self.metre_table.append(f.metre)
+                self.metre_ids_by_repr[repr(f.metre)] = metre_id
+            self.metre_ids.append(metre_id)
+            self.melody_strs.append(f.melody_str)
+            self.lyrics.append(f.lyrics)
+
+    def remove(self, keys: List[FolksongKey]) -> None:
+        """
+            Remove folksongs by key. Raise KeyError if a key is not in the store.
+        """
+        removed_rows = {self.rows[k] for k in keys}
+        kept_rows = [i for i in range(len(self.keys_column)) if i not in removed_rows]
+        self.keys_column = [self.keys_column[i] for i in kept_rows]
+        self.subsets = [self.subsets[i] for i in kept_rows]
+        self.titles = [self.titles[i] for i in kept_rows]
+        self.signatures = [self.signatures[i] for i in kept_rows]
+        self.time_units = array('d', [self.time_units[i] for i in kept_rows])
+        self.tonics = array('b', [self.tonics[i] for i in kept_rows])
+        self.metre_ids = array('H', [self.metre_ids[i] for i in kept_rows])
+        self.melody_strs = [self.melody_strs[i] for i in kept_rows]
+        self.lyrics = [self.lyrics[i] for i in kept_rows]
+        self.build_index()
+
+    def __getitem__(self, key: FolksongKey) -> Folksong:
+        i = self.rows[key]
+        return Folksong(
+            self.subsets[i],
+            self.titles[i],
+            self.signatures[i],
+            self.time_units[i],
+            self.tonics[i],
+            self.metre_table[self.metre_ids[i]],
+            None,
+            self.melody_strs[i],
+            self.lyrics[i]
+        )
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(self.keys_column)
+
+    def __len__(self) -> int:
+        return len(self.keys_column)
+
+
+def common_prefix_length(a: ChordSeq, b: ChordSeq) -> int:
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    i = 0
+    while a[i] == b[i]:
+        i += 1
+    return i
+
+
 class PATTreeNode:
-    def __init__(self, nid) -> None:
+    def __init__(self, nid, link: ChordSeq = b'') -> None:
         self.nid = nid
-        self.children: Mapping[List[Chord], PATTreeNode] = dict()
+        # the chord sequence on the link from the parent to this node
+        self.link = link
+        # children are indexed by the first chord of their link, which is unique among siblings
+        self.children: Mapping[int, PATTreeNode] = dict()
         self.keys: Set[FolksongKey] = set()
+        # [lo, hi) of this subtree's keys in PATTree.dfs_key_ids, set by PATTree.finalize
+        self.lo = 0
+        self.hi = 0
 
     def get_subtree_keys(self) -> Set[FolksongKey]:
         res_set = set(self.keys)
@@ -186,8 +353,8 @@ class PATTreeNode:
         return {
             'nid': self.nid,
             'children': {
-                ','.join([chord_to_str(c) for c in k]): v.to_dict()
-                for k, v in self.children.items()
+                ','.join([chord_to_str(c) for c in v.link]): v.to_dict()
+                for v in self.children.values()
             },
             'keys': list(self.keys)
         }
@@ -203,187 +370,843 @@ class PATTree:
     def __init__(self) -> None:
         self.head = PATTreeNode(0)
         self.node_number = 1
-    
+        # keys are numbered in the order they are first inserted
+        self.key_ids: Mapping[FolksongKey, int] = dict()
+        self.key_table: List[FolksongKey] = []
+        # the keys of all nodes in DFS order, so a subtree's keys are one slice
+        self.dfs_key_ids = array('I')
+        self.finalized = False
+
     def leaf_number(self) -> int:
-        return len(self.head.get_subtree_keys()) 
+        if not self.finalized:
+            self.finalize()
+        return self.leaf_count
 
     def __len__(self) -> int:
         return self.node_number
 
-    def insert(self, chord_seq: Tuple[Chord], key: FolksongKey) -> None:
-        si_seqs = [
-            chord_seq[i:]
-            for i in range(len(chord_seq))
-        ]
-        for sis in si_seqs:
-            # print('sis:', chord_seq_to_str(sis))
-            sis = tuple(sis)
+    def finalize(self) -> None:
+        """
+            Number the keys in DFS order and store the [lo, hi) range of every node's subtree,
+            so that search returns a slice of dfs_key_ids instead of walking the subtree.
+            Have to be called again after inserting.
+        """
+        key_ids = self.key_ids
+        dfs_key_ids = array('I')
+        # a node is pushed twice: once to enter it and once to close its range
+        stack: List[Tuple[PATTreeNode, bool]] = [(self.head, False)]
+        while len(stack) > 0:
+            node, is_exit = stack.pop()
+            if is_exit:
+                node.hi = len(dfs_key_ids)
+                continue
+            node.lo = len(dfs_key_ids)
+            dfs_key_ids.extend(sorted(key_ids[k] for k in node.keys))
+            stack.append((node, True))
+            for child_node in reversed(list(node.children.values())):
+                stack.append((child_node, False))
+        self.dfs_key_ids = dfs_key_ids
+        self.leaf_count = len(set(dfs_key_ids))
+        self.finalized = True
+
+    def insert(self, chord_seq: ChordSeq, key: FolksongKey) -> None:
+        if len(chord_seq) > 0 and key not in self.key_ids:
+            self.key_ids[key] = len(self.key_table)
+            self.key_table.append(key)
+        self.finalized = False
+        seq_len = len(chord_seq)
+        # counted in locals and added to the profile once, so that they cost little when it is disabled
+        visited = 0
+        created = 0
+        splits = 0
+        for si in range(seq_len):
+            # the semi-infinite string chord_seq[si:], walked with an index instead of slicing
+            # print('sis:', chord_seq_to_str(chord_seq[si:]))
+            pos = si
             cur_node = self.head
-            while len(sis) > 0:
-                # scan current node's link for any sequence that starts the same as sis
+            while pos < seq_len:
                 # print('  at node', cur_node.nid)
-                found_same_start = 0
-                for link, child_node in cur_node.children.items():
-                    for i in range(1, min(len(sis), len(link))+1):
-                        sis_start = sis[:i]
-                        if all(i == j for i, j in zip(sis_start, link)):
-                            found_same_start = i
-                        else:
-                            break
-                    if found_same_start > 0:
-                        # print('  link to', child_node.nid, ':', chord_seq_to_str(link), 'found_same_start:', found_same_start)
-                        if found_same_start < len(link):
-                            # link is longer than sis
-                            # have to insert a new node between cur_node and cur_children[link]
-                            # Old: cur_node -- link --> child_node
-                            # New: cur_node -- link[:found_same_start] --> new_node
-                            # new_node.children = {
-                            #     link[found_same_start:]: child_node,
-                            # }
-                            new_node = PATTreeNode(self.node_number)
-                            self.node_number += 1
-                            cur_node.children[link[:found_same_start]] = new_node
-                            new_node.children[link[found_same_start:]] = child_node
-                            # print(
-                            #     '  link split: add new node', new_node.nid,
-                            #     chord_seq_to_str(link[:found_same_start]),
-                            #     'and', chord_seq_to_str(link[found_same_start:])
-                            # )
-                            del cur_node.children[link]
-                            child_node = new_node
-
-                        if found_same_start == len(sis):
-                            # print('  add key')
-                            child_node.keys.add(key)
-                            sis = [] # leave while loop
-                        else:
-                            sis = sis[found_same_start:]
-                        # update
-                        cur_node = child_node
-                        break
-
-                # no link found
-                if found_same_start == 0:
-                    cur_node.children[sis] = PATTreeNode(self.node_number)
+                visited += 1
+                child_node = cur_node.children.get(chord_seq[pos])
+                if child_node is None:
+                    # no link starts with the same chord
+                    created += 1
+                    new_node = PATTreeNode(self.node_number, chord_seq[pos:])
                     self.node_number += 1
-                    # print('  create node', cur_node.children[sis].nid, 'and add key')
-                    cur_node.children[sis].keys.add(key)
-                    cur_node = cur_node.children
-                    sis = []
+                    # print('  create node', new_node.nid, 'and add key')
+                    new_node.keys.add(key)
+                    cur_node.children[chord_seq[pos]] = new_node
                     break
 
-    def search(self, chord_seq: List[Chord]) -> Set[FolksongKey]:
-        s = list(chord_seq)
-        cur_node = self.head
-        while len(s) > 0:
-            # print("s", chord_seq_to_str(s))
-            found_same_start = 0
-            # print(len(cur_node.children), len(cur_node.keys))
-            for link, child_node in cur_node.children.items():
-                for i in range(1, min(len(s), len(link))+1):
-                    s_start = s[:i]
-                    if all(i == j for i, j in zip(s_start, link)):
-                        found_same_start = i
-                    else:
-                        break
+                link = child_node.link
+                found_same_start = common_prefix_length(chord_seq[pos:pos+len(link)], link)
+                # print('  link to', child_node.nid, ':', chord_seq_to_str(link), 'found_same_start:', found_same_start)
+                if found_same_start < len(link):
+                    # link is longer than the common part
+                    # have to insert a new node between cur_node and child_node
+                    # Old: cur_node -- link --> child_node
+                    # New: cur_node -- link[:found_same_start] --> new_node
+                    #      new_node -- link[found_same_start:] --> child_node
+                    new_node = PATTreeNode(self.node_number, link[:found_same_start])
+                    self.node_number += 1
+                    child_node.link = link[found_same_start:]
+                    new_node.children[link[found_same_start]] = child_node
+                    cur_node.children[link[0]] = new_node
+                    # print('  link split: add new node', new_node.nid)
+                    child_node = new_node
+                    splits += 1
 
-                if found_same_start > 0:
-                    # print('  link to', child_node.nid, ':', chord_seq_to_str(link), 'found_same_start:', found_same_start)
-                    if found_same_start == len(s):
-                        # found
-                        s = [] # leave while loop
-                    else:
-                        # keep going
-                        s = s[found_same_start:]
-                    # update
-                    cur_node = child_node
-                    break
+                pos += found_same_start
+                if pos == seq_len:
+                    # print('  add key')
+                    child_node.keys.add(key)
+                cur_node = child_node
+        profile = profiling.PROFILE
+        if profile is not None:
+            profile.count('pattree.insert.nodes_visited', visited)
+            # every visit compares the link of a child, but the ones finding no child
+            profile.count('pattree.insert.prefix_comparisons', visited - created)
+            profile.count('pattree.insert.edge_splits', splits)
 
-            if found_same_start == 0:
+    def find_node(self, chord_seq: ChordSeq) -> Optional[PATTreeNode]:
+        """
+            Return the highest node whose path from head starts with chord_seq, or None
+        """
+        seq_len = len(chord_seq)
+        pos = 0
+        cur_node = self.head
+        visited = 0
+        while pos < seq_len:
+            # print("s", chord_seq_to_str(chord_seq[pos:]))
+            visited += 1
+            child_node = cur_node.children.get(chord_seq[pos])
+            if child_node is None:
                 # print('no matching links')
-                return set()
+                self.count_search(visited, visited - 1)
+                return None
+            link = child_node.link
+            found_same_start = common_prefix_length(chord_seq[pos:pos+len(link)], link)
+            # print('  link to', child_node.nid, ':', chord_seq_to_str(link), 'found_same_start:', found_same_start)
+            if found_same_start < len(link) and pos + found_same_start < seq_len:
+                # the query leaves the link in the middle: no suffix starts with it
+                self.count_search(visited, visited)
+                return None
+            pos += found_same_start
+            cur_node = child_node
         # end while
-        return cur_node.get_subtree_keys()
+        self.count_search(visited, visited)
+        return cur_node
+
+    def find_nodes(self, chord_seqs: List[ChordSeq]) -> List[Optional[PATTreeNode]]:
+        """
+            find_node of every chord sequence in one traversal.
+            The sequences sharing a prefix descend the links of that prefix together.
+        """
+        found: List[Optional[PATTreeNode]] = [None] * len(chord_seqs)
+        # (node, length of the path to node, indices of the sequences starting with that path)
+        stack = [(self.head, 0, list(range(len(chord_seqs))))]
+        visited = 0
+        compared = 0
+        while len(stack) > 0:
+            cur_node, pos, seq_indices = stack.pop()
+            visited += 1
+            groups = dict()
+            for i in seq_indices:
+                chord_seq = chord_seqs[i]
+                if len(chord_seq) == pos:
+                    found[i] = cur_node
+                else:
+                    groups.setdefault(chord_seq[pos], []).append(i)
+            for c, group in groups.items():
+                child_node = cur_node.children.get(c)
+                if child_node is None:
+                    # no matching links
+                    continue
+                link = child_node.link
+                link_end = pos + len(link)
+                passed = []
+                compared += len(group)
+                for i in group:
+                    chord_seq = chord_seqs[i]
+                    if len(chord_seq) <= link_end:
+                        # the sequence ends on this link
+                        if chord_seq[pos:] == link[:len(chord_seq)-pos]:
+                            found[i] = child_node
+                    elif chord_seq[pos:link_end] == link:
+                        passed.append(i)
+                if len(passed) > 0:
+                    stack.append((child_node, link_end, passed))
+        self.count_search(visited, compared)
+        return found
+
+    def count_search(self, visited: int, compared: int) -> None:
+        """
+            Add the nodes visited and the links compared by a search to the profile, if it is enabled
+        """
+        profile = profiling.PROFILE
+        if profile is not None:
+            profile.count('pattree.search.nodes_visited', visited)
+            profile.count('pattree.search.prefix_comparisons', compared)
+
+    def node_keys(self, node: PATTreeNode) -> Set[FolksongKey]:
+        if not self.finalized:
+            keys = node.get_subtree_keys()
+        else:
+            key_table = self.key_table
+            keys = {key_table[i] for i in self.dfs_key_ids[node.lo:node.hi]}
+        profile = profiling.PROFILE
+        if profile is not None:
+            profile.record_size('pattree.subtree_keys', len(keys))
+        return keys
+
+    def search(self, chord_seq: ChordSeq) -> Set[FolksongKey]:
+        node = self.find_node(chord_seq)
+        if node is None:
+            return set()
+        return self.node_keys(node)
+
+    def search_approximate(
+            self,
+            chord_seq: ChordSeq,
+            max_edits: int,
+            top_n: Optional[int] = 10,
+            node_budget: Optional[int] = DEFAULT_NODE_BUDGET) -> List[Tuple[FolksongKey, int]]:
+        """
+            (key, edit cost) of the top_n songs containing chord_seq with at most max_edits
+            chord substitutions, insertions or deletions, sorted by cost. See approximate_search.py
+        """
+        if not self.finalized:
+            self.finalize()
 
-    def delete(self, chord_seq: List[Chord], semi_infinite: bool = False):
-        raise NotImplementedError()
+        def edges(node: PATTreeNode):
+            for child_node in node.children.values():
+                yield child_node.link, child_node, child_node.lo, child_node.hi
 
+        return approximate_search(
+            chord_seq, max_edits, top_n, node_budget,
+            self.head, (self.head.lo, self.head.hi), self.dfs_key_ids, self.key_table.__getitem__, edges
+        )
+
+    def search_many(self, chord_seqs: List[ChordSeq]) -> List[Set[FolksongKey]]:
+        """
+            search of every chord sequence, walking the tree once for all of them.
+            Equal sequences share one result set, which should not be modified.
+        """
+        unique_chord_seqs = list(dict.fromkeys(chord_seqs))
+        results = dict()
+        for chord_seq, node in zip(unique_chord_seqs, self.find_nodes(unique_chord_seqs)):
+            results[chord_seq] = set() if node is None else self.node_keys(node)
+        return [results[chord_seq] for chord_seq in chord_seqs]
+
+    def count(self, chord_seq: ChordSeq) -> int:
+        """
+            Number of occurrences of chord_seq in all inserted sequences.
+            Each suffix ends at its own node, so this is the size of the node's key range.
+        """
+        if not self.finalized:
+            self.finalize()
+        node = self.find_node(chord_seq)
+        if node is None:
+            return 0
+        return node.hi - node.lo
+
+    def delete(self, chord_seq: ChordSeq, key: FolksongKey) -> None:
+        """
+            Remove key from the nodes of all suffixes of chord_seq, which must be the sequence it was inserted with.
+            Nodes left without keys are pruned if they have no children,
+            or merged into their only child, so the tree stays the same as one built without the key.
+        """
+        self.finalized = False
+        seq_len = len(chord_seq)
+        for si in range(seq_len):
+            # the nodes from head to the node where chord_seq[si:] ends
+            path = [self.head]
+            pos = si
+            while pos < seq_len:
+                child_node = path[-1].children.get(chord_seq[pos])
+                if child_node is None or chord_seq[pos:pos+len(child_node.link)] != child_node.link:
+                    raise KeyError(key)
+                pos += len(child_node.link)
+                path.append(child_node)
+            end_node = path[-1]
+            if key not in end_node.keys:
+                raise KeyError(key)
+            end_node.keys.remove(key)
+            # walk up until a node still needs to be there
+            for depth in range(len(path)-1, 0, -1):
+                node = path[depth]
+                parent_node = path[depth-1]
+                if len(node.keys) > 0 or len(node.children) > 1:
+                    break
+                if len(node.children) == 0:
+                    # print('  prune node', node.nid)
+                    del parent_node.children[node.link[0]]
+                    self.node_number -= 1
+                    continue
+                # print('  merge node', node.nid, 'into its child')
+                (child_node,) = node.children.values()
+                child_node.link = node.link + child_node.link
+                parent_node.children[node.link[0]] = child_node
+                self.node_number -= 1
+                break
+
+
+INDEX_TYPES = ['pattree', 'suffix_array']
+
+# number of folksongs whose chords are detected in one batch
+DETECTION_CHUNK_SIZE = 256
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+def ordered_map(
+        fn: Callable[[T], R],
+        args: Iterable[T],
+        jobs: int = 1,
+        initializer: Optional[Callable] = None,
+        initargs: tuple = ()) -> Iterator[R]:
+    """
+        map(fn, args), in jobs worker processes if jobs > 1, yielding in the order of args.
+        Unlike Executor.map, it reads at most 2 * jobs args ahead of the results it yields,
+        so that a long args iterator is not read at once and its results are not all held.
+        initializer(*initargs) is called in every worker before fn, or here if jobs <= 1.
+        When profiling is enabled, the workers profile fn and their profiles are merged here.
+    """
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, args)
+        return
+    profile = profiling.PROFILE
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        def result() -> R:
+            if profile is None:
+                return pending.popleft().result()
+            r, snapshot = pending.popleft().result()
+            profile.merge(snapshot)
+            return r
+        for a in args:
+            if profile is None:
+                pending.append(executor.submit(fn, a))
+            else:
+                pending.append(executor.submit(profiling.call_profiled, fn, a))
+            if len(pending) >= 2 * jobs:
+                yield result()
+        while pending:
+            yield result()
+
+def detect_normalized_chord_seqs(
+        songs: List[Tuple[NoteSeq, int, Metre]],
+        alpha: float,
+        beta: float,
+        tau: float,
+        old_chord_detection: bool) -> Tuple[List[ChordSeq], Optional[List[BarProfiles]]]:
+    """
+        The chord sequences of (normalized melody, tonic, metre), and the bar profiles they are detected from.
+        The old chord detection has no alpha, beta and tau to detect again with, and no bar profiles.
+    """
+    if old_chord_detection:
+        chord_seqs = [
+            old_normalized_note_seq_to_chrod_seq(melody, tonic, metre)
+            for melody, tonic, metre in songs
+        ]
+        return chord_seqs, None
+    bar_profiles_list = [
+        abs_note_seq_to_bar_profiles(denormalize_note_seq(melody, tonic), metre)
+        for melody, tonic, metre in songs
+    ]
+    return bar_profiles_to_chrod_seqs(bar_profiles_list, get_detector_config(alpha, beta, tau)), bar_profiles_list
+
+class DetectedChunk(NamedTuple):
+    music_keys: List[MusicKey]
+    chord_seqs: List[ChordSeq]
+    bar_profiles: Optional[List[BarProfiles]]
+    relative_chord_seqs: Optional[List[ChordSeq]]
+    relative_bar_profiles: Optional[List[BarProfiles]]
+
+def detect_chunk(
+        args: Tuple[List[Tuple[NoteSeq, int, Metre]], float, float, float, bool, bool]
+        ) -> DetectedChunk:
+    """
+        Detect the music keys and chord sequences of a chunk of (melody, tonic, metre),
+        and if relative, the chord sequences relative to the detected tonics.
+        It is a top-level function so that it can be sent to worker processes.
+    """
+    songs, alpha, beta, tau, old_chord_detection, relative = args
+    with profiling.stage('key_detection'):
+        music_keys = [
+            normalized_note_seq_to_music_key(melody, tonic)
+            for melody, tonic, _ in songs
+        ]
+    with profiling.stage('chord_detection'):
+        chord_seqs, bar_profiles = detect_normalized_chord_seqs(songs, alpha, beta, tau, old_chord_detection)
+    relative_chord_seqs, relative_bar_profiles = None, None
+    if relative:
+        # the melody is normalized to its annotated tonic, move it to have the detected tonic on C
+        relative_songs = [
+            (melody, (tonic - music_key.tonic) % 12, metre)
+            for (melody, tonic, metre), music_key in zip(songs, music_keys)
+        ]
+        with profiling.stage('chord_detection'):
+            relative_chord_seqs, relative_bar_profiles = detect_normalized_chord_seqs(
+                relative_songs, alpha, beta, tau, old_chord_detection
+            )
+    return DetectedChunk(music_keys, chord_seqs, bar_profiles, relative_chord_seqs, relative_bar_profiles)
+
+def detect_query_chord_seq(
+        q_abs_note_seq: NoteSeqLike,
+        metre: Metre,
+        old_chord_detection: bool,
+        alpha: float,
+        beta: float,
+        tau: float) -> ChordSeq:
+    with profiling.stage('query_detection'):
+        if old_chord_detection:
+            return old_abs_note_seq_to_chrod_seq(q_abs_note_seq, metre)
+        # a batch of one: with numpy, its bars are scored together instead of one by one
+        return abs_note_seqs_to_chrod_seqs([q_abs_note_seq], [metre], config=get_detector_config(alpha, beta, tau))[0]
+
+def detect_query_chord_seqs(
+        queries: List[Tuple[NoteSeqLike, Metre]],
+        old_chord_detection: bool,
+        alpha: float,
+        beta: float,
+        tau: float) -> List[ChordSeq]:
+    """
+        Chord sequences of (abs_note_seq, metre) queries, detected in one batch
+    """
+    with profiling.stage('query_detection'):
+        if old_chord_detection:
+            return [old_abs_note_seq_to_chrod_seq(q_abs_note_seq, metre) for q_abs_note_seq, metre in queries]
+        return abs_note_seqs_to_chrod_seqs(
+            [q_abs_note_seq for q_abs_note_seq, _ in queries],
+            [metre for _, metre in queries],
+            config=get_detector_config(alpha, beta, tau)
+        )
+
+def to_relative_query(q_abs_note_seq: NoteSeqLike) -> NoteSeq:
+    """
+        The query transposed to have its detected tonic on C
+    """
+    _, tonic = abs_note_seq_to_music_key(q_abs_note_seq)
+    return denormalize_note_seq(q_abs_note_seq, (12 - tonic) % 12)
+
+class SourceFile(NamedTuple):
+    """
+        A dataset file the database was built from, to find the files changed since then
+    """
+    size: int
+    mtime_ns: int
+    keys: List[FolksongKey]
 
 class MusicDatabase:
+    # databases pickled before index_type existed are PAT-tree databases
+    index_type = 'pattree'
+    suffix_array = None
+    # databases pickled before source_files existed can not be updated
+    source_files = None
+    # q of the q-gram index, 0 if there is none
+    qgram = 0
+    qgram_index = None
+    result_cache = None
+    # 'tonic' or 'interval' if there is a RelativeChordIndex
+    relative_chords = None
+    folksong_relative_chord_seq = None
+    relative_index = None
+    # databases pickled before bar profiles were stored can not detect again with with_params
+    folksong_bar_profiles = None
+    folksong_relative_bar_profiles = None
+
     def __init__(self,
-            Folksong_list: List[Folksong],
+            Folksong_list: Iterable[Folksong],
             alpha: float = 0.3,
             beta: float = 1.0,
             tau: float = 12,
-            old_chord_detection = False) -> None:
-        self.folksongs = {
-            f.key: f
-            for f in Folksong_list
-        }
-        # check that key is unique
-        if len(self.folksongs) != len(Folksong_list):
-            sigs = set()
-            for f in Folksong_list:
-                if f.key not in sigs:
-                    sigs.add(f.key)
-                else:
-                    raise AssertionError(f'{f.key} repeated at {f}')
+            old_chord_detection = False,
+            index_type: str = 'pattree',
+            jobs: int = 1,
+            qgram: int = 0,
+            relative_chords: Optional[str] = None) -> None:
+        """
+            Folksong_list:
+                the folksongs, which can be a generator: they are detected and stored a chunk
+                at a time, and their parsed melodies are not kept, so the whole dataset is
+                never held at once. A repeated key raises AssertionError.
+            index_type:
+                'pattree'      - the PAT-tree, which can be inserted into
+                'suffix_array' - a static suffix array, faster to build and smaller in memory
+            jobs:
+                number of worker processes detecting chords, 1 to detect in this process
+            qgram:
+                q of a chord q-gram index built alongside, for use_qgram searches. 0 for none.
+            relative_chords:
+                'tonic' or 'interval' to build a RelativeChordIndex alongside, for
+                transposition_invariant searches. See relative_index.py. None for none.
+        """
+        assert index_type in INDEX_TYPES, f'unknown index type: {index_type}'
+        assert relative_chords is None or relative_chords in RELATIVE_CHORDS, f'unknown relative chords: {relative_chords}'
+        assert qgram >= 0, f'q of the q-gram index must not be negative: {qgram}'
         self.folksong_music_key: Mapping[FolksongKey, int] = dict()
-        self.folksong_chrod_seq: Mapping[FolksongKey, List[Chord]] = dict()
+        self.folksong_chrod_seq: Mapping[FolksongKey, ChordSeq] = dict()
+        # None for the old chord detection
+        self.folksong_bar_profiles: Optional[Mapping[FolksongKey, BarProfiles]] = None if old_chord_detection else dict()
         self.alpha = alpha
         self.beta = beta
         self.tau = tau
         self.old_chord_detection = old_chord_detection
-        self.pat_tree = PATTree()
-        for s, f in tqdm(self.folksongs.items(), desc='Creating PAT-tree...'):
-            music_key = normalized_note_seq_to_music_key(f.melody, f.tonic)
-            self.folksong_music_key[f.key] = music_key
-            if old_chord_detection:
-                detected_chord_seq = old_normalized_note_seq_to_chrod_seq(
-                    f.melody, f.tonic, f.metre
-                )
-            else:
-                detected_chord_seq = normalized_note_seq_to_chrod_seq(
-                    f.melody, f.tonic, f.metre, alpha, beta, tau
+        self.index_type = index_type
+        self.qgram = qgram
+        self.relative_chords = relative_chords
+        if relative_chords is not None:
+            self.folksong_relative_chord_seq: Mapping[FolksongKey, ChordSeq] = dict()
+            if not old_chord_detection:
+                self.folksong_relative_bar_profiles: Mapping[FolksongKey, BarProfiles] = dict()
+        self.pat_tree = PATTree() if index_type == 'pattree' else None
+        self.source_files: Mapping[str, SourceFile] = dict()
+        self.result_cache = ResultCache()
+        self.folksongs = FolksongStore()
+        desc = 'Creating PAT-tree...' if self.pat_tree is not None else 'Detecting chords...'
+        self.detect_and_index(Folksong_list, jobs, desc)
+        self.reindex()
+
+    def detect_and_index(self, folksongs: Iterable[Folksong], jobs: int, desc: str) -> None:
+        """
+            Detect the music keys and chord sequences of folksongs, insert them into the PAT-tree
+            and add the folksongs to the store, reading folksongs a chunk at a time.
+            Does not finalize the PAT-tree or build the suffix array.
+        """
+        # chords are detected a chunk of folksongs at a time so the new detection can be batched
+        folksong_iter = iter(folksongs)
+        # the chunks whose chords are being detected, in order
+        pending_chunks = deque()
+        def chunk_args():
+            while True:
+                chunk = list(islice(folksong_iter, DETECTION_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    return
+                pending_chunks.append(chunk)
+                yield (
+                    [(f.melody, f.tonic, f.metre) for f in chunk],
+                    self.alpha, self.beta, self.tau, self.old_chord_detection,
+                    self.relative_chords is not None
                 )
-                # print(chord_seq_to_str(detected_chord_seq))
-            self.folksong_chrod_seq[f.key] = detected_chord_seq
-            self.pat_tree.insert(detected_chord_seq, s)
+        total = len(folksongs) if isinstance(folksongs, Sized) else None
+        with tqdm(total=total, desc=desc) as progress_bar:
+            # ordered_map yields in submission order, so keys are inserted exactly as in a serial build
+            for detected in ordered_map(detect_chunk, chunk_args(), jobs):
+                chunk = pending_chunks.popleft()
+                # the store raises on a repeated key, and keeps no parsed melody
+                self.folksongs.extend(chunk)
+                if detected.bar_profiles is not None:
+                    for f, bar_profiles in zip(chunk, detected.bar_profiles):
+                        self.folksong_bar_profiles[f.key] = bar_profiles
+                if detected.relative_chord_seqs is not None:
+                    for f, relative_chord_seq in zip(chunk, detected.relative_chord_seqs):
+                        self.folksong_relative_chord_seq[f.key] = relative_chord_seq
+                if detected.relative_bar_profiles is not None:
+                    for f, bar_profiles in zip(chunk, detected.relative_bar_profiles):
+                        self.folksong_relative_bar_profiles[f.key] = bar_profiles
+                for f, music_key, detected_chord_seq in zip(chunk, detected.music_keys, detected.chord_seqs):
+                    self.folksong_music_key[f.key] = music_key
+                    # print(chord_seq_to_str(detected_chord_seq))
+                    self.folksong_chrod_seq[f.key] = detected_chord_seq
+                if self.pat_tree is not None:
+                    with profiling.stage('tree_insert'):
+                        for f, detected_chord_seq in zip(chunk, detected.chord_seqs):
+                            self.pat_tree.insert(detected_chord_seq, f.key)
+                progress_bar.update(len(chunk))
+
+    def add_folksongs(self, Folksong_list: List[Folksong], jobs: int = 1, reindex: bool = True) -> None:
+        """
+            Detect and index new folksongs. Their keys must not be in the database.
+            The suffix array is static, so it is rebuilt from the stored chord sequences.
+            Pass reindex=False when more changes follow, and call reindex after the last one.
+        """
+        self.get_result_cache().clear()
+        new_folksongs = dict()
+        for f in Folksong_list:
+            if f.key in self.folksongs or f.key in new_folksongs:
+                raise AssertionError(f'{f.key} repeated at {f}')
+            new_folksongs[f.key] = f
+        desc = 'Adding to PAT-tree...' if self.pat_tree is not None else 'Detecting chords...'
+        self.detect_and_index(list(new_folksongs.values()), jobs, desc)
+        if reindex:
+            self.reindex()
+
+    def remove_folksongs(self, keys: List[FolksongKey], reindex: bool = True) -> None:
+        """
+            Remove folksongs by key. Raise KeyError if a key is not in the database.
+        """
+        self.get_result_cache().clear()
+        for k in keys:
+            chord_seq = self.folksong_chrod_seq[k]
+            if self.pat_tree is not None:
+                self.pat_tree.delete(chord_seq, k)
+            del self.folksong_music_key[k]
+            del self.folksong_chrod_seq[k]
+            if self.folksong_bar_profiles is not None:
+                del self.folksong_bar_profiles[k]
+            if self.relative_chords is not None:
+                del self.folksong_relative_chord_seq[k]
+            if self.folksong_relative_bar_profiles is not None:
+                del self.folksong_relative_bar_profiles[k]
+        self.folksongs.remove(keys)
+        if reindex:
+            self.reindex()
+
+    def reindex(self) -> None:
+        """
+            Make the index searchable after the chord sequences changed
+        """
+        self.get_result_cache().clear()
+        with profiling.stage('index_build'):
+            if self.pat_tree is not None:
+                self.pat_tree.finalize()
+            if self.index_type == 'suffix_array':
+                self.suffix_array = SuffixArrayIndex(self.folksong_chrod_seq)
+            if self.qgram > 0:
+                self.qgram_index = QGramIndex(self.folksong_chrod_seq, self.qgram)
+            if self.relative_chords is not None:
+                self.relative_index = RelativeChordIndex(self.folksong_relative_chord_seq, self.relative_chords)
 
     def __len__(self):
         return len(self.folksongs)
 
+    def with_params(self, alpha: float, beta: float, tau: float) -> 'MusicDatabase':
+        """
+            A database of the same folksongs with chords detected with alpha, beta and tau.
+            The chords are scored from the stored bar profiles, so no melody is parsed or profiled again,
+            and the database is the same as one built from the dataset with alpha, beta and tau.
+        """
+        if self.old_chord_detection:
+            raise ValueError('the old chord detection does not use alpha, beta and tau')
+        if self.folksong_bar_profiles is None or (
+                self.relative_chords is not None and self.folksong_relative_bar_profiles is None):
+            raise ValueError('the database was made before bar profiles were stored, build it from the dataset')
+        md = copy.copy(self)
+        md.alpha = alpha
+        md.beta = beta
+        md.tau = tau
+        md.folksongs = self.folksongs.copy()
+        md.folksong_music_key = dict(self.folksong_music_key)
+        md.folksong_bar_profiles = dict(self.folksong_bar_profiles)
+        if self.source_files is not None:
+            md.source_files = dict(self.source_files)
+        md.result_cache = ResultCache()
+        config = get_detector_config(alpha, beta, tau)
+
+        md.folksong_chrod_seq = dict()
+        md.pat_tree = PATTree() if self.pat_tree is not None else None
+        keys = list(self.folksong_chrod_seq.keys())
+        desc = 'Creating PAT-tree...' if md.pat_tree is not None else 'Detecting chords...'
+        for chunk_begin in tqdm(range(0, len(keys), DETECTION_CHUNK_SIZE), desc=desc):
+            chunk = keys[chunk_begin:chunk_begin+DETECTION_CHUNK_SIZE]
+            chord_seqs = bar_profiles_to_chrod_seqs([md.folksong_bar_profiles[k] for k in chunk], config)
+            for k, chord_seq in zip(chunk, chord_seqs):
+                md.folksong_chrod_seq[k] = chord_seq
+                if md.pat_tree is not None:
+                    md.pat_tree.insert(chord_seq, k)
+
+        if self.relative_chords is not None:
+            md.folksong_relative_bar_profiles = dict(self.folksong_relative_bar_profiles)
+            md.folksong_relative_chord_seq = dict()
+            keys = list(self.folksong_relative_chord_seq.keys())
+            for chunk_begin in range(0, len(keys), DETECTION_CHUNK_SIZE):
+                chunk = keys[chunk_begin:chunk_begin+DETECTION_CHUNK_SIZE]
+                chord_seqs = bar_profiles_to_chrod_seqs([md.folksong_relative_bar_profiles[k] for k in chunk], config)
+                md.folksong_relative_chord_seq.update(zip(chunk, chord_seqs))
+        md.reindex()
+        return md
+
+    def get_qgram_index(self) -> QGramIndex:
+        if self.qgram_index is None:
+            raise ValueError('the database has no q-gram index, build it with qgram > 0')
+        return self.qgram_index
+
+    def get_relative_index(self) -> RelativeChordIndex:
+        if self.relative_index is None:
+            raise ValueError('the database has no relative chord index, build it with relative_chords')
+        return self.relative_index
+
+    def searched_index(self, use_qgram: bool, transposition_invariant: bool) -> str:
+        if use_qgram and transposition_invariant:
+            raise ValueError('the q-gram index is not transposition invariant')
+        if transposition_invariant:
+            return 'relative'
+        if use_qgram:
+            return 'qgram'
+        return self.index_type
+
+    def get_result_cache(self) -> ResultCache:
+        # databases pickled before the cache existed get one on first use
+        if self.result_cache is None:
+            self.result_cache = ResultCache()
+        return self.result_cache
+
+    def result_cache_info(self) -> CacheInfo:
+        """
+            Hits and misses of the cached search results, since the database was loaded
+        """
+        return self.get_result_cache().info()
+
     def search_by_abs_note_seq(
             self,
-            q_abs_note_seq: List[MusicNote],
+            q_abs_note_seq: NoteSeqLike,
             metre: Metre,
             alpha: float = None,
             beta: float = None,
-            tau: float = None) -> Set[FolksongKey]:
+            tau: float = None,
+            use_qgram: bool = False,
+            transposition_invariant: bool = False) -> Set[FolksongKey]:
+        """
+            use_qgram: search the q-gram index instead of the PAT-tree or suffix array
+            transposition_invariant: search the chords relative to the query's tonic in the relative chord index,
+                so that the query may be in any key
+            The result is cached and shared with later searches of the same chord sequence,
+            so it should not be modified.
+        """
         alpha = self.alpha if alpha is None else alpha
         beta = self.beta if beta is None else beta
         tau = self.tau if tau is None else tau
-        if self.old_chord_detection:
-            chord_seq = old_abs_note_seq_to_chrod_seq(
-                q_abs_note_seq, metre
-            )
-        else:
-            chord_seq = abs_note_seq_to_chrod_seq(
-                q_abs_note_seq, metre, alpha, beta, tau
-            )
+        searched_index = self.searched_index(use_qgram, transposition_invariant)
+        if transposition_invariant:
+            q_abs_note_seq = to_relative_query(q_abs_note_seq)
+        chord_seq = detect_query_chord_seq(q_abs_note_seq, metre, self.old_chord_detection, alpha, beta, tau)
         # print('search_by_abs_note_seq: dected chord:', chord_seq_to_str(chord_seq))
-        retrieved_signatures = self.pat_tree.search(chord_seq)
+        cache = self.get_result_cache()
+        cache_key = ('exact', searched_index, chord_seq, alpha, beta, tau, self.old_chord_detection)
+        retrieved_signatures = cache.get(cache_key)
+        if retrieved_signatures is not None:
+            return retrieved_signatures
+        with profiling.stage('index_search'):
+            if transposition_invariant:
+                retrieved_signatures = self.get_relative_index().search(chord_seq)
+            elif use_qgram:
+                retrieved_signatures = self.get_qgram_index().search(chord_seq)
+            elif self.index_type == 'suffix_array':
+                retrieved_signatures = self.suffix_array.search(chord_seq)
+            else:
+                retrieved_signatures = self.pat_tree.search(chord_seq)
+        cache.put(cache_key, retrieved_signatures)
         return retrieved_signatures
 
+    def search_by_abs_note_seq_approximate(
+            self,
+            q_abs_note_seq: NoteSeqLike,
+            metre: Metre,
+            max_edits: int,
+            top_n: Optional[int] = 10,
+            node_budget: Optional[int] = DEFAULT_NODE_BUDGET,
+            alpha: float = None,
+            beta: float = None,
+            tau: float = None,
+            use_qgram: bool = False) -> List[Tuple[FolksongKey, int]]:
+        """
+            (key, edit cost) of the top_n folksongs whose chord sequences contain the query's
+            with at most max_edits chord edits, sorted by cost.
+            At most node_budget positions of the index are visited, None for no limit.
+            use_qgram: filter candidates with the q-gram index and verify them instead,
+                which has no node budget and is faster for long queries and small max_edits
+        """
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        tau = self.tau if tau is None else tau
+        chord_seq = detect_query_chord_seq(q_abs_note_seq, metre, self.old_chord_detection, alpha, beta, tau)
+        cache = self.get_result_cache()
+        cache_key = (
+            'approximate', self.searched_index(use_qgram, False), chord_seq, alpha, beta, tau, self.old_chord_detection,
+            max_edits, top_n, None if use_qgram else node_budget
+        )
+        ranked = cache.get(cache_key)
+        if ranked is None:
+            with profiling.stage('approximate_search'):
+                if use_qgram:
+                    ranked = self.get_qgram_index().search_approximate(chord_seq, max_edits, top_n)
+                elif self.index_type == 'suffix_array':
+                    ranked = self.suffix_array.search_approximate(chord_seq, max_edits, top_n, node_budget)
+                else:
+                    ranked = self.pat_tree.search_approximate(chord_seq, max_edits, top_n, node_budget)
+            cache.put(cache_key, ranked)
+        return list(ranked)
+
+    def search_many(
+            self,
+            queries: List[Tuple[NoteSeqLike, Metre]],
+            alpha: float = None,
+            beta: float = None,
+            tau: float = None,
+            use_qgram: bool = False,
+            transposition_invariant: bool = False) -> List[Set[FolksongKey]]:
+        """
+            search_by_abs_note_seq of many (abs_note_seq, metre) queries.
+            The chords of all queries are detected in one batch, and the distinct chord sequences
+            are searched together. Queries with the same chord sequence share one result set,
+            which should not be modified. Results are cached as in search_by_abs_note_seq.
+        """
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        tau = self.tau if tau is None else tau
+        if transposition_invariant:
+            queries = [(to_relative_query(q_abs_note_seq), metre) for q_abs_note_seq, metre in queries]
+        chord_seqs = detect_query_chord_seqs(queries, self.old_chord_detection, alpha, beta, tau)
+        return self.search_chord_seqs(chord_seqs, alpha, beta, tau, use_qgram, transposition_invariant)
+
+    def search_chord_seqs(
+            self,
+            chord_seqs: List[ChordSeq],
+            alpha: float = None,
+            beta: float = None,
+            tau: float = None,
+            use_qgram: bool = False,
+            transposition_invariant: bool = False) -> List[Set[FolksongKey]]:
+        """
+            The searching half of search_many, for chord sequences that are already detected
+            with alpha, beta and tau, e.g. the ones stored in folksong_chrod_seq.
+            With transposition_invariant, they must be relative to the tonic of their queries.
+        """
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        tau = self.tau if tau is None else tau
+        searched_index = self.searched_index(use_qgram, transposition_invariant)
+        cache = self.get_result_cache()
+        results = dict()
+        missed_chord_seqs = []
+        for chord_seq in dict.fromkeys(chord_seqs):
+            result = cache.get(('exact', searched_index, chord_seq, alpha, beta, tau, self.old_chord_detection))
+            if result is None:
+                missed_chord_seqs.append(chord_seq)
+            else:
+                results[chord_seq] = result
+        with profiling.stage('index_search'):
+            if transposition_invariant:
+                relative_index = self.get_relative_index()
+                missed_results = [relative_index.search(chord_seq) for chord_seq in missed_chord_seqs]
+            elif use_qgram:
+                qgram_index = self.get_qgram_index()
+                missed_results = [qgram_index.search(chord_seq) for chord_seq in missed_chord_seqs]
+            elif self.index_type == 'suffix_array':
+                missed_results = self.suffix_array.search_many(missed_chord_seqs)
+            else:
+                missed_results = self.pat_tree.search_many(missed_chord_seqs)
+        for chord_seq, result in zip(missed_chord_seqs, missed_results):
+            cache.put(('exact', searched_index, chord_seq, alpha, beta, tau, self.old_chord_detection), result)
+            results[chord_seq] = result
+        return [results[chord_seq] for chord_seq in chord_seqs]
+
     def to_dict(self) -> dict:
         return {
-            'folksongs': self.folksongs,
+            'folksongs': dict(self.folksongs),
             'folksong_scale_type': self.folksong_music_key,
             'folksong_chrod_seq': self.folksong_chrod_seq,
             'alpha': self.alpha,
             'beta': self.beta,
             'tau': self.tau,
+            'index_type': self.index_type,
+            'qgram': self.qgram,
+            'relative_chords': self.relative_chords,
+            'folksong_relative_chord_seq': self.folksong_relative_chord_seq,
             'pat_tree': {
                 'head': self.pat_tree.head.to_dict()
-            }
+            } if self.pat_tree is not None else None
         }
@@ -1,7 +1,15 @@
+from array import array
+from functools import lru_cache
 from math import exp
-from typing import List
+from typing import List, NamedTuple, Optional, Sequence
 
-from musical_things import MusicNote, Chord, MusicKey, Metre
+from musical_things import NoteSeq, NoteSeqLike, as_note_seq, ChordSeq, MusicKey, Metre, encode_chord
+
+# numpy is optional: without it the batched detection falls back to the per-song path
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Chord weights
 SINGLE_NOTE_W = [25, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4, -4]
@@ -58,6 +66,20 @@ OLD_CHORD_NOTES = [
 ]
 
 
+# every CHORD_WEIGHTS row rotated to every root, in the order of the chord index
+ROTATED_CHORD_WEIGHTS = [
+    w[-root:] + w[:-root]
+    for w in CHORD_WEIGHTS
+    for root in range(12)
+]
+
+# every SCALE_WEIGHTS row rotated to every tonic, in the order of the key index
+ROTATED_SCALE_WEIGHTS = [
+    w[-tonic:] + w[:-tonic]
+    for w in SCALE_WEIGHTS
+    for tonic in range(12)
+]
+
 LARGE_NEG = float('-inf')
 
 
@@ -82,32 +104,30 @@ def mean(x):
     return sum(x) / len(x)
 
 
-def denormalize_note_seq(note_seq: List[MusicNote], tonic: int):
+def denormalize_note_seq(note_seq: NoteSeqLike, tonic: int) -> NoteSeq:
+    """
+        the note sequence moved to tonic, as a view sharing the arrays of note_seq
+    """
     assert 0 <= tonic < 12
-    normalized_note_seq = [
-        MusicNote(n.start, n.end, n.pitch+tonic)
-        for n in note_seq
-    ]
-    return normalized_note_seq
+    return as_note_seq(note_seq).transposed(tonic)
 
 
-def abs_note_seq_to_music_key(note_seq: List[MusicNote]) -> MusicKey:
+def abs_note_seq_to_music_key(note_seq: NoteSeqLike) -> MusicKey:
+    note_seq = as_note_seq(note_seq)
+    t = note_seq.transposition
     profile = [0] * 12
-    for n in note_seq:
-        note_duration = n.end - n.start
-        pitch_class = n.pitch
+    for start, end, pitch in zip(note_seq.starts, note_seq.ends, note_seq.pitches):
+        note_duration = end - start
+        pitch_class = pitch + t
         if pitch_class < 0:
             pitch_class += (pitch_class // 12) * 12
         pitch_class = pitch_class % 12
         profile[pitch_class] += note_duration
-    key_score = []
-    for scale_type in range(3):
-        w = SCALE_WEIGHTS[scale_type]
-        for tonic in range(12):
-            _w = w[-tonic:] + w[:-tonic]
-            key_score.append(
-                sum([a * b for a, b in zip(profile, _w)])
-            )
+    key_score = [
+        sum([a * b for a, b in zip(profile, _w)])
+        # only the first 3 scale types are detected
+        for _w in ROTATED_SCALE_WEIGHTS[:36]
+    ]
     # print(key_score)
     best_key_index = argmax(key_score)
     best_scale_type, best_tonic = best_key_index//12, best_key_index%12
@@ -115,12 +135,160 @@ def abs_note_seq_to_music_key(note_seq: List[MusicNote]) -> MusicKey:
     return best_key
 
 
+def scale_type_to_chord_scale_prob(scale_type: int, tau: float) -> List[float]:
+    """
+        the probability of every chord to be in the scale, softmaxed with temperature tau
+    """
+    scale_weight = SCALE_WEIGHTS[scale_type]
+    chord_scale_scores = []
+    for chord_index, _w in enumerate(ROTATED_CHORD_WEIGHTS):
+        root = chord_index % 12
+        if root in SCALE_NOTES[scale_type] or len(SCALE_NOTES[scale_type]) == 0:
+            chord_scale_scores.append(
+                sum([a * b for a, b in zip(scale_weight, _w)])
+            )
+        else:
+            chord_scale_scores.append(LARGE_NEG)
+
+    # get top half possible normalized_chord: that is 24 in 48
+    # k = mean(chord_scale_scores)
+    # chord_scale_scores = [
+    #     i - k if i > k else LARGE_NEG
+    #     for i in chord_scale_scores
+    # ]
+    return softmax(chord_scale_scores, temperature=tau)
+
+
+class DetectorConfig:
+    """
+        The tables chord detection needs for one (alpha, beta, tau),
+        so that detecting a song only does the per-bar work.
+        Get a shared one with get_detector_config.
+    """
+    def __init__(self, alpha: float = 0.3, beta: float = 1.0, tau: float = 12) -> None:
+        self.alpha = alpha
+        self.beta = beta
+        self.tau = tau
+        # indexed by scale type
+        self.chord_scale_prob = [
+            scale_type_to_chord_scale_prob(scale_type, tau)
+            for scale_type in range(len(SCALE_WEIGHTS))
+        ]
+        self.chord_scale_prob_alpha = [
+            [csp ** alpha for csp in chord_scale_prob]
+            for chord_scale_prob in self.chord_scale_prob
+        ]
+        if np is not None:
+            self.np_rotated_chord_weights = np.array(ROTATED_CHORD_WEIGHTS, dtype=float)
+            self.np_chord_scale_prob_alpha = np.array(self.chord_scale_prob_alpha)
+
+    def __repr__(self) -> str:
+        return f'DetectorConfig(alpha={self.alpha}, beta={self.beta}, tau={self.tau})'
+
+
+@lru_cache(maxsize=32)
+def get_detector_config(alpha: float = 0.3, beta: float = 1.0, tau: float = 12) -> DetectorConfig:
+    return DetectorConfig(alpha, beta, tau)
+
+
+def notes_profile(note_seq: NoteSeq, overlapped_indices: List[int], window_start: float, window_end: float) -> List[float]:
+    """
+        pitch-class profile in [window_start, window_end) of the overlapped notes,
+        given by their indices in note_seq
+    """
+    starts, ends, pitches, t = note_seq.starts, note_seq.ends, note_seq.pitches, note_seq.transposition
+    profile = [0] * 12
+    for i in overlapped_indices:
+        note_overlap_duration = min(ends[i], window_end) - max(starts[i], window_start)
+        pitch_class = pitches[i] + t
+        if pitch_class < 0:
+            pitch_class += (pitch_class // 12) * 12
+        pitch_class = pitch_class % 12
+        profile[pitch_class] += note_overlap_duration
+    return profile
+
+
+def window_profile(abs_note_seq: NoteSeq, window_start: float, window_end: float) -> Optional[List[float]]:
+    """
+        pitch-class profile of the notes overlapping [window_start, window_end)
+        return None if no note overlaps the window
+    """
+    overlapped_indices = [
+        i
+        for i, (start, end) in enumerate(zip(abs_note_seq.starts, abs_note_seq.ends))
+        if start < window_end and end > window_start
+    ]
+    if len(overlapped_indices) == 0:
+        return None
+    return notes_profile(abs_note_seq, overlapped_indices, window_start, window_end)
+
+
+class WindowSweep:
+    """
+        Find the notes overlapping each window of a note sequence sorted by start,
+        for windows that only move forward.
+        Each note enters and leaves the active list once, so all windows of a sequence
+        cost O(notes + windows) instead of filtering every note for every window.
+        The overlapped notes are given by their indices, in the same order as in the note sequence.
+    """
+    def __init__(self, note_seq: NoteSeq) -> None:
+        self.note_seq = note_seq
+        self.next_index = 0
+        self.active: List[int] = []
+
+    def overlapped_notes(self, window_start: float, window_end: float) -> List[int]:
+        starts = self.note_seq.starts
+        i = self.next_index
+        while i < len(starts) and starts[i] < window_end:
+            self.active.append(i)
+            i += 1
+        self.next_index = i
+        # a note that ended before this window can not overlap later windows
+        ends = self.note_seq.ends
+        self.active = [j for j in self.active if ends[j] > window_start]
+        return self.active
+
+    def profile(self, window_start: float, window_end: float) -> Optional[List[float]]:
+        overlapped_indices = self.overlapped_notes(window_start, window_end)
+        if len(overlapped_indices) == 0:
+            return None
+        return notes_profile(self.note_seq, overlapped_indices, window_start, window_end)
+
+
+def profile_to_chord_index(
+        profile: List[float],
+        scale_type: int,
+        config: DetectorConfig) -> int:
+    """
+        return the index of the best chord in [chord_type * 12 + root for chord_type in range(8)]
+    """
+    chord_window_score = [
+        sum([a * b for a, b in zip(profile, _w)])
+        for _w in ROTATED_CHORD_WEIGHTS
+    ]
+    chord_window_prob = softmax(chord_window_score)
+    # print('---\n', chord_window_prob)
+    beta = config.beta
+    chord_window_scale_prob = [
+        csp_alpha * (cwp ** beta)
+        for csp_alpha, cwp in zip(config.chord_scale_prob_alpha[scale_type], chord_window_prob)
+    ]
+    return argmax(chord_window_scale_prob)
+
+
+def chord_index_to_chord(best_chord_index: int) -> int:
+    best_chord_type, best_root = best_chord_index//12, best_chord_index%12
+    best_chord_type = CHORD_TYPE_MAP[best_chord_type]
+    return encode_chord(best_chord_type, best_root)
+
+
 def abs_note_seq_to_chrod_seq(
-        abs_note_seq: List[MusicNote],
+        abs_note_seq: NoteSeqLike,
         metre: Metre,
         alpha: float = 0.3,
         beta: float = 1.0,
-        tau: float = 12) -> List[Chord]:
+        tau: float = 12,
+        config: Optional[DetectorConfig] = None) -> ChordSeq:
     """
         the abs_note_seq is expect to be sorted
         the returned chords are ABSOLUTIVE
@@ -131,7 +299,10 @@ def abs_note_seq_to_chrod_seq(
 
         tau is the temperature of to use at softmaxing chord_scale_prob.
         we choose to use higher temperature to prevent one chord get all the probability
+
+        if config is given, its alpha, beta and tau are used instead
     """
+    abs_note_seq = as_note_seq(abs_note_seq)
     assert len(abs_note_seq) > 0, 'Empty abs_note_seq'
     assert len(metre) == 2, 'metre is not 2-tuple'
 
@@ -139,30 +310,13 @@ def abs_note_seq_to_chrod_seq(
     # print('detected_scale_type', detected_scale_type)
     # print('detected_tonic', detected_tonic)
 
-    scale_weight = SCALE_WEIGHTS[detected_scale_type]
-    chord_scale_scores = []
-    for w in CHORD_WEIGHTS:
-        for root in range(12):
-            if root in SCALE_NOTES[detected_scale_type] or len(SCALE_NOTES[detected_scale_type]) == 0:
-                _w = w[-root:] + w[:-root]
-                chord_scale_scores.append(
-                    sum([a * b for a, b in zip(scale_weight, _w)])
-                )
-            else:
-                chord_scale_scores.append(LARGE_NEG)
-
-    # get top half possible normalized_chord: that is 24 in 48
-    # k = mean(chord_scale_scores)
-    # chord_scale_scores = [
-    #     i - k if i > k else LARGE_NEG
-    #     for i in chord_scale_scores
-    # ]
-    chord_scale_prob = softmax(chord_scale_scores, temperature=tau)
+    if config is None:
+        config = get_detector_config(alpha, beta, tau)
 
     # print('---')
     # print('\n'.join([
     #     f'{chord_to_str((cid//12), (cid%12)): {csp}'
-    #     for cid, csp, in zip(range(48), chord_scale_prob)
+    #     for cid, csp, in zip(range(48), config.chord_scale_prob[detected_scale_type])
     # ]))
 
     # find chord for each bar
@@ -170,49 +324,22 @@ def abs_note_seq_to_chrod_seq(
     window_end = metre[0] * 4 // metre[1]
     window_step = window_end
 
-    note_seq_end = max(n.end for n in abs_note_seq)
+    note_seq_end = abs_note_seq.end()
 
-    chord_seq: List[Chord] = []
+    chord_seq = bytearray()
 
+    sweep = WindowSweep(abs_note_seq)
     while window_start < note_seq_end:
-        overlapped_notes = [
-            n
-            for n in abs_note_seq
-            if n.start < window_end and n.end > window_start
-        ]
-        if len(overlapped_notes) > 0:
-            profile = [0] * 12
-            for n in overlapped_notes:
-                note_overlap_duration = min(n.end, window_end) - max(n.start, window_start)
-                pitch_class = n.pitch
-                if pitch_class < 0:
-                    pitch_class += (pitch_class // 12) * 12
-                pitch_class = pitch_class % 12
-                profile[pitch_class] += note_overlap_duration
-
+        profile = sweep.profile(window_start, window_end)
+        if profile is not None:
             # if too few notes or no note in this winodw, then ignore
             if sum(profile) < window_step * 0.2:
                 window_start += window_step
                 window_end += window_step
                 continue
 
-            chord_window_score = []
-            for w in CHORD_WEIGHTS:
-                for root in range(12):
-                    _w = w[-root:] + w[:-root]
-                    chord_window_score.append(
-                        sum([a * b for a, b in zip(profile, _w)])
-                    )
-            chord_window_prob = softmax(chord_window_score)
-            # print('---\n', window_start, '\n', chord_window_prob)
-            chord_window_scale_prob = [
-                (csp ** alpha) * (cwp ** beta)
-                for csp, cwp in zip(chord_scale_prob, chord_window_prob)
-            ]
-            best_chord_index = argmax(chord_window_scale_prob)
-            best_chord_type, best_root = best_chord_index//12, best_chord_index%12
-            best_chord_type = CHORD_TYPE_MAP[best_chord_type]
-            best_chord = Chord(best_chord_type, best_root)
+            best_chord_index = profile_to_chord_index(profile, detected_scale_type, config)
+            best_chord = chord_index_to_chord(best_chord_index)
 
             # should we remove repitition?
             # if len(chord_seq) > 0:
@@ -224,22 +351,23 @@ def abs_note_seq_to_chrod_seq(
         window_start += window_step
         window_end += window_step
 
-    return chord_seq
+    return bytes(chord_seq)
 
 
-def normalized_note_seq_to_music_key(normalized_note_seq: List[MusicNote], tonic: int) -> MusicKey:
+def normalized_note_seq_to_music_key(normalized_note_seq: NoteSeqLike, tonic: int) -> MusicKey:
     assert 0 <= tonic < 12
     abs_note_seq = denormalize_note_seq(normalized_note_seq, tonic)
     return abs_note_seq_to_music_key(abs_note_seq)
 
 
 def normalized_note_seq_to_chrod_seq(
-        normalized_note_seq: List[MusicNote],
+        normalized_note_seq: NoteSeqLike,
         tonic: int,
         metre: Metre,
         alpha: float = 0.3,
         beta: float = 1.0,
-        tau: float = 12) -> List[Chord]:
+        tau: float = 12,
+        config: Optional[DetectorConfig] = None) -> ChordSeq:
     """
         the normalized_note_seq is expect to be sorted
         the returned chords are ABSOLUTIVE
@@ -249,11 +377,249 @@ def normalized_note_seq_to_chrod_seq(
     assert 0 <= tonic < 12
 
     abs_note_seq = denormalize_note_seq(normalized_note_seq, tonic)
-    chord_list = abs_note_seq_to_chrod_seq(abs_note_seq, metre, alpha, beta, tau)
+    chord_list = abs_note_seq_to_chrod_seq(abs_note_seq, metre, alpha, beta, tau, config)
     return chord_list
 
 
-def old_abs_note_seq_to_chrod_seq(abs_note_seq: List[MusicNote], metre: Metre):
+# Bars whose two best chord scores, or whose profile sum and the 20% threshold,
+# are closer than this (relatively) are rescored by the pure Python path,
+# because numpy may sum in a different order and round differently.
+BATCH_TIE_TOLERANCE = 1e-9
+
+def abs_note_seqs_to_chrod_seqs(
+        abs_note_seqs: Sequence[NoteSeqLike],
+        metres: Sequence[Metre],
+        alpha: float = 0.3,
+        beta: float = 1.0,
+        tau: float = 12,
+        config: Optional[DetectorConfig] = None) -> List[ChordSeq]:
+    """
+        abs_note_seq_to_chrod_seq over many note sequences at once.
+        The returned chord sequences are the same as calling abs_note_seq_to_chrod_seq on each of them.
+
+        With numpy, the bar profiles of a sequence come from one notes-by-windows overlap matrix,
+        and the bars of all sequences are scored against the 96 rotated chord weights with
+        one matrix multiply, one softmax and one argmax.
+    """
+    assert len(abs_note_seqs) == len(metres)
+    if config is None:
+        config = get_detector_config(alpha, beta, tau)
+    if np is None:
+        return [
+            abs_note_seq_to_chrod_seq(abs_note_seq, metre, config=config)
+            for abs_note_seq, metre in zip(abs_note_seqs, metres)
+        ]
+
+    pitch_class_onehot = np.eye(12)
+
+    # the bars to score, of all sequences
+    bar_profiles = []
+    bar_scale_types = []
+    # for every sequence: a list of (window index, bar row or -1 if the threshold is too close to call)
+    seq_bars = []
+    for abs_note_seq, metre in zip(abs_note_seqs, metres):
+        abs_note_seq = as_note_seq(abs_note_seq)
+        assert len(abs_note_seq) > 0, 'Empty abs_note_seq'
+        assert len(metre) == 2, 'metre is not 2-tuple'
+        scale_type, _ = abs_note_seq_to_music_key(abs_note_seq)
+        window_step = metre[0] * 4 // metre[1]
+        assert window_step > 0, 'metre is shorter than a quarter note'
+        note_seq_end = abs_note_seq.end()
+
+        window_number = max(0, int(np.ceil(note_seq_end / window_step)))
+        while window_number * window_step < note_seq_end:
+            window_number += 1
+        while window_number > 0 and (window_number - 1) * window_step >= note_seq_end:
+            window_number -= 1
+
+        # views of the arrays of the sequence, no note is read one by one
+        starts = np.frombuffer(abs_note_seq.starts, dtype=float)[:, None]
+        ends = np.frombuffer(abs_note_seq.ends, dtype=float)[:, None]
+        pitch_classes = (np.frombuffer(abs_note_seq.pitches, dtype=np.int16) + abs_note_seq.transposition) % 12
+        window_starts = (np.arange(window_number) * window_step)[None, :]
+        window_ends = window_starts + window_step
+
+        # notes-by-windows
+        is_overlapped = (starts < window_ends) & (ends > window_starts)
+        overlap = np.clip(np.minimum(ends, window_ends) - np.maximum(starts, window_starts), 0, None)
+        profiles = overlap.T @ pitch_class_onehot[pitch_classes]
+        profile_sums = profiles.sum(axis=1)
+        threshold = window_step * 0.2
+        threshold_margin = BATCH_TIE_TOLERANCE * max(1.0, threshold)
+
+        bars = []
+        has_note = is_overlapped.any(axis=0)
+        for w in np.flatnonzero(has_note & (profile_sums >= threshold - threshold_margin)):
+            if abs(profile_sums[w] - threshold) <= threshold_margin:
+                bars.append((int(w), -1))
+            else:
+                bars.append((int(w), len(bar_profiles)))
+                bar_profiles.append(profiles[w])
+                bar_scale_types.append(scale_type)
+        seq_bars.append((abs_note_seq, window_step, scale_type, bars))
+
+    best_chord_indices = np.zeros(0, dtype=int)
+    is_tie = np.zeros(0, dtype=bool)
+    if len(bar_profiles) > 0:
+        chord_window_score = np.stack(bar_profiles) @ config.np_rotated_chord_weights.T
+        with np.errstate(over='ignore', invalid='ignore'):
+            e_x = np.exp(chord_window_score)
+            chord_window_prob = e_x / e_x.sum(axis=1, keepdims=True)
+            chord_window_scale_prob = (
+                config.np_chord_scale_prob_alpha[bar_scale_types] * (chord_window_prob ** config.beta)
+            )
+        best_chord_indices = np.argmax(chord_window_scale_prob, axis=1)
+        best = chord_window_scale_prob[np.arange(len(bar_profiles)), best_chord_indices]
+        second_best = np.partition(chord_window_scale_prob, -2, axis=1)[:, -2]
+        is_tie = ~(best - second_best > BATCH_TIE_TOLERANCE * best) | ~np.isfinite(best)
+
+    chord_seqs = []
+    for abs_note_seq, window_step, scale_type, bars in seq_bars:
+        chord_seq = bytearray()
+        for w, row in bars:
+            if row != -1 and not is_tie[row]:
+                chord_seq.append(chord_index_to_chord(int(best_chord_indices[row])))
+                continue
+            # rescore this bar exactly as abs_note_seq_to_chrod_seq does
+            window_start = w * window_step
+            profile = window_profile(abs_note_seq, window_start, window_start + window_step)
+            if profile is None or sum(profile) < window_step * 0.2:
+                continue
+            best_chord_index = profile_to_chord_index(profile, scale_type, config)
+            chord_seq.append(chord_index_to_chord(best_chord_index))
+        chord_seqs.append(bytes(chord_seq))
+    return chord_seqs
+
+
+def normalized_note_seqs_to_chrod_seqs(
+        normalized_note_seqs: Sequence[NoteSeqLike],
+        tonics: Sequence[int],
+        metres: Sequence[Metre],
+        alpha: float = 0.3,
+        beta: float = 1.0,
+        tau: float = 12,
+        config: Optional[DetectorConfig] = None) -> List[ChordSeq]:
+    abs_note_seqs = [
+        denormalize_note_seq(normalized_note_seq, tonic)
+        for normalized_note_seq, tonic in zip(normalized_note_seqs, tonics)
+    ]
+    return abs_note_seqs_to_chrod_seqs(abs_note_seqs, metres, alpha, beta, tau, config)
+
+
+class BarProfiles(NamedTuple):
+    """
+        What chord detection computes of a song before alpha, beta and tau are used:
+        the detected scale type, and the pitch-class profile of every bar that gets a chord,
+        12 values per bar.
+    """
+    scale_type: int
+    profiles: array
+
+    def __len__(self) -> int:
+        return len(self.profiles) // 12
+
+    def bar_profile(self, i: int) -> List[float]:
+        return self.profiles[12*i:12*i+12].tolist()
+
+
+def abs_note_seq_to_bar_profiles(abs_note_seq: NoteSeqLike, metre: Metre) -> BarProfiles:
+    """
+        The bars of abs_note_seq_to_chrod_seq, profiled exactly as it does
+    """
+    abs_note_seq = as_note_seq(abs_note_seq)
+    assert len(abs_note_seq) > 0, 'Empty abs_note_seq'
+    assert len(metre) == 2, 'metre is not 2-tuple'
+
+    detected_scale_type, _ = abs_note_seq_to_music_key(abs_note_seq)
+
+    window_start = 0
+    window_end = metre[0] * 4 // metre[1]
+    window_step = window_end
+
+    note_seq_end = abs_note_seq.end()
+
+    profiles = array('d')
+
+    sweep = WindowSweep(abs_note_seq)
+    while window_start < note_seq_end:
+        profile = sweep.profile(window_start, window_end)
+        # if too few notes or no note in this winodw, then ignore
+        if profile is not None and sum(profile) >= window_step * 0.2:
+            profiles.extend(profile)
+        window_start += window_step
+        window_end += window_step
+
+    return BarProfiles(detected_scale_type, profiles)
+
+
+def bar_profiles_to_chrod_seqs(
+        bar_profiles_list: Sequence[BarProfiles],
+        config: DetectorConfig) -> List[ChordSeq]:
+    """
+        The chord sequences of the songs whose bars are profiled, the same as abs_note_seq_to_chrod_seq
+        with config. Only the scoring is done, so detecting again with other alpha, beta and tau
+        does not need the melodies.
+
+        With numpy, the bars of all songs are scored with one matrix multiply like abs_note_seqs_to_chrod_seqs,
+        and the bars whose two best chords are too close to call are rescored by the pure Python path.
+    """
+    if np is None:
+        return [
+            bytes(
+                chord_index_to_chord(profile_to_chord_index(bar_profiles.bar_profile(i), bar_profiles.scale_type, config))
+                for i in range(len(bar_profiles))
+            )
+            for bar_profiles in bar_profiles_list
+        ]
+
+    bar_number = sum(len(bar_profiles) for bar_profiles in bar_profiles_list)
+    if bar_number == 0:
+        return [b'' for _ in bar_profiles_list]
+    profiles = np.frombuffer(
+        b''.join(bar_profiles.profiles.tobytes() for bar_profiles in bar_profiles_list),
+        dtype=float
+    ).reshape(bar_number, 12)
+    bar_scale_types = np.repeat(
+        [bar_profiles.scale_type for bar_profiles in bar_profiles_list],
+        [len(bar_profiles) for bar_profiles in bar_profiles_list]
+    )
+    chord_window_score = profiles @ config.np_rotated_chord_weights.T
+    with np.errstate(over='ignore', invalid='ignore'):
+        e_x = np.exp(chord_window_score)
+        chord_window_prob = e_x / e_x.sum(axis=1, keepdims=True)
+        chord_window_scale_prob = (
+            config.np_chord_scale_prob_alpha[bar_scale_types] * (chord_window_prob ** config.beta)
+        )
+    best_chord_indices = np.argmax(chord_window_scale_prob, axis=1)
+    best = chord_window_scale_prob[np.arange(bar_number), best_chord_indices]
+    second_best = np.partition(chord_window_scale_prob, -2, axis=1)[:, -2]
+    is_tie = ~(best - second_best > BATCH_TIE_TOLERANCE * best) | ~np.isfinite(best)
+
+    best_chord_indices = best_chord_indices.tolist()
+    is_tie = is_tie.tolist()
+    # many bars too close to call have the same profile, e.g. one whole note
+    rescored = dict()
+    chord_seqs = []
+    row = 0
+    for bar_profiles in bar_profiles_list:
+        chord_seq = bytearray()
+        for i in range(len(bar_profiles)):
+            if is_tie[row]:
+                rescored_key = (bar_profiles.scale_type, bar_profiles.profiles[12*i:12*i+12].tobytes())
+                best_chord_index = rescored.get(rescored_key)
+                if best_chord_index is None:
+                    best_chord_index = profile_to_chord_index(bar_profiles.bar_profile(i), bar_profiles.scale_type, config)
+                    rescored[rescored_key] = best_chord_index
+            else:
+                best_chord_index = best_chord_indices[row]
+            chord_seq.append(chord_index_to_chord(best_chord_index))
+            row += 1
+        chord_seqs.append(bytes(chord_seq))
+    return chord_seqs
+
+
+def old_abs_note_seq_to_chrod_seq(abs_note_seq: NoteSeqLike, metre: Metre) -> ChordSeq:
+    abs_note_seq = as_note_seq(abs_note_seq)
 
     detected_scale_type, detected_tonic = abs_note_seq_to_music_key(abs_note_seq)
     if detected_scale_type > 0:
@@ -261,39 +627,26 @@ def old_abs_note_seq_to_chrod_seq(abs_note_seq: List[MusicNote], metre: Metre):
         if detected_tonic > 12:
             detected_tonic -= 12
 
-    tonal_norm_note_seq = [
-        MusicNote(n.start, n.end, n.pitch-detected_tonic)
-        for n in abs_note_seq
-    ]
+    tonal_norm_note_seq = abs_note_seq.transposed(-detected_tonic)
 
     window_step = metre[0] * 4 // metre[1]
     window_start = -window_step
     window_end = 0
 
-    note_seq_end = max(n.end for n in abs_note_seq)
+    note_seq_end = abs_note_seq.end()
 
-    chord_seq: List[Chord] = []
+    chord_seq = bytearray()
 
+    sweep = WindowSweep(tonal_norm_note_seq)
     while window_start < note_seq_end:
         window_start += window_step
         window_end += window_step
 
-        overlapped_notes = [
-            n
-            for n in tonal_norm_note_seq
-            if n.start < window_end and n.end > window_start
-        ]
+        overlapped_indices = sweep.overlapped_notes(window_start, window_end)
         candidate_list = [(a, b) for a in range(4) for b in range(12)]
 
-        if len(overlapped_notes) > 0:
-            profile = [0] * 12
-            for n in overlapped_notes:
-                note_overlap_duration = min(n.end, window_end) - max(n.start, window_start)
-                pitch_class = n.pitch
-                if pitch_class < 0:
-                    pitch_class += (pitch_class // 12) * 12
-                pitch_class = pitch_class % 12
-                profile[pitch_class] += note_overlap_duration
+        if len(overlapped_indices) > 0:
+            profile = notes_profile(tonal_norm_note_seq, overlapped_indices, window_start, window_end)
 
             # step 1
             for _ in range(12):
@@ -308,7 +661,7 @@ def old_abs_note_seq_to_chrod_seq(abs_note_seq: List[MusicNote], metre: Metre):
                 temp_profile[max_freq_note] = 0
 
             if len(candidate_list) == 1:
-                chord_seq.append(Chord(candidate_list[0][0], candidate_list[0][1]))
+                chord_seq.append(encode_chord(candidate_list[0][0], candidate_list[0][1]))
                 continue
 
             # step 2
@@ -317,7 +670,7 @@ def old_abs_note_seq_to_chrod_seq(abs_note_seq: List[MusicNote], metre: Metre):
             candidate_list = [c for c in candidate_list if c[0] == min_chord_type]
 
             if len(candidate_list) == 1:
-                chord_seq.append(Chord(candidate_list[0][0], candidate_list[0][1]))
+                chord_seq.append(encode_chord(candidate_list[0][0], candidate_list[0][1]))
                 continue
 
             # step 3
@@ -331,7 +684,7 @@ def old_abs_note_seq_to_chrod_seq(abs_note_seq: List[MusicNote], metre: Metre):
             candidate_list = [c for c in candidate_list if c[1] == max_freq_root]
 
             if len(candidate_list) == 1:
-                chord_seq.append(Chord(candidate_list[0][0], candidate_list[0][1]))
+                chord_seq.append(encode_chord(candidate_list[0][0], candidate_list[0][1]))
                 continue
 
             # step 4
@@ -345,7 +698,7 @@ def old_abs_note_seq_to_chrod_seq(abs_note_seq: List[MusicNote], metre: Metre):
             candidate_list = [c for c in candidate_list if (c[1]+7)%12 == max_freq_fifth]
 
             if len(candidate_list) == 1:
-                chord_seq.append(Chord(candidate_list[0][0], candidate_list[0][1]))
+                chord_seq.append(encode_chord(candidate_list[0][0], candidate_list[0][1]))
                 continue
 
             # step 5
@@ -363,15 +716,15 @@ def old_abs_note_seq_to_chrod_seq(abs_note_seq: List[MusicNote], metre: Metre):
             candidate_list = [c for c in candidate_list if (c[1]+7)%12 == max_freq_third]
 
             if len(candidate_list) == 1:
-                chord_seq.append(Chord(candidate_list[0][0], candidate_list[0][1]))
+                chord_seq.append(encode_chord(candidate_list[0][0], candidate_list[0][1]))
             else:
                 # step 6
                 # Choose the first entry in the candidate_list as the final result
-                chord_seq.append(Chord(candidate_list[0][0], candidate_list[0][1]))
+                chord_seq.append(encode_chord(candidate_list[0][0], candidate_list[0][1]))
     # end while
-    return chord_seq
+    return bytes(chord_seq)
 
-def old_normalized_note_seq_to_chrod_seq(normalized_note_seq: List[MusicNote], tonic: int, metre: Metre):
+def old_normalized_note_seq_to_chrod_seq(normalized_note_seq: NoteSeqLike, tonic: int, metre: Metre) -> ChordSeq:
     assert 0 <= tonic < 12
     abs_note_seq = denormalize_note_seq(normalized_note_seq, tonic)
     return old_abs_note_seq_to_chrod_seq(abs_note_seq, metre)
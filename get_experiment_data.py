@@ -1,18 +1,29 @@
 from argparse import ArgumentParser, Namespace
-import pickle
-from typing import List
+from math import ceil
+from time import perf_counter
+from typing import Callable, List, NamedTuple, Optional, Set, Tuple, TypeVar, Union
 import random
 
 from tqdm import tqdm
 
-from database import MusicDatabase
+from approximate_search import DEFAULT_NODE_BUDGET, non_negative_int, positive_int
+from database import MusicDatabase, FolksongKey, ordered_map
 from detector import denormalize_note_seq
-from musical_things import MusicNote
+from mapped_index import MappedMusicIndex, load_database
+from musical_things import MusicNote, Metre, NoteSeq, NoteSeqLike
 from jianpu import (
     jianpu_to_note_seq, JIANPU_PREFIXES, JIANPU_NOTES, JIANPU_SUFFIXES
 )
+import profiling
+
+# number of sampled songs whose queries are sent to a worker at once
+QUERY_BATCH_SIZE = 256
 
 JIANPU_EDITABLES = JIANPU_PREFIXES.union(JIANPU_NOTES).union(JIANPU_SUFFIXES).difference(['^', 'x'])
+# in a fixed order, so that a seeded edit picks the same character in every run
+JIANPU_EDITABLE_CHARS = sorted(JIANPU_EDITABLES)
+
+R = TypeVar('R')
 
 def read_args() -> Namespace:
     parser = ArgumentParser()
@@ -28,8 +39,11 @@ def read_args() -> Namespace:
     )
     parser.add_argument(
         '--corrupt-number', '-c',
+        dest='corrupt_numbers',
         type=int,
-        default=1
+        nargs='+',
+        default=[1],
+        help='Numbers of corruptions of every query, each evaluated on the same songs. 0 measures the precision of the complete melodies'
     )
     parser.add_argument(
         '--no-deletion',
@@ -43,13 +57,66 @@ def read_args() -> Namespace:
         '-t',
         action='store_true'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes the queries are spread over'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed of the random songs and corruptions. Every query has its own generator seeded from it, \
+              so the results do not depend on -j'
+    )
+    parser.add_argument(
+        '-k', '--max-edits',
+        type=non_negative_int,
+        default=None,
+        help='Search approximately, allowing up to k chord substitutions, insertions or deletions'
+    )
+    parser.add_argument(
+        '--top',
+        type=positive_int,
+        default=10,
+        help='Number of best approximate results, a corrupted query hits if its song is among them'
+    )
+    parser.add_argument(
+        '--node-budget',
+        type=non_negative_int,
+        default=DEFAULT_NODE_BUDGET,
+        help='Positions of the index an approximate search may visit, 0 for no limit'
+    )
+    parser.add_argument(
+        '--qgram',
+        dest='use_qgram',
+        action='store_true',
+        help='Search with the q-gram index of a database made with --qgram, exactly or with -k (without a node budget)'
+    )
+    parser.add_argument(
+        '--transposition-invariant',
+        action='store_true',
+        help='Search exactly with the chords relative to the query\'s tonic, \
+              in the relative chord index of a database made with --relative'
+    )
+    parser.add_argument(
+        '--transpose',
+        action='store_true',
+        help='Transpose every corrupted query to a random key'
+    )
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.transposition_invariant and args.max_edits is not None:
+        parser.error('--transposition-invariant searches exactly, without -k')
+    return args
 
 def corrupt_jianpu_str(
         jianpu_str: str,
         corrupt_number: int,
         deletion: bool = True,
-        edition: bool = True) -> str:
+        edition: bool = True,
+        rng: random.Random = random) -> str:
 
     assert deletion or edition, 'deletion and edition can\'t be all False'
 
@@ -58,105 +125,188 @@ def corrupt_jianpu_str(
 
     for _ in range(corrupt_number):
         if deletion and edition:
-            corrupt_method = 'd' if random.randint(0, 1) == 0 else 'e'
+            corrupt_method = 'd' if rng.randint(0, 1) == 0 else 'e'
         elif deletion:
             corrupt_method = 'd'
         elif edition:
             corrupt_method = 'e'
 
         if corrupt_method == 'd':
-            rand_index = random.randint(0, len(corrupted_jianpu_str)-1)
+            rand_index = rng.randint(0, len(corrupted_jianpu_str)-1)
             corrupted_jianpu_str = corrupted_jianpu_str[:rand_index] + corrupted_jianpu_str[rand_index+1:]
         else:
-            rand_index = random.randint(0, len(corrupted_jianpu_str)-1)
+            rand_index = rng.randint(0, len(corrupted_jianpu_str)-1)
             c = corrupted_jianpu_str[rand_index]
 
             assert c in JIANPU_EDITABLES
-            rand_char = random.choice(list(JIANPU_EDITABLES))
+            rand_char = rng.choice(JIANPU_EDITABLE_CHARS)
             corrupted_jianpu_str = corrupted_jianpu_str[:rand_index] + rand_char + corrupted_jianpu_str[rand_index+1:]
     return corrupted_jianpu_str
 
 def corrupt_note_seq(
-        note_seq: List[MusicNote],
+        note_seq: NoteSeqLike,
         corrupt_number: int,
         deletion: bool = True,
-        edition: bool = True) -> List[MusicNote]:
+        edition: bool = True,
+        rng: random.Random = random) -> NoteSeq:
 
     assert deletion or edition, 'deletion and edition can\'t be all False'
 
     corrupt_method = ''
-    corrupted_note_seq = note_seq.copy()
+    corrupted_note_seq = list(note_seq)
 
     for _ in range(corrupt_number):
         if deletion and edition:
-            corrupt_method = 'd' if random.randint(0, 1) == 0 else 'e'
+            corrupt_method = 'd' if rng.randint(0, 1) == 0 else 'e'
         elif deletion:
             corrupt_method = 'd'
         elif edition:
             corrupt_method = 'e'
 
         if corrupt_method == 'd':
-            rand_index = random.randint(0, len(corrupted_note_seq)-1)
+            rand_index = rng.randint(0, len(corrupted_note_seq)-1)
             corrupted_note_seq.pop(rand_index)
         else:
-            rand_index = random.randint(0, len(corrupted_note_seq)-1)
+            rand_index = rng.randint(0, len(corrupted_note_seq)-1)
             pitch_list = [n.pitch for n in corrupted_note_seq]
             max_pitch = max(pitch_list)
             min_pitch = min(pitch_list)
             sigma = (max_pitch - min_pitch) / 2
             rand_index_pitch = pitch_list[rand_index]
-            new_pitch = round(random.gauss(rand_index_pitch, sigma))
-            corrupted_note_seq[rand_index].pitch = new_pitch
+            new_pitch = round(rng.gauss(rand_index_pitch, sigma))
+            # replace the note instead of changing its pitch, a list of notes is shared with the caller
+            old_note = corrupted_note_seq[rand_index]
+            corrupted_note_seq[rand_index] = MusicNote(old_note.start, old_note.end, new_pitch)
 
-    return corrupted_note_seq
+    return NoteSeq.from_notes(corrupted_note_seq)
 
+def query_rng(seed: int, corrupt_number: int, query_index: int) -> random.Random:
+    return random.Random(f'{seed}-{corrupt_number}-{query_index}')
 
-def main():
-    args = read_args()
-    md: MusicDatabase = pickle.load(open(args.dataset_path, 'rb'))
-    if md.old_chord_detection:
-        print('use original chord detection')
-    else:
-        print(md.alpha, md.beta, md.tau)
-    if args.test_number > 0:
-        rand_folksongs = random.choices(list(md.folksongs.values()), k=args.test_number)
+def percentile(sorted_values: List[float], q: float) -> float:
+    """
+        the nearest-rank q-th percentile of sorted_values
+    """
+    rank = max(1, ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank-1]
+
+def latency_str(latencies: List[float]) -> str:
+    if len(latencies) == 0:
+        return 'no query'
+    latencies = sorted(latencies)
+    return ', '.join(
+        [f'p{q} {percentile(latencies, q) * 1e3:.2f} ms' for q in (50, 90, 99)]
+        + [f'max {latencies[-1] * 1e3:.2f} ms']
+    )
+
+
+class ChunkResult(NamedTuple):
+    precisions: List[float]
+    note_seq_hits: List[int]
+    jianpu_hits: List[int]
+    # seconds of every search that missed the result cache, and of every one that hit it
+    latencies: List[float]
+    cached_latencies: List[float]
+    cache_hits: int
+    cache_misses: int
+
+
+# the database searched by evaluate_chunk, set in every worker process by set_worker_database
+worker_md: Optional[Union[MusicDatabase, MappedMusicIndex]] = None
+
+def set_worker_database(md: Union[MusicDatabase, MappedMusicIndex]) -> None:
+    global worker_md
+    worker_md = md
+
+def timed(md: Union[MusicDatabase, MappedMusicIndex], search: Callable[[], R], result: ChunkResult) -> R:
+    """
+        search(), appending its latency to result.cached_latencies if it hit the result cache
+        of md, and to result.latencies otherwise
+    """
+    cache_hits = md.result_cache_info().hits
+    begin_time = perf_counter()
+    retrieved = search()
+    latency = perf_counter() - begin_time
+    if md.result_cache_info().hits > cache_hits:
+        result.cached_latencies.append(latency)
     else:
-        rand_folksongs = list(md.folksongs.values())
+        result.latencies.append(latency)
+    return retrieved
 
-    retrieval_precisions = []
-    note_seq_hits = []
-    jianpu_hits = []
+def timed_search(
+        md: Union[MusicDatabase, MappedMusicIndex],
+        q_abs_note_seq: NoteSeq,
+        metre: Metre,
+        args: Namespace,
+        result: ChunkResult) -> Set[FolksongKey]:
+    """
+        The keys found by searching one query, exactly or approximately, appending its latency to result
+    """
+    if args.max_edits is not None:
+        return {key for key, _ in timed(md, lambda: md.search_by_abs_note_seq_approximate(
+            q_abs_note_seq, metre, args.max_edits, args.top, args.node_budget or None,
+            use_qgram=args.use_qgram
+        ), result)}
+    return timed(md, lambda: md.search_by_abs_note_seq(
+        q_abs_note_seq, metre,
+        use_qgram=args.use_qgram,
+        transposition_invariant=args.transposition_invariant
+    ), result)
 
-    if args.t:
-        rand_folksongs = tqdm(rand_folksongs)
+def evaluate_chunk(task: Tuple[int, int, List[FolksongKey], Namespace]) -> ChunkResult:
+    """
+        Search the queries made from a chunk of the sampled songs with corrupt_number corruptions.
+        The queries are numbered from first_query_index, and each is corrupted with its own
+        seeded generator, so that they are the same in whichever worker they are made.
+        It is a top-level function so that it can be sent to worker processes.
+    """
+    corrupt_number, first_query_index, keys, args = task
+    md = worker_md
+    cache_info = md.result_cache_info()
+    result = ChunkResult([], [], [], [], [], 0, 0)
 
-    if args.corrupt_number == 0:
-        for f in rand_folksongs:
-            note_seq = f.melody
-            abs_note_seq = denormalize_note_seq(note_seq, f.tonic)
-            retrieved_folksongs = md.search_by_abs_note_seq(abs_note_seq, f.metre)
-            assert f.key in retrieved_folksongs, 'Can not find complete melody!?'
-            retrieval_precisions.append(1/len(retrieved_folksongs))
-        print('average precision:', sum(retrieval_precisions) / len(retrieval_precisions))
+    if corrupt_number == 0:
+        for key in keys:
+            if args.max_edits is not None:
+                # approximate searches have no stored chords to start from, detect the melody
+                f = md.folksongs[key]
+                retrieved_folksongs = timed_search(md, denormalize_note_seq(f.melody, f.tonic), f.metre, args, result)
+            else:
+                # the complete melody is detected as the chords stored for its song, search them directly
+                if args.transposition_invariant:
+                    chord_seq = md.folksong_relative_chord_seq[key]
+                else:
+                    chord_seq = md.folksong_chrod_seq[key]
+                (retrieved_folksongs,) = timed(md, lambda: md.search_chord_seqs(
+                    [chord_seq],
+                    use_qgram=args.use_qgram,
+                    transposition_invariant=args.transposition_invariant
+                ), result)
+            assert key in retrieved_folksongs, 'Can not find complete melody!?'
+            result.precisions.append(1/len(retrieved_folksongs))
 
     else:
-        for f in rand_folksongs:
+        for query_index, key in enumerate(keys, first_query_index):
+            rng = query_rng(args.seed, corrupt_number, query_index)
+            f = md.folksongs[key]
             note_seq = f.melody
+            # the melody is normalized, so denormalizing it to another tonic transposes it
+            query_tonic = rng.randrange(12) if args.transpose else f.tonic
             # print('original  chord_seq:', chord_seq_to_str(md.folksong_chrod_seq[f.key]))
             try_count = 0
             while try_count < 100:
                 try:
                     corrupted_note_seq = corrupt_note_seq(
                         note_seq,
-                        args.corrupt_number,
+                        corrupt_number,
                         edition=(not args.no_edition),
-                        deletion=(not args.no_deletion)
+                        deletion=(not args.no_deletion),
+                        rng=rng
                     )
-                    abs_corrupted_note_seq = denormalize_note_seq(corrupted_note_seq, f.tonic)
+                    abs_corrupted_note_seq = denormalize_note_seq(corrupted_note_seq, query_tonic)
                     assert len(abs_corrupted_note_seq) > 0
-                    retrieved_folksongs = md.search_by_abs_note_seq(abs_corrupted_note_seq, f.metre)
-                    # print('# of retrieved_folksongs:', len(retrieved_folksongs))
-                    note_seq_hits.append((1 if f.key in retrieved_folksongs else 0))
+                    retrieved_folksongs = timed_search(md, abs_corrupted_note_seq, f.metre, args, result)
+                    result.note_seq_hits.append(1 if key in retrieved_folksongs else 0)
                     break
                 except (ValueError, AssertionError):
                     try_count += 1
@@ -168,22 +318,83 @@ def main():
                 try:
                     corrupted_jianpu_str = corrupt_jianpu_str(
                         jianpu_str,
-                        args.corrupt_number,
+                        corrupt_number,
                         edition=(not args.no_edition),
-                        deletion=(not args.no_deletion)
+                        deletion=(not args.no_deletion),
+                        rng=rng
                     )
                     # print(corrupted_jianpu_str)
-                    corrupted_jp_str_note_seq = jianpu_to_note_seq(corrupted_jianpu_str, f.time_unit, f.metre)
+                    with profiling.stage('jianpu_decode'):
+                        corrupted_jp_str_note_seq = jianpu_to_note_seq(corrupted_jianpu_str, f.time_unit, f.metre)
                     assert len(corrupted_jp_str_note_seq) > 0
-                    abs_corrupted_jp_str_note_seq = denormalize_note_seq(corrupted_jp_str_note_seq, f.tonic)
-                    retrieved_folksongs = md.search_by_abs_note_seq(abs_corrupted_jp_str_note_seq, f.metre)
-                    jianpu_hits.append((1 if f.key in retrieved_folksongs else 0))
+                    abs_corrupted_jp_str_note_seq = denormalize_note_seq(corrupted_jp_str_note_seq, query_tonic)
+                    retrieved_folksongs = timed_search(md, abs_corrupted_jp_str_note_seq, f.metre, args, result)
+                    result.jianpu_hits.append(1 if key in retrieved_folksongs else 0)
                     break
                 except (ValueError, AssertionError):
                     try_count += 1
 
-        print('note_seq corruption hit rate:', sum(note_seq_hits) / len(note_seq_hits) if len(note_seq_hits) > 0 else 0)
-        print('jianpu corruption hit rate:', sum(jianpu_hits) / len(jianpu_hits) if len(jianpu_hits) > 0 else 0)
+    new_cache_info = md.result_cache_info()
+    return result._replace(
+        cache_hits=new_cache_info.hits - cache_info.hits,
+        cache_misses=new_cache_info.misses - cache_info.misses
+    )
+
+
+def main():
+    args = read_args()
+    with profiling.profiled(args.profile_path, args.cprofile_path):
+        run(args)
+
+def run(args: Namespace) -> None:
+    md = load_database(args.dataset_path)
+    if md.old_chord_detection:
+        print('use original chord detection')
+    else:
+        print(md.alpha, md.beta, md.tau)
+    try:
+        # search nothing, so that an index the database does not have is reported before the queries
+        md.search_chord_seqs([], use_qgram=args.use_qgram, transposition_invariant=args.transposition_invariant)
+    except ValueError as e:
+        raise SystemExit(f'can not search {args.dataset_path}: {e}')
+    keys = list(md.folksongs)
+    if args.test_number > 0:
+        keys = random.Random(args.seed).choices(keys, k=args.test_number)
+
+    tasks = [
+        (corrupt_number, i, keys[i:i+QUERY_BATCH_SIZE], args)
+        for corrupt_number in args.corrupt_numbers
+        for i in range(0, len(keys), QUERY_BATCH_SIZE)
+    ]
+    chunk_results = ordered_map(evaluate_chunk, tasks, args.jobs, set_worker_database, (md,))
+    if args.t:
+        chunk_results = tqdm(chunk_results, total=len(tasks))
+    # the results of every corruption number
+    results = {
+        corrupt_number: ChunkResult([], [], [], [], [], 0, 0)
+        for corrupt_number in args.corrupt_numbers
+    }
+    for (corrupt_number, _, _, _), chunk_result in zip(tasks, chunk_results):
+        result = results[corrupt_number]
+        for merged, chunk_list in zip(result[:5], chunk_result[:5]):
+            merged.extend(chunk_list)
+        results[corrupt_number] = result._replace(
+            cache_hits=result.cache_hits + chunk_result.cache_hits,
+            cache_misses=result.cache_misses + chunk_result.cache_misses
+        )
+
+    for corrupt_number, result in results.items():
+        print(f'c={corrupt_number}')
+        if corrupt_number == 0:
+            print('average precision:', sum(result.precisions) / len(result.precisions))
+        else:
+            note_seq_hits, jianpu_hits = result.note_seq_hits, result.jianpu_hits
+            print('note_seq corruption hit rate:', sum(note_seq_hits) / len(note_seq_hits) if len(note_seq_hits) > 0 else 0)
+            print('jianpu corruption hit rate:', sum(jianpu_hits) / len(jianpu_hits) if len(jianpu_hits) > 0 else 0)
+        # a result cache hit skips the search, so its latency is not mixed with the searched ones
+        print(f'query latency: {latency_str(result.latencies)}')
+        print(f'result cache hit latency: {latency_str(result.cached_latencies)}')
+        print(f'result cache: {result.cache_hits} hits, {result.cache_misses} misses')
 
 
 if __name__ == '__main__':
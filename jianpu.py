@@ -1,6 +1,7 @@
+from array import array
 from typing import List
 
-from musical_things import MusicNote, Metre
+from musical_things import MusicNote, NoteSeq, Metre
 
 JIANPU_NUMBER_TO_PITCH = [-1, 0, 2, 4, 5, 7, 9, 11] # index 0 is rest
 JIANPU_PREFIXES = set(['+', '-'])
@@ -28,7 +29,11 @@ PITCH_TO_JIANPU_NUMBER = [
     ['7b'],
 ]
 
-def jianpu_to_note_seq(melody_str: str, time_unit: int, metre: Metre) -> List[MusicNote]:
+def jianpu_to_note_seq_by_char(melody_str: str, time_unit: int, metre: Metre) -> List[MusicNote]:
+    """
+        The reference parser, one character at a time.
+        It is the one that tells what a jianpu string means, and what is wrong with it.
+    """
     note_seq: List[MusicNote] = []
     measure_number = 1
     octave = 0
@@ -127,5 +132,152 @@ def jianpu_to_note_seq(melody_str: str, time_unit: int, metre: Metre) -> List[Mu
     # end for c in melody_str
     return note_seq
 
+# The scanner looks every character up in JIANPU_CHAR_CODE: a note is its pitch in
+# the octave, anything else a negative code, grouped so that a comparison or two
+# tells its kind in the order of how common they are.
+JIANPU_REST = -1
+JIANPU_TIE = -2
+JIANPU_CLIP = -3
+JIANPU_HALF = -4 # _
+JIANPU_DOT = -5
+JIANPU_SHARP = -6
+JIANPU_FLAT = -7
+JIANPU_UP = -8
+JIANPU_DOWN = -9
+JIANPU_BAR = -10
+JIANPU_TRIPLET_BEGIN = -11
+JIANPU_TRIPLET_END = -12
+
+JIANPU_CHAR_CODE = {
+    '1': 0, '2': 2, '3': 4, '4': 5, '5': 7, '6': 9, '7': 11,
+    '0': JIANPU_REST, '^': JIANPU_TIE, 'x': JIANPU_CLIP,
+    '_': JIANPU_HALF, '.': JIANPU_DOT, '#': JIANPU_SHARP, 'b': JIANPU_FLAT,
+    '+': JIANPU_UP, '-': JIANPU_DOWN,
+    '|': JIANPU_BAR, '(': JIANPU_TRIPLET_BEGIN, ')': JIANPU_TRIPLET_END,
+}
+
+
+class IrregularJianpu(Exception):
+    pass
+
+
+def jianpu_to_note_seq(melody_str: str, time_unit: int, metre: Metre) -> NoteSeq:
+    """
+        The same notes as jianpu_to_note_seq_by_char, as a NoteSeq, by scan_jianpu.
+        Strings it would raise on are parsed by jianpu_to_note_seq_by_char, so that they
+        raise the same errors.
+    """
+    try:
+        return scan_jianpu(melody_str, time_unit, metre)
+    except IrregularJianpu:
+        pass
+    # outside the except block, so that its errors are not chained to IrregularJianpu
+    return NoteSeq.from_notes(jianpu_to_note_seq_by_char(melody_str, time_unit, metre))
+
+
+def scan_jianpu(melody_str: str, time_unit: int, metre: Metre) -> NoteSeq:
+    """
+        jianpu_to_note_seq_by_char with one table lookup per character, writing the notes
+        straight into the arrays of a NoteSeq and shifting an anacrusis in place.
+        Raise IrregularJianpu where it would raise.
+    """
+    starts = array('d')
+    ends = array('d')
+    pitches = array('h')
+    has_note = False
+    char_code = JIANPU_CHAR_CODE
+    is_first_measure = True
+    octave_pitch = 0
+    is_triplet = False
+    is_rest = False
+    duration = 0
+    cur_state = JIANPU_SEPERATOR_STATE
+    cur_time = 0
+    last_note_end = 0
+
+    for c in melody_str:
+        code = char_code.get(c)
+        if code is None:
+            raise IrregularJianpu()
+
+        if code >= 0: # note
+            duration = time_unit * 2 / 3 if is_triplet else time_unit
+            if has_note:
+                last_note_end = ends[-1]
+            starts.append(last_note_end)
+            ends.append(last_note_end+duration)
+            pitches.append(code + octave_pitch)
+            has_note = True
+            cur_time += duration
+            cur_state = JIANPU_NOTE_STATE
+
+        elif code >= JIANPU_CLIP: # rest, tie or clip
+            duration = time_unit * 2 / 3 if is_triplet else time_unit
+            if code == JIANPU_REST:
+                is_rest = True
+            elif code == JIANPU_TIE:
+                if not has_note:
+                    raise IrregularJianpu()
+                ends[-1] += duration
+            cur_time += duration
+            cur_state = JIANPU_NOTE_STATE
+
+        elif code >= JIANPU_FLAT: # suffix
+            if cur_state == JIANPU_PREFFIX_STATE or cur_state == JIANPU_SEPERATOR_STATE:
+                raise IrregularJianpu()
+            octave_pitch = 0
+            if not has_note and (not is_rest or code == JIANPU_SHARP or code == JIANPU_FLAT):
+                raise IrregularJianpu()
+            if code == JIANPU_HALF:
+                cur_time += duration
+                duration *= 2
+                if not is_rest:
+                    ends[-1] = starts[-1] + duration
+            elif code == JIANPU_DOT:
+                cur_time += duration / 2
+                duration += duration / 2
+                if not is_rest:
+                    ends[-1] = starts[-1] + duration
+            elif code == JIANPU_SHARP:
+                pitches[-1] += 1
+            else:
+                pitches[-1] -= 1
+            cur_state = JIANPU_SUFFIX_STATE
+
+        elif code >= JIANPU_DOWN: # prefix
+            is_rest = False
+            duration = 0
+            octave_pitch += 12 if code == JIANPU_UP else -12
+            cur_state = JIANPU_PREFFIX_STATE
+
+        else: # separator
+            if cur_state == JIANPU_PREFFIX_STATE:
+                raise IrregularJianpu()
+            octave_pitch = 0
+            is_rest = False
+            duration = 0
+            if code == JIANPU_BAR:
+                if is_first_measure:
+                    if not has_note:
+                        raise IrregularJianpu()
+                    measure_length = int(metre[0] * 4 / metre[1])
+                    if cur_time != measure_length:
+                        # is anacrusis
+                        right_shift = measure_length - cur_time
+                        for i in range(len(starts)):
+                            starts[i] += right_shift
+                            ends[i] += right_shift
+                    is_first_measure = False
+            elif code == JIANPU_TRIPLET_BEGIN:
+                if is_triplet:
+                    raise IrregularJianpu()
+                is_triplet = True
+            else:
+                if not is_triplet:
+                    raise IrregularJianpu()
+                is_triplet = False
+            cur_state = JIANPU_SEPERATOR_STATE
+    return NoteSeq(starts, ends, pitches)
+
 def note_seq_to_jianpu(note_seq: List[MusicNote], time_unit: int, metre: Metre):
     raise NotImplementedError()
@@ -1,26 +1,36 @@
 from argparse import ArgumentParser, Namespace
+from contextlib import redirect_stdout
 import glob
+from io import StringIO
 import json
+import os
 import pickle
 import random
+from time import perf_counter
 from traceback import format_exc
-from typing import List
+from typing import Iterator, List, Mapping, Optional, Tuple
 
 from tqdm import tqdm
 
-from database import MusicDatabase, Folksong
+from database import MusicDatabase, Folksong, SourceFile, INDEX_TYPES, ordered_map
+from relative_index import RELATIVE_CHORDS
+from mapped_index import is_mapped_index, write_mapped_index
+from parse_cache import ParseCache
 from musical_things import MusicNote, chord_seq_to_str
+import profiling
 
 
 def read_args() -> Namespace:
     parser = ArgumentParser()
     parser.add_argument(
         'dataset_path',
-        type=str
+        type=str,
+        help='Not needed with --from-db'
     )
     parser.add_argument(
         'output_file_path',
         type=str,
+        nargs='?',
         help='The file path for outputed pickle file'
     )
     parser.add_argument(
@@ -43,6 +53,68 @@ def read_args() -> Namespace:
         type=float,
         default=8.0
     )
+    parser.add_argument(
+        '--index',
+        dest='index_type',
+        choices=INDEX_TYPES,
+        default='pattree',
+        help='\'pattree\' - PAT-tree. \
+              \'suffix_array\' - Static suffix array, faster to build and smaller'
+    )
+    parser.add_argument(
+        '--qgram',
+        type=int,
+        default=0,
+        help='Also build an inverted index of chord q-grams with this q, for search.py --qgram. 0 for none'
+    )
+    parser.add_argument(
+        '--relative',
+        dest='relative_chords',
+        choices=RELATIVE_CHORDS,
+        default=None,
+        help='Also build an index of the chords relative to the detected tonic of every song, \
+              for search.py --transposition-invariant. \
+              \'tonic\' - Chord roots relative to the tonic. \
+              \'interval\' - Chord roots relative to the previous root'
+    )
+    parser.add_argument(
+        '--format',
+        dest='output_format',
+        choices=['pickle', 'mapped'],
+        default='pickle',
+        help='\'pickle\' - Pickled MusicDatabase. \
+              \'mapped\' - Memory-mapped index file, which search.py opens without loading the whole database'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes for parsing and chord detection'
+    )
+    parser.add_argument(
+        '--update',
+        dest='update_path',
+        type=str,
+        default=None,
+        help='Update this pickled database with the new, changed and removed files of the dataset \
+              instead of building from scratch. Its -a, -b, -t, --old, --index, --qgram and --relative are kept'
+    )
+    parser.add_argument(
+        '--from-db',
+        dest='from_db_path',
+        type=str,
+        default=None,
+        help='Detect the chords of this pickled database again with -a, -b and -t, \
+              from the bar profiles stored in it instead of parsing the dataset. Its --index, --qgram and --relative are kept'
+    )
+    parser.add_argument(
+        '--parse-cache',
+        dest='parse_cache_dir',
+        type=str,
+        default=None,
+        help='Keep the parsed records of every .sm file in this directory, \
+              and load the files that did not change since from it instead of parsing them again'
+    )
     parser.add_argument(
         '-v',
         dest='verbose',
@@ -52,55 +124,277 @@ def read_args() -> Namespace:
         '--dump-pattree-json',
         action='store_true'
     )
-    return parser.parse_args()
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.from_db_path is not None and args.output_file_path is None:
+        # make_database.py --from-db path/to/database output_file_path
+        args.output_file_path = args.dataset_path
+        args.dataset_path = None
+    if args.output_file_path is None:
+        parser.error('output_file_path is required')
+    return args
 
-def main():
-    args = read_args()
+def iter_sm_records(sm_file_path: str) -> Iterator[Tuple[int, List[str]]]:
+    """
+        The records of one .sm file, delimited by empty lines, read a line at a time.
+        Yield the index of the line after each record and its lines.
+    """
+    # when profiling, the time of reading a record is the time since the last one was yielded
+    profile = profiling.PROFILE
+    record_lines: List[str] = []
+    i = -1
+    begin_time = perf_counter()
+    with open(sm_file_path, 'r', encoding='utf8', errors='ignore') as f:
+        for i, l in enumerate(f):
+            if l == '\n':
+                if len(record_lines) > 0:
+                    if profile is not None:
+                        profile.add_time('file_read', perf_counter() - begin_time)
+                    yield i, record_lines
+                    begin_time = perf_counter()
+                    record_lines = []
+            else:
+                record_lines.append(l)
+    # the last record may not be followed by an empty line
+    if len(record_lines) > 0:
+        if profile is not None:
+            profile.add_time('file_read', perf_counter() - begin_time)
+        yield i + 1, record_lines
+
+def read_sm_file(sm_file_path: str) -> Tuple[List[Folksong], int]:
+    """
+        Parse all records of one .sm file.
+        Return the successfully parsed folksongs and the number of records.
+    """
     folksong_list:List[Folksong] = []
-    all_sm_file_path = glob.glob(f'{args.dataset_path}/**/*.sm', recursive=True)
     total_record = 0
-    for sm_file_path in all_sm_file_path:
-        # print(sm_file_path)
-        with open(sm_file_path, 'r', encoding='utf8', errors='ignore') as f:
-            all_lines = f.readlines()
-            all_lines += ['\n'] # to find last record
-            record_begin_line_index = 0
-            record_end_line_index = 0
-            for i, l in enumerate(all_lines):
-                if l == '\n':
-                    record_end_line_index = i
-                    record_lines = all_lines[record_begin_line_index : record_end_line_index]
-                    if len(record_lines) > 0:
-                        total_record += 1
-                        try:
-                            folksong_list.append(Folksong.from_lines(record_lines))
-                        except NotImplementedError:
-                            pass
-                        except BaseException:
-                            print(f'Exception @ line {i} in {sm_file_path}.')
-                            print(format_exc())
-                    record_begin_line_index = i + 1
-                    record_end_line_index = i + 1
-    print(f'successfully parsed {len(folksong_list)} out of {total_record} records')
+    for i, record_lines in iter_sm_records(sm_file_path):
+        total_record += 1
+        try:
+            with profiling.stage('record_parse'):
+                folksong_list.append(Folksong.from_lines(record_lines))
+        except NotImplementedError:
+            pass
+        except BaseException:
+            print(f'Exception @ line {i} in {sm_file_path}.')
+            print(format_exc())
+    return folksong_list, total_record
+
+def read_sm_file_cached(
+        args: Tuple[str, os.stat_result, Optional[ParseCache]]) -> Tuple[List[Folksong], int, str, bool]:
+    """
+        read_sm_file of (path, stat, parse_cache), or load it from parse_cache if it is cached there,
+        and cache it otherwise. Return what it printed, or printed when it was cached, so that the results
+        of worker processes can be printed in file order, and whether it was loaded from the cache.
+    """
+    sm_file_path, st, parse_cache = args
+    if parse_cache is not None:
+        with profiling.stage('parse_cache_load'):
+            cached = parse_cache.load(sm_file_path, st)
+        if cached is not None:
+            return cached[0], cached[1], cached[2], True
+    output = StringIO()
+    with redirect_stdout(output):
+        folksong_list, total_record = read_sm_file(sm_file_path)
+    if parse_cache is not None:
+        with profiling.stage('parse_cache_store'):
+            parse_cache.store(sm_file_path, st, folksong_list, total_record, output.getvalue())
+    return folksong_list, total_record, output.getvalue(), False
+
+def find_sm_files(dataset_path: str) -> List[str]:
+    return glob.glob(f'{dataset_path}/**/*.sm', recursive=True)
+
+class SourceFileReader:
+    """
+        The folksongs of sm_file_paths, parsed (or loaded from parse_cache) a file at a time
+        as they are iterated, using jobs worker processes if jobs > 1, in file order.
+        Only the files being read are held, so it can be passed to MusicDatabase as is.
+        After iterating, total_record, parsed_number and source_files hold the numbers of records
+        and successfully parsed folksongs, and the size, modification time and keys of every file,
+        keyed by path relative to dataset_path.
+    """
+    def __init__(self,
+            dataset_path: str,
+            sm_file_paths: List[str],
+            jobs: int = 1,
+            parse_cache: Optional[ParseCache] = None) -> None:
+        self.dataset_path = dataset_path
+        self.sm_file_paths = sm_file_paths
+        self.jobs = jobs
+        self.parse_cache = parse_cache
+        self.total_record = 0
+        self.parsed_number = 0
+        self.cached_number = 0
+        self.source_files: Mapping[str, SourceFile] = dict()
+
+    def __iter__(self) -> Iterator[Folksong]:
+        # stat before reading, so that a file changed while it is read is read again by the next update
+        stats = [os.stat(sm_file_path) for sm_file_path in self.sm_file_paths]
+        results = ordered_map(
+            read_sm_file_cached,
+            ((sm_file_path, st, self.parse_cache) for sm_file_path, st in zip(self.sm_file_paths, stats)),
+            self.jobs
+        )
+        for sm_file_path, st, (file_folksong_list, file_total_record, output, cached) in zip(
+                self.sm_file_paths, stats, results):
+            # print(sm_file_path)
+            print(output, end='')
+            self.total_record += file_total_record
+            self.parsed_number += len(file_folksong_list)
+            self.cached_number += cached
+            self.source_files[os.path.relpath(sm_file_path, self.dataset_path)] = SourceFile(
+                st.st_size, st.st_mtime_ns, [f.key for f in file_folksong_list]
+            )
+            yield from file_folksong_list
+        if self.parse_cache is not None:
+            print(f'{self.cached_number} out of {len(self.sm_file_paths)} files loaded from the parse cache')
+
+def read_sm_files(sm_file_paths: List[str], jobs: int = 1) -> List[Tuple[List[Folksong], int]]:
+    """
+        read_sm_file of every path, using jobs worker processes if jobs > 1.
+        Return the results in the order of sm_file_paths.
+    """
+    results = []
+    for folksong_list, total_record, output, _ in ordered_map(
+            read_sm_file_cached,
+            ((sm_file_path, None, None) for sm_file_path in sm_file_paths),
+            jobs):
+        print(output, end='')
+        results.append((folksong_list, total_record))
+    return results
+
+def read_folksongs(dataset_path: str, jobs: int = 1) -> Tuple[List[Folksong], int]:
+    """
+        Parse all records of all .sm files under dataset_path, using jobs worker processes if jobs > 1.
+        Return the successfully parsed folksongs and the number of records.
+    """
+    folksong_list:List[Folksong] = []
+    total_record = 0
+    for file_folksong_list, file_total_record in read_sm_files(find_sm_files(dataset_path), jobs):
+        folksong_list += file_folksong_list
+        total_record += file_total_record
+    return folksong_list, total_record
+
+def read_source_files(
+        dataset_path: str,
+        sm_file_paths: List[str],
+        jobs: int = 1,
+        parse_cache: Optional[ParseCache] = None) -> Tuple[List[Folksong], int, Mapping[str, SourceFile]]:
+    """
+        Parse sm_file_paths and record their size and modification time, keyed by path relative to dataset_path.
+        The files cached in parse_cache are loaded from it instead, and the others are cached after parsing.
+        Return the successfully parsed folksongs, the number of records and the source files.
+    """
+    reader = SourceFileReader(dataset_path, sm_file_paths, jobs, parse_cache)
+    folksong_list = list(reader)
+    return folksong_list, reader.total_record, reader.source_files
+
+def update_database(
+        md: MusicDatabase,
+        dataset_path: str,
+        jobs: int = 1,
+        parse_cache: Optional[ParseCache] = None) -> None:
+    """
+        Re-parse only the files under dataset_path that are new or changed since md was built,
+        and remove the folksongs of changed and deleted files.
+    """
+    sm_file_paths = {
+        os.path.relpath(sm_file_path, dataset_path): sm_file_path
+        for sm_file_path in find_sm_files(dataset_path)
+    }
+    new_paths = []
+    changed_paths = []
+    for rel_path, sm_file_path in sm_file_paths.items():
+        source_file = md.source_files.get(rel_path)
+        if source_file is None:
+            new_paths.append(sm_file_path)
+        else:
+            st = os.stat(sm_file_path)
+            if (st.st_size, st.st_mtime_ns) != (source_file.size, source_file.mtime_ns):
+                changed_paths.append(sm_file_path)
+    removed_rel_paths = [rel_path for rel_path in md.source_files if rel_path not in sm_file_paths]
+    print(f'{len(new_paths)} new, {len(changed_paths)} changed, {len(removed_rel_paths)} removed files')
+
+    stale_rel_paths = removed_rel_paths + [os.path.relpath(p, dataset_path) for p in changed_paths]
+    md.remove_folksongs(
+        [k for rel_path in stale_rel_paths for k in md.source_files[rel_path].keys],
+        reindex=False
+    )
+    for rel_path in stale_rel_paths:
+        del md.source_files[rel_path]
 
-    md = MusicDatabase(
-        folksong_list,
-        old_chord_detection=args.old_chord_detection,
-        alpha=args.a,
-        beta=args.b,
-        tau=args.t
+    folksong_list, total_record, source_files = read_source_files(
+        dataset_path, changed_paths + new_paths, jobs, parse_cache
     )
-    print('PAT-tree number of nodes:', len(md.pat_tree))
+    print(f'successfully parsed {len(folksong_list)} out of {total_record} records')
+    md.add_folksongs(folksong_list, jobs=jobs)
+    md.source_files.update(source_files)
+
+def main():
+    args = read_args()
+    with profiling.profiled(args.profile_path, args.cprofile_path):
+        run(args)
+
+def run(args: Namespace) -> None:
+    parse_cache = None if args.parse_cache_dir is None else ParseCache(args.parse_cache_dir)
+    if args.from_db_path is not None:
+        if is_mapped_index(args.from_db_path):
+            raise SystemExit(f'{args.from_db_path} is a mapped index file, --from-db needs the pickled database')
+        with profiling.stage('pickle_load'):
+            source_md: MusicDatabase = pickle.load(open(args.from_db_path, 'rb'))
+        try:
+            md = source_md.with_params(args.a, args.b, args.t)
+        except ValueError as e:
+            raise SystemExit(f'can not use {args.from_db_path}: {e}')
+        del source_md
+    elif args.update_path is not None:
+        if is_mapped_index(args.update_path):
+            raise SystemExit(f'{args.update_path} is a mapped index file, --update needs the pickled database')
+        with profiling.stage('pickle_load'):
+            md: MusicDatabase = pickle.load(open(args.update_path, 'rb'))
+        if md.source_files is None:
+            raise SystemExit(f'{args.update_path} does not record its source files, rebuild it without --update')
+        # the detection parameters and index type of the existing database are kept
+        update_database(md, args.dataset_path, args.jobs, parse_cache)
+    else:
+        # the folksongs are parsed while they are detected, and not held after
+        reader = SourceFileReader(args.dataset_path, find_sm_files(args.dataset_path), args.jobs, parse_cache)
+        md = MusicDatabase(
+            reader,
+            old_chord_detection=args.old_chord_detection,
+            alpha=args.a,
+            beta=args.b,
+            tau=args.t,
+            index_type=args.index_type,
+            jobs=args.jobs,
+            qgram=args.qgram,
+            relative_chords=args.relative_chords
+        )
+        md.source_files = reader.source_files
+        print(f'successfully parsed {reader.parsed_number} out of {reader.total_record} records')
+    if md.pat_tree is not None:
+        print('PAT-tree number of nodes:', len(md.pat_tree))
+    else:
+        print('Suffix array length:', len(md.suffix_array))
+    if md.qgram_index is not None:
+        print(f'Distinct chord {md.qgram}-grams:', len(md.qgram_index))
+    if md.relative_index is not None:
+        print(f'Relative chord ({md.relative_chords}) suffix array length:', len(md.relative_index))
     if args.verbose:
         for k, f in md.folksongs.items():
             print('-'*8)
             print(f)
             print('Music key:', md.folksong_music_key[k])
             print('Chord sequence:', chord_seq_to_str(md.folksong_chrod_seq[k], is_old=args.old_chord_detection))
-    pickle.dump(md, open(args.output_file_path, 'wb+'), protocol=pickle.HIGHEST_PROTOCOL)
+    if args.output_format == 'mapped':
+        with profiling.stage('mapped_index_write'):
+            write_mapped_index(md, args.output_file_path)
+    else:
+        with profiling.stage('pickle_dump'):
+            pickle.dump(md, open(args.output_file_path, 'wb+'), protocol=pickle.HIGHEST_PROTOCOL)
 
     # dump json of PAT-tree
-    if args.dump_pattree_json:
+    if args.dump_pattree_json and md.pat_tree is not None:
         with open('pat_tree.json', 'w+', encoding='utf8') as f:
             f.write(json.dumps(md.pat_tree.head.to_dict(), default=lambda o: o.__dict__, sort_keys=True, indent=2))
 
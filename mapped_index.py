@@ -0,0 +1,369 @@
+"""
+A binary, memory-mapped index file written from a MusicDatabase.
+
+Opening it only reads a small header: search touches the pages of the
+suffix array it binary searches, and a folksong is unpickled only when it is
+looked up, so the start-up time and memory of one query do not grow with the
+database the way pickle.load does.
+
+Layout (native byte order, every section aligned to 8 bytes):
+
+    MAGIC                  8 bytes
+    header offset          uint64
+    sections               see SECTIONS
+    header                 JSON: detection parameters, byte order and [offset, length] of every section
+
+The suffix structure is the one of SuffixArrayIndex, whichever index the
+database was built with, so the results are the same as the pickled database.
+The q-gram and relative chord indexes are not written.
+Records are numbered in the database's insertion order.
+"""
+
+from array import array
+from collections.abc import Mapping
+import json
+import mmap
+import pickle
+import sys
+from typing import Iterator, List, Optional, Set, Tuple, Union
+
+from approximate_search import DEFAULT_NODE_BUDGET
+from database import MusicDatabase, Folksong, FolksongKey, detect_query_chord_seq, detect_query_chord_seqs
+from musical_things import NoteSeqLike, ChordSeq, MusicKey, Metre
+import profiling
+from result_cache import ResultCache, CacheInfo
+from suffix_array import SuffixArrayIndex, suffix_approximate_search, suffix_range
+
+
+MAGIC = b'MUSICIDX'
+VERSION = 1
+
+SECTIONS = [
+    # the concatenated chord sequences of SuffixArrayIndex
+    'text',
+    # uint32 suffix array, LCP array and record id of each suffix
+    'sa',
+    'lcp',
+    'sa_record',
+    # uint32 offsets (one more than records) into the utf8 keys
+    'key_offsets',
+    'key_blob',
+    # uint32 record ids sorted by key, to look up a key by binary search
+    'sorted_record',
+    # uint32 offsets into the chord sequences of all records
+    'chord_seq_offsets',
+    'chord_seq_blob',
+    # uint8 scale type and tonic of every record
+    'music_key',
+    # uint64 offsets into the pickled folksongs
+    'folksong_offsets',
+    'folksong_blob',
+]
+
+ALIGNMENT = 8
+
+
+def write_mapped_index(md: MusicDatabase, file_path: str) -> None:
+    keys = list(md.folksongs.keys())
+    record_ids = {k: i for i, k in enumerate(keys)}
+    if md.index_type == 'suffix_array':
+        suffix_array = md.suffix_array
+    else:
+        suffix_array = SuffixArrayIndex(md.folksong_chrod_seq)
+    sa_doc_record = [record_ids[k] for k in suffix_array.keys]
+
+    encoded_keys = [k.encode('utf8') for k in keys]
+    key_offsets = array('I', [0])
+    for k in encoded_keys:
+        key_offsets.append(key_offsets[-1] + len(k))
+    chord_seq_offsets = array('I', [0])
+    for k in keys:
+        chord_seq_offsets.append(chord_seq_offsets[-1] + len(md.folksong_chrod_seq[k]))
+    music_key = array('B')
+    for k in keys:
+        music_key.extend(md.folksong_music_key[k])
+    pickled_folksongs = [pickle.dumps(md.folksongs[k], protocol=pickle.HIGHEST_PROTOCOL) for k in keys]
+    folksong_offsets = array('Q', [0])
+    for p in pickled_folksongs:
+        folksong_offsets.append(folksong_offsets[-1] + len(p))
+
+    section_data = {
+        'text': suffix_array.text,
+        'sa': suffix_array.sa.tobytes(),
+        'lcp': suffix_array.lcp.tobytes(),
+        'sa_record': array('I', [sa_doc_record[d] for d in suffix_array.sa_doc]).tobytes(),
+        'key_offsets': key_offsets.tobytes(),
+        'key_blob': b''.join(encoded_keys),
+        'sorted_record': array('I', sorted(range(len(keys)), key=lambda i: encoded_keys[i])).tobytes(),
+        'chord_seq_offsets': chord_seq_offsets.tobytes(),
+        'chord_seq_blob': b''.join(md.folksong_chrod_seq[k] for k in keys),
+        'music_key': music_key.tobytes(),
+        'folksong_offsets': folksong_offsets.tobytes(),
+        'folksong_blob': b''.join(pickled_folksongs),
+    }
+
+    with open(file_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(bytes(8)) # header offset, written at last
+        sections = dict()
+        for name in SECTIONS:
+            f.write(bytes(-f.tell() % ALIGNMENT))
+            sections[name] = [f.tell(), len(section_data[name])]
+            f.write(section_data[name])
+        header = {
+            'version': VERSION,
+            'byteorder': sys.byteorder,
+            'alpha': md.alpha,
+            'beta': md.beta,
+            'tau': md.tau,
+            'old_chord_detection': md.old_chord_detection,
+            'index_type': md.index_type,
+            'record_number': len(keys),
+            'sections': sections
+        }
+        header_offset = f.tell()
+        f.write(json.dumps(header).encode('utf8'))
+        f.seek(len(MAGIC))
+        f.write(array('Q', [header_offset]).tobytes())
+
+
+def is_mapped_index(file_path: str) -> bool:
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class RecordTable(Mapping):
+    """
+        A read-only dict of one attribute of all records, decoded on lookup
+    """
+    def __init__(self, index: 'MappedMusicIndex', get_record) -> None:
+        self.index = index
+        self.get_record = get_record
+
+    def __getitem__(self, key: FolksongKey):
+        record_id = self.index.record_id(key)
+        if record_id is None:
+            raise KeyError(key)
+        return self.get_record(record_id)
+
+    def __iter__(self) -> Iterator[FolksongKey]:
+        return (self.index.key(i) for i in range(len(self.index)))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+class MappedMusicIndex:
+    """
+        Searches like MusicDatabase on a file written by write_mapped_index.
+        folksongs, folksong_chrod_seq and folksong_music_key are read-only mappings.
+    """
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self.mm
+        assert mm[:len(MAGIC)] == MAGIC, f'{file_path} is not a mapped index file'
+        header_offset = array('Q', mm[len(MAGIC):len(MAGIC)+8])[0]
+        header = json.loads(mm[header_offset:])
+        assert header['version'] == VERSION, f'unsupported mapped index version: {header["version"]}'
+        assert header['byteorder'] == sys.byteorder, f'{file_path} was written on a {header["byteorder"]} endian machine'
+        self.alpha = header['alpha']
+        self.beta = header['beta']
+        self.tau = header['tau']
+        self.old_chord_detection = header['old_chord_detection']
+        self.index_type = header['index_type']
+        self.record_number = header['record_number']
+        self.sections = header['sections']
+
+        self.text_offset = self.sections['text'][0]
+        self.sa = self.section_view('sa', 'I')
+        self.lcp = self.section_view('lcp', 'I')
+        self.sa_record = self.section_view('sa_record', 'I')
+        self.key_offsets = self.section_view('key_offsets', 'I')
+        self.sorted_record = self.section_view('sorted_record', 'I')
+        self.chord_seq_offsets = self.section_view('chord_seq_offsets', 'I')
+        self.music_key = self.section_view('music_key', 'B')
+        self.folksong_offsets = self.section_view('folksong_offsets', 'Q')
+
+        self.folksongs = RecordTable(self, self.folksong)
+        self.folksong_chrod_seq = RecordTable(self, self.chord_seq)
+        self.folksong_music_key = RecordTable(self, lambda i: MusicKey(self.music_key[2*i], self.music_key[2*i+1]))
+        self.result_cache = ResultCache()
+
+    def __reduce__(self):
+        # sent to worker processes by its path, each of them maps the file again
+        return (MappedMusicIndex, (self.file_path,))
+
+    def section_view(self, name: str, fmt: str) -> memoryview:
+        offset, length = self.sections[name]
+        return memoryview(self.mm)[offset:offset+length].cast(fmt)
+
+    def section_bytes(self, name: str, begin: int, end: int) -> bytes:
+        offset = self.sections[name][0]
+        return self.mm[offset+begin:offset+end]
+
+    def close(self) -> None:
+        for view in (self.sa, self.lcp, self.sa_record, self.key_offsets, self.sorted_record,
+                self.chord_seq_offsets, self.music_key, self.folksong_offsets):
+            view.release()
+        self.mm.close()
+
+    def __len__(self) -> int:
+        return self.record_number
+
+    def key_bytes(self, record_id: int) -> bytes:
+        return self.section_bytes('key_blob', self.key_offsets[record_id], self.key_offsets[record_id+1])
+
+    def key(self, record_id: int) -> FolksongKey:
+        return self.key_bytes(record_id).decode('utf8')
+
+    def record_id(self, key: FolksongKey) -> Optional[int]:
+        encoded_key = key.encode('utf8')
+        sorted_record = self.sorted_record
+        lo, hi = 0, len(sorted_record)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_bytes(sorted_record[mid]) < encoded_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(sorted_record) and self.key_bytes(sorted_record[lo]) == encoded_key:
+            return sorted_record[lo]
+        return None
+
+    def chord_seq(self, record_id: int) -> ChordSeq:
+        return self.section_bytes('chord_seq_blob', self.chord_seq_offsets[record_id], self.chord_seq_offsets[record_id+1])
+
+    def folksong(self, record_id: int) -> Folksong:
+        return pickle.loads(
+            self.section_bytes('folksong_blob', self.folksong_offsets[record_id], self.folksong_offsets[record_id+1])
+        )
+
+    def check_no_qgram(self, use_qgram: bool, transposition_invariant: bool = False) -> None:
+        if use_qgram or transposition_invariant:
+            raise ValueError('mapped index files have no q-gram or relative chord index, search the pickled database')
+
+    def result_cache_info(self) -> CacheInfo:
+        return self.result_cache.info()
+
+    def search(self, chord_seq: ChordSeq) -> Set[FolksongKey]:
+        if len(chord_seq) == 0:
+            return {self.key(d) for d in set(self.sa_record)}
+        lo, hi = suffix_range(self.mm, self.sa, self.lcp, chord_seq, self.text_offset)
+        return {self.key(d) for d in set(self.sa_record[lo:hi])}
+
+    def search_by_abs_note_seq(
+            self,
+            q_abs_note_seq: NoteSeqLike,
+            metre: Metre,
+            alpha: float = None,
+            beta: float = None,
+            tau: float = None,
+            use_qgram: bool = False,
+            transposition_invariant: bool = False) -> Set[FolksongKey]:
+        self.check_no_qgram(use_qgram, transposition_invariant)
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        tau = self.tau if tau is None else tau
+        chord_seq = detect_query_chord_seq(q_abs_note_seq, metre, self.old_chord_detection, alpha, beta, tau)
+        cache_key = ('exact', chord_seq, alpha, beta, tau)
+        retrieved_keys = self.result_cache.get(cache_key)
+        if retrieved_keys is None:
+            with profiling.stage('index_search'):
+                retrieved_keys = self.search(chord_seq)
+            self.result_cache.put(cache_key, retrieved_keys)
+        return retrieved_keys
+
+    def search_approximate(
+            self,
+            chord_seq: ChordSeq,
+            max_edits: int,
+            top_n: Optional[int] = 10,
+            node_budget: Optional[int] = DEFAULT_NODE_BUDGET) -> List[Tuple[FolksongKey, int]]:
+        return suffix_approximate_search(
+            self.mm, self.sa, self.sa_record, self.key,
+            chord_seq, max_edits, top_n, node_budget, self.text_offset
+        )
+
+    def search_by_abs_note_seq_approximate(
+            self,
+            q_abs_note_seq: NoteSeqLike,
+            metre: Metre,
+            max_edits: int,
+            top_n: Optional[int] = 10,
+            node_budget: Optional[int] = DEFAULT_NODE_BUDGET,
+            alpha: float = None,
+            beta: float = None,
+            tau: float = None,
+            use_qgram: bool = False) -> List[Tuple[FolksongKey, int]]:
+        """
+            Same as MusicDatabase.search_by_abs_note_seq_approximate
+        """
+        self.check_no_qgram(use_qgram)
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        tau = self.tau if tau is None else tau
+        chord_seq = detect_query_chord_seq(q_abs_note_seq, metre, self.old_chord_detection, alpha, beta, tau)
+        cache_key = ('approximate', chord_seq, alpha, beta, tau, max_edits, top_n, node_budget)
+        ranked = self.result_cache.get(cache_key)
+        if ranked is None:
+            with profiling.stage('approximate_search'):
+                ranked = self.search_approximate(chord_seq, max_edits, top_n, node_budget)
+            self.result_cache.put(cache_key, ranked)
+        return list(ranked)
+
+    def search_many(
+            self,
+            queries: List[Tuple[NoteSeqLike, Metre]],
+            alpha: float = None,
+            beta: float = None,
+            tau: float = None,
+            use_qgram: bool = False,
+            transposition_invariant: bool = False) -> List[Set[FolksongKey]]:
+        """
+            Same as MusicDatabase.search_many
+        """
+        self.check_no_qgram(use_qgram, transposition_invariant)
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        tau = self.tau if tau is None else tau
+        chord_seqs = detect_query_chord_seqs(queries, self.old_chord_detection, alpha, beta, tau)
+        return self.search_chord_seqs(chord_seqs, alpha, beta, tau, use_qgram, transposition_invariant)
+
+    def search_chord_seqs(
+            self,
+            chord_seqs: List[ChordSeq],
+            alpha: float = None,
+            beta: float = None,
+            tau: float = None,
+            use_qgram: bool = False,
+            transposition_invariant: bool = False) -> List[Set[FolksongKey]]:
+        """
+            Same as MusicDatabase.search_chord_seqs
+        """
+        self.check_no_qgram(use_qgram, transposition_invariant)
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        tau = self.tau if tau is None else tau
+        results = dict()
+        for chord_seq in dict.fromkeys(chord_seqs):
+            cache_key = ('exact', chord_seq, alpha, beta, tau)
+            result = self.result_cache.get(cache_key)
+            if result is None:
+                with profiling.stage('index_search'):
+                    result = self.search(chord_seq)
+                self.result_cache.put(cache_key, result)
+            results[chord_seq] = result
+        return [results[chord_seq] for chord_seq in chord_seqs]
+
+
+def load_database(file_path: str) -> Union[MusicDatabase, MappedMusicIndex]:
+    """
+        Open a mapped index file, or unpickle a MusicDatabase
+    """
+    if is_mapped_index(file_path):
+        with profiling.stage('mapped_index_open'):
+            return MappedMusicIndex(file_path)
+    with profiling.stage('pickle_load'), open(file_path, 'rb') as f:
+        return pickle.load(f)
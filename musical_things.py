@@ -1,5 +1,7 @@
+from array import array
 from collections import namedtuple
-from typing import Tuple, Sequence
+from collections.abc import Sequence as SequenceABC
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 NOTE_NAME_TO_NUMBER = {
     'C': 0,
@@ -19,23 +21,162 @@ NOTE_NAME_TO_NUMBER = {
 NOTE_NAME = ['C', 'C#/Db', 'D', 'D#/Eb', 'E', 'F', 'F#/Gb', 'G', 'G#/Ab', 'A', 'A#/Bb', 'B']
 
 class MusicNote:
+    __slots__ = ('start', 'end', 'pitch')
+
     def __init__(self, start: float, end: float, pitch: int) -> None:
         self.start = start
         self.end = end
         self.pitch = pitch
 
+    def __getstate__(self):
+        return (self.start, self.end, self.pitch)
+
+    def __setstate__(self, state) -> None:
+        # notes pickled before MusicNote had slots have a dict state
+        if isinstance(state, dict):
+            state = (state['start'], state['end'], state['pitch'])
+        self.start, self.end, self.pitch = state
+
     def __str__(self):
         return f'MusicNote(start={self.start}, end={self.end}, pitch={self.pitch})'
 
     def __repr__(self):
         return f'MusicNote(start={self.start}, end={self.end}, pitch={self.pitch})'
 
+
+class NoteSeq(SequenceABC):
+    """
+        A note sequence held as parallel arrays: the starts and ends of the notes (array('d'))
+        and their pitches (array('h')), plus a transposition added to every pitch that is read.
+        A note costs 18 bytes instead of a MusicNote object and its three numbers.
+
+        transposed() shares the arrays, so moving a melody to another key copies nothing.
+        Indexing and iterating give MusicNote objects, for code that works a note at a time.
+    """
+    __slots__ = ('starts', 'ends', 'pitches', 'transposition')
+
+    def __init__(self,
+            starts: Optional[array] = None,
+            ends: Optional[array] = None,
+            pitches: Optional[array] = None,
+            transposition: int = 0) -> None:
+        self.starts = array('d') if starts is None else starts
+        self.ends = array('d') if ends is None else ends
+        self.pitches = array('h') if pitches is None else pitches
+        self.transposition = transposition
+        assert len(self.starts) == len(self.ends) == len(self.pitches)
+
+    @classmethod
+    def from_notes(cls, notes: Iterable[MusicNote]) -> 'NoteSeq':
+        notes = list(notes)
+        return cls(
+            array('d', [n.start for n in notes]),
+            array('d', [n.end for n in notes]),
+            array('h', [n.pitch for n in notes])
+        )
+
+    def __len__(self) -> int:
+        return len(self.pitches)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return NoteSeq(self.starts[i], self.ends[i], self.pitches[i], self.transposition)
+        return MusicNote(self.starts[i], self.ends[i], self.pitches[i] + self.transposition)
+
+    def __iter__(self) -> Iterator[MusicNote]:
+        return map(MusicNote, self.starts, self.ends, self.pitch_list())
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, NoteSeq):
+            return NotImplemented
+        return (
+            self.starts == other.starts
+            and self.ends == other.ends
+            and self.pitch_list() == other.pitch_list()
+        )
+
+    def __getstate__(self):
+        return (self.starts, self.ends, self.pitches, self.transposition)
+
+    def __setstate__(self, state) -> None:
+        self.starts, self.ends, self.pitches, self.transposition = state
+
+    def __repr__(self):
+        return f'NoteSeq({list(self)})'
+
+    def pitch_list(self) -> List[int]:
+        """
+            the transposed pitches
+        """
+        t = self.transposition
+        return self.pitches.tolist() if t == 0 else [p + t for p in self.pitches]
+
+    def transposed(self, semitones: int) -> 'NoteSeq':
+        """
+            the notes moved up semitones, sharing the arrays of this sequence
+        """
+        return NoteSeq(self.starts, self.ends, self.pitches, self.transposition + semitones)
+
+    def extend(self, other: 'NoteSeq') -> None:
+        """
+            append the notes of other, with their transposition applied
+        """
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+        t = other.transposition - self.transposition
+        self.pitches.extend(other.pitches if t == 0 else array('h', [p + t for p in other.pitches]))
+
+    def end(self) -> float:
+        """
+            the end of the last sounding note
+        """
+        return max(self.ends)
+
+
+# what the detectors take: a NoteSeq, or any sequence of MusicNote
+NoteSeqLike = Union[NoteSeq, Sequence[MusicNote]]
+
+def as_note_seq(notes: NoteSeqLike) -> NoteSeq:
+    return notes if isinstance(notes, NoteSeq) else NoteSeq.from_notes(notes)
+
 # MusicNote = namedtuple('MusicNote', ['start', 'end', 'pitch'])
 
 Metre = Tuple[int, int]
 
 Chord = namedtuple('Chord', ['chord_type', 'root'])
 
+# A chord is packed into one small integer: chord_type * 12 + root.
+# There are at most 8 chord types, so every chord fits in a byte
+# and a chord sequence is held as bytes.
+CHORD_NUMBER = 8 * 12
+
+ChordSeq = bytes
+
+def encode_chord(chord_type: int, root: int) -> int:
+    return chord_type * 12 + root
+
+def decode_chord(c: int) -> Chord:
+    return Chord(c // 12, c % 12)
+
+def encode_chord_seq(cs: Sequence[Chord]) -> ChordSeq:
+    return bytes(c[0] * 12 + c[1] for c in cs)
+
+# TRANSPOSE_TABLES[t] moves the root of every chord up t semitones, for bytes.translate
+TRANSPOSE_TABLES = [
+    bytes((c - c % 12 + (c % 12 + t) % 12) if c < CHORD_NUMBER else c for c in range(256))
+    for t in range(12)
+]
+
+def transpose_chord_seq(cs: ChordSeq, semitones: int) -> ChordSeq:
+    return cs.translate(TRANSPOSE_TABLES[semitones % 12])
+
+def chord_seq_to_intervals(cs: ChordSeq) -> ChordSeq:
+    """
+        Every chord but the first, with its root replaced by the interval from the previous root:
+        the same for every transposition of cs
+    """
+    return bytes(c - c % 12 + (c - p) % 12 for p, c in zip(cs, cs[1:]))
+
 CHORD_NOTATION = [
     # single
     [n+'1' for n in NOTE_NAME],
@@ -68,14 +209,14 @@ OLD_CHORD_NOTATION = [
 ]
 
 
-def chord_to_str(c: Chord, is_old=False) -> str:
-    return OLD_CHORD_NOTATION[c[0]][c[1]] if is_old else CHORD_NOTATION[c[0]][c[1]]
+def chord_to_str(c: int, is_old=False) -> str:
+    return OLD_CHORD_NOTATION[c // 12][c % 12] if is_old else CHORD_NOTATION[c // 12][c % 12]
 
-def chord_seq_to_str(cs: Sequence[Chord], is_old=False) -> str:
+def chord_seq_to_str(cs: ChordSeq, is_old=False) -> str:
     return (
-        ','.join([OLD_CHORD_NOTATION[c[0]][c[1]] for c in cs])
+        ','.join([OLD_CHORD_NOTATION[c // 12][c % 12] for c in cs])
         if is_old else
-        ','.join([CHORD_NOTATION[c[0]][c[1]] for c in cs])
+        ','.join([CHORD_NOTATION[c // 12][c % 12] for c in cs])
     )
 
 MusicKey = namedtuple('MusicKey', ['scale_type', 'tonic'])
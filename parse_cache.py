@@ -0,0 +1,144 @@
+"""
+An on-disk cache of the parsed records of .sm files, so that building a database
+again only parses the files that changed.
+
+Every source file has one cache file, named by a hash of its absolute path. It holds
+the fingerprint of the source file (size, modification time and SHA-256 of the content)
+and its parsed folksongs as columns, with the melodies as the flat arrays of one NoteSeq,
+so that loading them does not parse any jianpu nor create any note object. It also holds
+what parsing printed about the records that failed, so that a build from the cache
+reports the same errors as one that parses.
+
+An entry is used if the size and the modification time of the source file are the
+same, or if only the modification time changed but the content hash is the same,
+e.g. after a checkout touched the file.
+"""
+
+from array import array
+import hashlib
+import os
+import pickle
+from typing import List, Optional, Tuple
+
+from database import Folksong
+from musical_things import NoteSeq, as_note_seq
+
+
+# change it when parsing changes, to ignore the entries parsed before
+PARSE_CACHE_VERSION = 4
+
+
+def file_sha256(file_path: str) -> str:
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def encode_folksongs(folksong_list: List[Folksong]) -> dict:
+    note_offsets = array('I', [0])
+    notes = NoteSeq()
+    for f in folksong_list:
+        notes.extend(as_note_seq(f.melody))
+        note_offsets.append(len(notes))
+    return {
+        'subsets': [f.subset for f in folksong_list],
+        'titles': [f.title for f in folksong_list],
+        'signatures': [f.signature for f in folksong_list],
+        'time_units': [f.time_unit for f in folksong_list],
+        'tonics': [f.tonic for f in folksong_list],
+        'metres': [f.metre for f in folksong_list],
+        'melody_strs': [f.melody_str for f in folksong_list],
+        'lyrics': [f.lyrics for f in folksong_list],
+        'note_offsets': note_offsets,
+        'starts': notes.starts,
+        'ends': notes.ends,
+        'pitches': notes.pitches,
+    }
+
+
+def decode_folksongs(columns: dict) -> List[Folksong]:
+    note_offsets = columns['note_offsets']
+    notes = NoteSeq(columns['starts'], columns['ends'], columns['pitches'])
+    folksong_list = []
+    for i, fields in enumerate(zip(
+            columns['subsets'],
+            columns['titles'],
+            columns['signatures'],
+            columns['time_units'],
+            columns['tonics'],
+            columns['metres'])):
+        begin, end = note_offsets[i], note_offsets[i+1]
+        folksong_list.append(Folksong(*fields, notes[begin:end], columns['melody_strs'][i], columns['lyrics'][i]))
+    return folksong_list
+
+
+class ParseCache:
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, sm_file_path: str) -> str:
+        path_hash = hashlib.sha1(os.path.abspath(sm_file_path).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, path_hash + '.pickle')
+
+    def load(self, sm_file_path: str, st: os.stat_result) -> Optional[Tuple[List[Folksong], int, str]]:
+        """
+            The folksongs, the number of records of sm_file_path, whose stat is st,
+            and what parsing it printed, or None if they are not cached
+        """
+        entry_path = self.entry_path(sm_file_path)
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            # no entry, or one written by another version of the code
+            entry = None
+        if (
+                not isinstance(entry, dict)
+                or entry.get('version') != PARSE_CACHE_VERSION
+                or entry['path'] != os.path.abspath(sm_file_path)
+                or entry['size'] != st.st_size):
+            return None
+        if entry['mtime_ns'] != st.st_mtime_ns:
+            if entry['sha256'] != file_sha256(sm_file_path):
+                return None
+            # the same content, remember the new modification time
+            entry['mtime_ns'] = st.st_mtime_ns
+            self.write_entry(entry_path, entry)
+        return decode_folksongs(entry['folksongs']), entry['total_record'], entry['output']
+
+    def store(
+            self,
+            sm_file_path: str,
+            st: os.stat_result,
+            folksong_list: List[Folksong],
+            total_record: int,
+            output: str) -> None:
+        """
+            Cache the folksongs and the number of records parsed from sm_file_path, whose stat is st
+            (taken before parsing), and what parsing it printed.
+            Nothing is cached if the file changed since st, as the parsed records may not be of the hashed content.
+        """
+        sha256 = file_sha256(sm_file_path)
+        new_st = os.stat(sm_file_path)
+        if (new_st.st_size, new_st.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return
+        self.write_entry(self.entry_path(sm_file_path), {
+            'version': PARSE_CACHE_VERSION,
+            'path': os.path.abspath(sm_file_path),
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha256': sha256,
+            'total_record': total_record,
+            'output': output,
+            'folksongs': encode_folksongs(folksong_list),
+        })
+
+    def write_entry(self, entry_path: str, entry: dict) -> None:
+        # write a whole new file, so that a build stopped halfway does not leave a broken entry
+        temp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, entry_path)
@@ -0,0 +1,221 @@
+"""
+Opt-in instrumentation of builds and searches, turned on by --profile of make_database.py,
+search.py and get_experiment_data.py.
+
+The instrumented code looks up the module-level PROFILE, which is None unless profiling
+is enabled, so that it costs one global lookup where it is off:
+
+    with profiling.stage('record_parse'):
+        ...
+    profile = profiling.PROFILE
+    if profile is not None:
+        profile.count('pattree.insert.nodes_visited', visited)
+
+A stage records its calls and wall time. Stages nest: seconds includes the stages run
+inside it, and self_seconds does not. Counters are added up, and sizes keep the count,
+total, maximum and a power-of-two histogram of the sizes recorded under a name.
+
+The stages run in worker processes by database.ordered_map are recorded in the workers
+and merged into the report, so with -j their seconds add up the time of all workers.
+The optional cProfile dump covers the main process only.
+"""
+
+import cProfile
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import sys
+from time import perf_counter
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# the profile of this process, None when profiling is disabled
+PROFILE: Optional['Profile'] = None
+
+# the stage of a disabled profile, nullcontext does not keep any state so one is shared
+NULL_STAGE = nullcontext()
+
+
+def size_bucket_label(bucket: int) -> str:
+    """
+        The range of the sizes counted in a histogram bucket, which is their bit length
+    """
+    if bucket <= 1:
+        return str(bucket)
+    return f'{1 << (bucket - 1)}-{(1 << bucket) - 1}'
+
+
+class Profile:
+    def __init__(self) -> None:
+        # name -> [calls, seconds, self_seconds]
+        self.stages: Dict[str, List[float]] = dict()
+        self.counters: Dict[str, int] = dict()
+        # name -> [count, total, max, {bit length of a size: count}]
+        self.sizes: Dict[str, list] = dict()
+        # the seconds of the stages run inside each of the running stages, innermost last
+        self.child_seconds: List[float] = []
+        self.begin_time = perf_counter()
+
+    def add_time(self, name: str, seconds: float, calls: int = 1, self_seconds: Optional[float] = None) -> None:
+        """
+            Add calls and seconds to stage name, as if it ran inside the running stage
+        """
+        s = self.stages.get(name)
+        if s is None:
+            s = self.stages[name] = [0, 0.0, 0.0]
+        s[0] += calls
+        s[1] += seconds
+        s[2] += seconds if self_seconds is None else self_seconds
+        if len(self.child_seconds) > 0:
+            self.child_seconds[-1] += seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        self.child_seconds.append(0.0)
+        begin_time = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - begin_time
+            self.add_time(name, seconds, self_seconds=seconds - self.child_seconds.pop())
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_size(self, name: str, size: int) -> None:
+        s = self.sizes.get(name)
+        if s is None:
+            s = self.sizes[name] = [0, 0, 0, dict()]
+        s[0] += 1
+        s[1] += size
+        if size > s[2]:
+            s[2] = size
+        histogram = s[3]
+        bucket = size.bit_length()
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def snapshot(self) -> Tuple[dict, dict, dict]:
+        """
+            The stages, counters and sizes recorded, to be merged into another profile
+        """
+        return self.stages, self.counters, self.sizes
+
+    def merge(self, snapshot: Tuple[dict, dict, dict]) -> None:
+        """
+            Add the snapshot of another profile, e.g. of a worker process, to this one
+        """
+        stages, counters, sizes = snapshot
+        for name, (calls, seconds, self_seconds) in stages.items():
+            s = self.stages.get(name)
+            if s is None:
+                s = self.stages[name] = [0, 0.0, 0.0]
+            s[0] += calls
+            s[1] += seconds
+            s[2] += self_seconds
+        for name, n in counters.items():
+            self.count(name, n)
+        for name, (count, total, max_size, histogram) in sizes.items():
+            s = self.sizes.get(name)
+            if s is None:
+                s = self.sizes[name] = [0, 0, 0, dict()]
+            s[0] += count
+            s[1] += total
+            s[2] = max(s[2], max_size)
+            for bucket, n in histogram.items():
+                s[3][bucket] = s[3].get(bucket, 0) + n
+
+    def report(self) -> dict:
+        """
+            The profile as a JSON-serializable dict
+        """
+        return {
+            'wall_seconds': perf_counter() - self.begin_time,
+            'stages': {
+                name: {'calls': calls, 'seconds': seconds, 'self_seconds': self_seconds}
+                for name, (calls, seconds, self_seconds) in self.stages.items()
+            },
+            'counters': dict(sorted(self.counters.items())),
+            'sizes': {
+                name: {
+                    'count': count,
+                    'total': total,
+                    'mean': total / count if count > 0 else 0,
+                    'max': max_size,
+                    'histogram': {size_bucket_label(b): histogram[b] for b in sorted(histogram)},
+                }
+                for name, (count, total, max_size, histogram) in sorted(self.sizes.items())
+            },
+        }
+
+
+def stage(name: str) -> ContextManager[None]:
+    """
+        A stage of PROFILE, or a context manager that does nothing when profiling is disabled
+    """
+    if PROFILE is None:
+        return NULL_STAGE
+    return PROFILE.stage(name)
+
+
+def call_profiled(fn: Callable[[T], R], arg: T) -> Tuple[R, Tuple[dict, dict, dict]]:
+    """
+        fn(arg) and the snapshot of a profile of it, to be run in a worker process.
+        It is a top-level function so that it can be sent to worker processes.
+    """
+    global PROFILE
+    PROFILE = Profile()
+    try:
+        return fn(arg), PROFILE.snapshot()
+    finally:
+        PROFILE = None
+
+
+def add_profile_arguments(parser) -> None:
+    parser.add_argument(
+        '--profile',
+        dest='profile_path',
+        type=str,
+        default=None,
+        help='Write the time of every stage and the counters of the index to this JSON file'
+    )
+    parser.add_argument(
+        '--cprofile',
+        dest='cprofile_path',
+        type=str,
+        default=None,
+        help='Write the cProfile stats of the main process to this file, to be read with pstats'
+    )
+
+
+@contextmanager
+def profiled(profile_path: Optional[str], cprofile_path: Optional[str]) -> Iterator[Optional[Profile]]:
+    """
+        Enable PROFILE if profile_path is given and cProfile if cprofile_path is given while the
+        block runs, and write their results after it, also if it is interrupted
+    """
+    global PROFILE
+    if profile_path is not None:
+        PROFILE = Profile()
+    profiler = None
+    if cprofile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield PROFILE
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+            print(f'cProfile stats written to {cprofile_path}')
+        if profile_path is not None:
+            report = {
+                'command': os.path.basename(sys.argv[0]),
+                'argv': sys.argv[1:],
+                **PROFILE.report()
+            }
+            PROFILE = None
+            with open(profile_path, 'w', encoding='utf8') as f:
+                json.dump(report, f, indent=2)
+            print(f'profile written to {profile_path}')
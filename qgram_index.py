@@ -0,0 +1,203 @@
+"""
+An inverted index from chord q-grams (q consecutive bar chords) to the songs and
+offsets where they occur, for fault-tolerant search.
+
+If a song contains the query (m chords) with at most k edits, the occurrence
+shares at least
+
+    t = (m - q + 1) - k * q
+
+of the query's q-grams, because one edit destroys at most q of them (the
+q-gram lemma). So the songs sharing fewer than t of the query's q-grams are
+filtered out by counting posting list hits, and only the remaining candidates
+are verified. A q-gram hit at query position i and song offset o puts the
+start of the occurrence within k of o - i, so the verification only aligns
+the query against the windows of the song around its hits, with the cells
+larger than k cut off (Ukkonen's cut-off), which keeps it to a band of
+diagonals.
+
+The cost scales with the length of the posting lists of the query's q-grams
+rather than with the corpus, as long as t > 0. Shorter queries or larger k
+leave nothing to filter with, and every song is verified.
+
+Exact search needs no edit distance: the occurrences of the query's rarest
+q-gram are compared with the query, and a query shorter than q is looked for
+in every song with a substring test.
+
+Reference:
+
+- Ukkonen (1992), Approximate string-matching with q-grams and maximal matches
+- Sellers (1980), The theory and computation of evolutionary distances: pattern recognition
+"""
+
+from array import array
+from typing import Dict, List, Mapping, Optional, Set, Tuple
+
+from musical_things import ChordSeq
+
+
+FolksongKey = str
+
+DEFAULT_Q = 3
+
+
+def occurrence_cost(q: ChordSeq, text: ChordSeq, max_edits: int) -> Optional[int]:
+    """
+        The least edit distance between q and a substring of text, or None if it is larger than max_edits
+    """
+    m = len(q)
+    # column[i] = least edit distance between q[:i] and a substring of text ending here.
+    # Cells after the last one within max_edits are not kept.
+    column = list(range(min(m, max_edits) + 1))
+    best = column[m] if len(column) == m + 1 else None
+    for chord in text:
+        column_len = len(column)
+        # an occurrence can start anywhere
+        new_column = [0]
+        last_kept = 0
+        for i in range(1, min(column_len + 1, m + 1)):
+            cell = column[i-1] + (q[i-1] != chord)
+            if i < column_len and column[i] < cell:
+                cell = column[i] + 1
+            if new_column[i-1] < cell:
+                cell = new_column[i-1] + 1
+            new_column.append(cell)
+            if cell <= max_edits:
+                last_kept = i
+        del new_column[last_kept+1:]
+        column = new_column
+        if len(column) == m + 1 and (best is None or column[m] < best):
+            best = column[m]
+    return best
+
+
+class QGramIndex:
+    def __init__(self, chord_seqs: Mapping[FolksongKey, ChordSeq], q: int = DEFAULT_Q) -> None:
+        assert q > 0, 'q must be positive'
+        self.q = q
+        self.keys: List[FolksongKey] = []
+        self.chord_seqs: List[ChordSeq] = []
+        # q-gram -> song id and offset of every occurrence, interleaved
+        self.postings: Dict[ChordSeq, array] = dict()
+        for key, chord_seq in chord_seqs.items():
+            if len(chord_seq) == 0:
+                # no other index stores a key for an empty sequence either
+                continue
+            doc_id = len(self.keys)
+            self.keys.append(key)
+            self.chord_seqs.append(chord_seq)
+            for offset in range(len(chord_seq) - q + 1):
+                gram = chord_seq[offset:offset+q]
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array('I')
+                posting.append(doc_id)
+                posting.append(offset)
+
+    def __len__(self) -> int:
+        return len(self.postings)
+
+    def candidates(self, chord_seq: ChordSeq, max_edits: int) -> Optional[Dict[int, List[int]]]:
+        """
+            The songs passing the count filter, with the diagonals (offset - query position) of their hits.
+            None if the filter can not exclude any song.
+        """
+        q = self.q
+        threshold = len(chord_seq) - q + 1 - max_edits * q
+        if threshold <= 0:
+            return None
+        diagonals: Dict[int, List[int]] = dict()
+        counts: Dict[int, int] = dict()
+        # the last query position counted for a song, so that each position counts once
+        counted_at: Dict[int, int] = dict()
+        for i in range(len(chord_seq) - q + 1):
+            posting = self.postings.get(chord_seq[i:i+q])
+            if posting is None:
+                continue
+            for j in range(0, len(posting), 2):
+                doc_id = posting[j]
+                if doc_id not in diagonals:
+                    diagonals[doc_id] = []
+                    counts[doc_id] = 0
+                diagonals[doc_id].append(posting[j+1] - i)
+                if counted_at.get(doc_id) != i:
+                    counted_at[doc_id] = i
+                    counts[doc_id] += 1
+        return {
+            doc_id: doc_diagonals
+            for doc_id, doc_diagonals in diagonals.items()
+            if counts[doc_id] >= threshold
+        }
+
+    def verify(self, chord_seq: ChordSeq, doc_id: int, doc_diagonals: List[int], max_edits: int) -> Optional[int]:
+        """
+            The least cost of chord_seq in the song, looking only around the diagonals of its hits
+        """
+        text = self.chord_seqs[doc_id]
+        m = len(chord_seq)
+        # an occurrence starting within max_edits of a diagonal ends before diagonal + m + 2 * max_edits
+        windows = sorted(
+            (max(0, d - max_edits), min(len(text), d + m + 2 * max_edits))
+            for d in set(doc_diagonals)
+        )
+        best = None
+        window_begin, window_end = windows[0]
+        for begin, end in windows[1:] + [(len(text) + 1, len(text) + 1)]:
+            if begin <= window_end:
+                window_end = max(window_end, end)
+                continue
+            cost = occurrence_cost(chord_seq, text[window_begin:window_end], max_edits)
+            if cost is not None and (best is None or cost < best):
+                best = cost
+            window_begin, window_end = begin, end
+        return best
+
+    def search_approximate(
+            self,
+            chord_seq: ChordSeq,
+            max_edits: int,
+            top_n: Optional[int] = 10) -> List[Tuple[FolksongKey, int]]:
+        """
+            (key, edit cost) of the top_n (all if None) songs containing chord_seq
+            with at most max_edits edits, sorted by cost and then key
+        """
+        candidates = self.candidates(chord_seq, max_edits)
+        ranked = []
+        if candidates is None:
+            for doc_id, text in enumerate(self.chord_seqs):
+                cost = occurrence_cost(chord_seq, text, max_edits)
+                if cost is not None:
+                    ranked.append((cost, self.keys[doc_id]))
+        else:
+            for doc_id, doc_diagonals in candidates.items():
+                cost = self.verify(chord_seq, doc_id, doc_diagonals, max_edits)
+                if cost is not None:
+                    ranked.append((cost, self.keys[doc_id]))
+        ranked.sort()
+        if top_n is not None:
+            ranked = ranked[:top_n]
+        return [(key, cost) for cost, key in ranked]
+
+    def search(self, chord_seq: ChordSeq) -> Set[FolksongKey]:
+        """
+            The songs containing chord_seq exactly. A query of at least q chords is only
+            looked for at the occurrences of its rarest q-gram, a shorter one in every song.
+        """
+        q = self.q
+        if len(chord_seq) < q:
+            return {key for key, text in zip(self.keys, self.chord_seqs) if chord_seq in text}
+        posting = None
+        gram_begin = 0
+        for i in range(len(chord_seq) - q + 1):
+            gram_posting = self.postings.get(chord_seq[i:i+q])
+            if gram_posting is None:
+                return set()
+            if posting is None or len(gram_posting) < len(posting):
+                posting, gram_begin = gram_posting, i
+        found = set()
+        for j in range(0, len(posting), 2):
+            doc_id = posting[j]
+            begin = posting[j+1] - gram_begin
+            if begin >= 0 and self.chord_seqs[doc_id].startswith(chord_seq, begin):
+                found.add(self.keys[doc_id])
+        return found
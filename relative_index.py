@@ -0,0 +1,70 @@
+"""
+An index of chord sequences relative to the key of their songs, so that a
+query matches in whichever key it is sung.
+
+The stored chord sequences are absolute, and the detector's chord-in-scale
+prior is that of a scale on C, so the chords of a transposed melody are not
+the transposed chords. The relative sequence of a song is instead detected on
+its melody transposed so that its detected tonic (folksong_music_key) is C.
+A query is detected the same way with its own detected tonic, so a transposed
+query gets the same relative chords as long as its tonic is detected along.
+
+Two encodings of the relative chords are indexed:
+
+- 'tonic':    the chords themselves, their roots relative to the tonic
+- 'interval': every chord but the first, with its root relative to the
+              previous chord's root. It does not depend on the tonic at all,
+              so it also matches when the tonic of the query is detected
+              differently, as long as the detected chords agree. The chord
+              type of the first chord is not in it, so the candidates are
+              verified against the 12 transpositions of the query.
+"""
+
+from typing import Mapping, Set
+
+from musical_things import ChordSeq, transpose_chord_seq, chord_seq_to_intervals
+from suffix_array import SuffixArrayIndex
+
+
+FolksongKey = str
+
+RELATIVE_CHORDS = ['tonic', 'interval']
+
+
+class RelativeChordIndex:
+    def __init__(self, relative_chord_seqs: Mapping[FolksongKey, ChordSeq], relative_chords: str) -> None:
+        """
+            relative_chord_seqs: the chord sequences detected relative to the tonic of every song
+        """
+        assert relative_chords in RELATIVE_CHORDS, f'unknown relative chords: {relative_chords}'
+        self.relative_chords = relative_chords
+        self.relative_chord_seqs = relative_chord_seqs
+        if relative_chords == 'interval':
+            self.suffix_array = SuffixArrayIndex({
+                key: chord_seq_to_intervals(chord_seq)
+                for key, chord_seq in relative_chord_seqs.items()
+            })
+        else:
+            self.suffix_array = SuffixArrayIndex(relative_chord_seqs)
+
+    def __len__(self) -> int:
+        return len(self.suffix_array)
+
+    def search(self, relative_chord_seq: ChordSeq) -> Set[FolksongKey]:
+        """
+            The songs containing relative_chord_seq, a query detected relative to its tonic,
+            in any transposition for 'interval'
+        """
+        if self.relative_chords == 'tonic':
+            return self.suffix_array.search(relative_chord_seq)
+        if len(relative_chord_seq) <= 1:
+            # no interval to search, and the songs of one chord are not in the suffix array
+            candidates = self.relative_chord_seqs.keys()
+        else:
+            candidates = self.suffix_array.search(chord_seq_to_intervals(relative_chord_seq))
+        transposed = [transpose_chord_seq(relative_chord_seq, t) for t in range(12)]
+        return {
+            key
+            for key in candidates
+            if any(t in self.relative_chord_seqs[key] for t in transposed)
+        }
@@ -0,0 +1,83 @@
+"""
+A least-recently-used cache of search results.
+
+Many queries detect to the same chord sequence, e.g. the corrupted queries of
+the experiments whose corruption does not change a chord, so their results are
+kept and looked up by the chord sequence, the detection parameters it was
+detected with and the search options. The cache is bounded by the total size
+of the results rather than by their number, as the result of a short query
+can hold every key of the database.
+"""
+
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional, Sized
+
+
+# total size of the cached results: one per result plus one per key (or ranked key) in it
+RESULT_CACHE_SIZE = 1 << 17
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+    results: int
+
+
+class ResultCache:
+    def __init__(self, maxsize: int = RESULT_CACHE_SIZE) -> None:
+        """
+            maxsize: total size of the cached results, 0 to cache nothing
+        """
+        self.maxsize = maxsize
+        # key -> (result, size)
+        self.entries: OrderedDict = OrderedDict()
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self) -> dict:
+        # results are not pickled with the database
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['maxsize'])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[Sized]:
+        """
+            The cached result of key, or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, result: Sized) -> None:
+        size = len(result) + 1
+        if size > self.maxsize:
+            return
+        old_entry = self.entries.pop(key, None)
+        if old_entry is not None:
+            self.currsize -= old_entry[1]
+        self.entries[key] = (result, size)
+        self.currsize += size
+        while self.currsize > self.maxsize:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.currsize -= evicted_size
+
+    def clear(self) -> None:
+        """
+            Drop all results, after the index changed. The statistics are kept.
+        """
+        self.entries.clear()
+        self.currsize = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, self.currsize, len(self.entries))
@@ -2,14 +2,16 @@
 python3 ./make_database.py dataset md_old.pickle --old
 
 # make new with 4 differnet alpha value
-for alpha in 0.0 0.3 0.6 1.0; do
-    python3 ./make_database.py dataset md_${alpha}.pickle -a ${alpha}
+# the dataset is parsed once, the other alpha values are detected again from the bar profiles stored in the first
+python3 ./make_database.py dataset md_0.0.pickle -a 0.0
+for alpha in 0.3 0.6 1.0; do
+    python3 ./make_database.py --from-db md_0.0.pickle md_${alpha}.pickle -a ${alpha}
 done
 
-for c_num in 0 1 2 3 4; do
-    echo "c=$c_num"
-    python3 ./get_experiment_data.py md_old.pickle -c $c_num
-    for alpha in 0.0 0.3 0.6 1.0; do
-        python3 ./get_experiment_data.py md_${alpha}.pickle -c $c_num --no-deletion
-    done
+# every database is loaded once and evaluated at all corruption numbers,
+# with the queries spread over one worker per CPU
+JOBS=$(nproc 2>/dev/null || echo 1)
+python3 ./get_experiment_data.py md_old.pickle -c 0 1 2 3 4 -j $JOBS
+for alpha in 0.0 0.3 0.6 1.0; do
+    python3 ./get_experiment_data.py md_${alpha}.pickle -c 0 1 2 3 4 --no-deletion -j $JOBS
 done
@@ -1,10 +1,13 @@
 from argparse import ArgumentParser, Namespace
 import json
-import pickle
 
+from approximate_search import DEFAULT_NODE_BUDGET, non_negative_int, positive_int
 from database import MusicDatabase
 from detector import abs_note_seq_to_chrod_seq
+from mapped_index import load_database
 from musical_things import MusicNote, chord_seq_to_str
+from search_server import query_from_json, serve
+import profiling
 
 def read_args() -> Namespace:
     parser = ArgumentParser()
@@ -14,7 +17,9 @@ def read_args() -> Namespace:
     )
     parser.add_argument(
         'query_file_path',
-        type=str
+        type=str,
+        nargs='?',
+        help='Not needed with --serve'
     )
     parser.add_argument(
         '--query_format',
@@ -25,18 +30,83 @@ def read_args() -> Namespace:
               \'json\' - Object containing an integer 2-tuple as metre, \
               and a list of objects with three keys: "start", "end", and "pitch"'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '-k', '--max-edits',
+        type=non_negative_int,
+        default=None,
+        help='Search approximately, allowing up to k chord substitutions, insertions or deletions'
+    )
+    parser.add_argument(
+        '--top',
+        type=positive_int,
+        default=10,
+        help='Number of best approximate results'
+    )
+    parser.add_argument(
+        '--node-budget',
+        type=non_negative_int,
+        default=DEFAULT_NODE_BUDGET,
+        help='Positions of the index an approximate search may visit, 0 for no limit'
+    )
+    parser.add_argument(
+        '--qgram',
+        dest='use_qgram',
+        action='store_true',
+        help='Search with the q-gram index of a database made with --qgram, exactly or with -k (without a node budget)'
+    )
+    parser.add_argument(
+        '--transposition-invariant',
+        action='store_true',
+        help='Search exactly with the chords relative to the query\'s tonic, \
+              in the relative chord index of a database made with --relative'
+    )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Load the database once and answer json queries with POST /search over HTTP'
+    )
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='127.0.0.1'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8000
+    )
+    parser.add_argument(
+        '--unix-socket',
+        dest='unix_socket_path',
+        type=str,
+        default=None,
+        help='Serve on this unix socket instead of --host and --port'
+    )
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if not args.serve and args.query_file_path is None:
+        parser.error('query_file_path is required without --serve')
+    if args.transposition_invariant and args.max_edits is not None:
+        parser.error('--transposition-invariant searches exactly, without -k')
+    return args
 
 
 def main():
     args = read_args()
-    md: MusicDatabase = pickle.load(open(args.dataset_path, 'rb'))
+    with profiling.profiled(args.profile_path, args.cprofile_path):
+        run(args)
+
+def run(args: Namespace) -> None:
+    md: MusicDatabase = load_database(args.dataset_path)
+    if args.serve:
+        serve(md, args.host, args.port, args.unix_socket_path)
+        return
     if args.query_format == 'json':
         query_song = json.load(open(args.query_file_path, 'r', encoding='utf8'))
-        q_metre = query_song['metre']
-        q_melody = [MusicNote(start=n['start'], end=n['end'], pitch=n['pitch']) for n in query_song['melody']]
+        q_metre, q_melody = query_from_json(query_song)
         print('Query metre:', q_metre)
-        print('Query melody:', q_melody)
+        # the notes as written in the query, q_melody holds their times as floats
+        print('Query melody:', [MusicNote(n['start'], n['end'], n['pitch']) for n in query_song['melody']])
 
         # ground_truth
         q_key = query_song['key']
@@ -47,7 +117,23 @@ def main():
     else:
         raise NotImplementedError()
 
-    retrieved_keys = md.search_by_abs_note_seq(q_melody, q_metre)
+    if args.max_edits is not None:
+        ranked = md.search_by_abs_note_seq_approximate(
+            q_melody, q_metre, args.max_edits, args.top, args.node_budget or None,
+            use_qgram=args.use_qgram
+        )
+        print(f'Found {len(ranked)} records')
+        for key, cost in ranked:
+            print('Edit cost:', cost)
+            print(md.folksongs[key])
+            print('---')
+        return
+
+    retrieved_keys = md.search_by_abs_note_seq(
+        q_melody, q_metre,
+        use_qgram=args.use_qgram,
+        transposition_invariant=args.transposition_invariant
+    )
 
     print(f'Found {len(retrieved_keys)} records')
     for key in retrieved_keys:
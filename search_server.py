@@ -0,0 +1,202 @@
+"""
+Answer queries of a loaded database over HTTP, so that the database is loaded once.
+
+    POST /search
+    {"metre": [3, 4], "melody": [{"start": 0, "end": 1, "pitch": 60}, ...], "records": true}
+
+The query is the same as the json query file of search.py, "records" is optional.
+The response is {"keys": [...], "records": [...]} with the keys sorted and one
+record per key, or {"keys": [...]} if "records" is false. A query that can not
+be searched gets status 400 and {"error": "..."}.
+
+With "max_edits": k (and optionally "top" and "node_budget", 0 for no limit as
+in search.py), the search is approximate: the keys are ranked by edit cost and
+"costs" holds their costs.
+With "qgram": true, the q-gram index of the database is searched, and with
+"transposition_invariant": true, its relative chord index.
+
+Connections are handled by asyncio and kept alive. Searching is CPU bound, so
+queries are answered one at a time in the event loop.
+"""
+
+import asyncio
+import json
+from math import isfinite
+from typing import Optional, Tuple, Union
+
+from approximate_search import DEFAULT_NODE_BUDGET
+from database import MusicDatabase, Folksong, FolksongKey
+from mapped_index import MappedMusicIndex
+from musical_things import MusicNote, Metre, NoteSeq
+
+
+SEARCH_PATH = '/search'
+
+# refuse larger request bodies
+MAX_BODY_SIZE = 1 << 20
+
+STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large'
+}
+
+
+def is_int(x) -> bool:
+    # bool is an int, but true is not a pitch
+    return isinstance(x, int) and not isinstance(x, bool)
+
+def int_option(query_song: dict, name: str, default: int, minimum: int = 0) -> int:
+    """
+        The option name of a json query, or default if it is not given.
+        Raise ValueError if it is not an int of at least minimum.
+    """
+    value = query_song.get(name, default)
+    if not (is_int(value) and value >= minimum):
+        raise ValueError(f'{name} must be an integer of at least {minimum}: {value!r}')
+    return value
+
+def query_from_json(query_song: dict) -> Tuple[Metre, NoteSeq]:
+    """
+        The metre and melody of a json query.
+        Raise ValueError if the metre is not two positive ints, or a note has no numeric start and end or int pitch.
+    """
+    q_metre = query_song['metre']
+    if not (isinstance(q_metre, (list, tuple)) and len(q_metre) == 2 and all(is_int(m) and m > 0 for m in q_metre)):
+        raise ValueError(f'metre must be two positive integers: {q_metre!r}')
+    for n in query_song['melody']:
+        if not all(
+                (is_int(n[k]) or isinstance(n[k], float)) and isfinite(n[k])
+                for k in ('start', 'end')):
+            raise ValueError(f'start and end of a note must be numbers: {n!r}')
+        if not is_int(n['pitch']):
+            raise ValueError(f'pitch of a note must be an integer: {n!r}')
+    q_melody = NoteSeq.from_notes(
+        MusicNote(start=n['start'], end=n['end'], pitch=n['pitch']) for n in query_song['melody']
+    )
+    return q_metre, q_melody
+
+
+def folksong_to_dict(key: FolksongKey, f: Folksong) -> dict:
+    return {
+        'key': key,
+        'subset': f.subset,
+        'title': f.title,
+        'signature': f.signature,
+        'time_unit': f.time_unit,
+        'tonic': f.tonic,
+        'metre': f.metre,
+        'melody': f.melody_str,
+        'lyrics': f.lyrics
+    }
+
+
+class SearchServer:
+    def __init__(self, md: Union[MusicDatabase, MappedMusicIndex]) -> None:
+        self.md = md
+        self.query_count = 0
+
+    def search(self, query_song: dict) -> dict:
+        q_metre, q_melody = query_from_json(query_song)
+        response = dict()
+        use_qgram = bool(query_song.get('qgram', False))
+        if query_song.get('max_edits') is not None:
+            ranked = self.md.search_by_abs_note_seq_approximate(
+                q_melody, q_metre,
+                int_option(query_song, 'max_edits', 0),
+                int_option(query_song, 'top', 10, minimum=1),
+                # 0 for no limit, as --node-budget of search.py
+                int_option(query_song, 'node_budget', DEFAULT_NODE_BUDGET) or None,
+                use_qgram=use_qgram
+            )
+            retrieved_keys = [key for key, _ in ranked]
+            response['costs'] = [cost for _, cost in ranked]
+        else:
+            retrieved_keys = sorted(self.md.search_by_abs_note_seq(
+                q_melody, q_metre,
+                use_qgram=use_qgram,
+                transposition_invariant=bool(query_song.get('transposition_invariant', False))
+            ))
+        self.query_count += 1
+        response['keys'] = retrieved_keys
+        if query_song.get('records', True):
+            response['records'] = [folksong_to_dict(k, self.md.folksongs[k]) for k in retrieved_keys]
+        return response
+
+    def respond(self, method: str, path: str, body: bytes) -> Tuple[int, dict]:
+        if path != SEARCH_PATH:
+            return 404, {'error': f'unknown path {path}'}
+        if method != 'POST':
+            return 405, {'error': f'use POST {SEARCH_PATH}'}
+        try:
+            return 200, self.search(json.loads(body))
+        except (ValueError, KeyError, TypeError, AssertionError, ArithmeticError) as e:
+            # malformed json, missing fields or a melody the detector can not take
+            return 400, {'error': repr(e)}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if content_length > MAX_BODY_SIZE:
+                    status, response = 413, {'error': f'body larger than {MAX_BODY_SIZE} bytes'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(content_length)
+                    status, response = self.respond(method, path, body)
+                payload = json.dumps(response).encode('utf8')
+                writer.write(
+                    f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(payload)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+                    f'\r\n'.encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # the client went away or sent something that is not HTTP
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self, host: str, port: int, unix_socket_path: Optional[str] = None) -> None:
+        if unix_socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket_path)
+            print(f'Serving on {unix_socket_path}', flush=True)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f'Serving on http://{host}:{port}{SEARCH_PATH}', flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def serve(
+        md: Union[MusicDatabase, MappedMusicIndex],
+        host: str = '127.0.0.1',
+        port: int = 8000,
+        unix_socket_path: Optional[str] = None) -> None:
+    server = SearchServer(md)
+    try:
+        asyncio.run(server.serve_forever(host, port, unix_socket_path))
+    except KeyboardInterrupt:
+        cache_info = md.result_cache_info()
+        print(f'Answered {server.query_count} queries, {cache_info.hits} from the result cache')
@@ -0,0 +1,311 @@
+"""
+A static, read-optimized alternative to PATTree.
+
+All chord sequences are concatenated into one integer-encoded text, each
+sequence followed by a separator symbol that no query can contain:
+
+    text = seq_0 SEP seq_1 SEP ... seq_n-1 SEP
+
+The suffix array of the text is built with SA-IS (linear time) and the LCP
+array with Kasai's algorithm (linear time). A query is answered by binary
+searching the first suffix that starts with the query, then walking the LCP
+array for as long as the following suffixes share at least len(query) chords.
+
+Because every suffix of every sequence is in the array, the songs containing
+the query are exactly the songs owning the matched suffixes, which is the same
+set PATTree.search returns.
+
+Reference:
+
+- Nong, Zhang & Chan (2009), Two Efficient Algorithms for Linear Time Suffix Array Construction
+- Kasai et al. (2001), Linear-Time Longest-Common-Prefix Computation in Suffix Arrays
+"""
+
+from array import array
+from typing import Callable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple
+
+from approximate_search import approximate_search, DEFAULT_NODE_BUDGET
+from musical_things import ChordSeq, CHORD_NUMBER
+
+
+FolksongKey = str
+
+# every packed chord is less than CHORD_NUMBER
+SEPARATOR = CHORD_NUMBER
+
+
+def sa_is(s: Sequence[int], upper: int) -> List[int]:
+    """
+        Suffix array of s by induced sorting. Every value of s must be in [0, upper].
+    """
+    n = len(s)
+    if n == 0:
+        return []
+    if n == 1:
+        return [0]
+    if n == 2:
+        return [0, 1] if s[0] < s[1] else [1, 0]
+
+    sa = [0] * n
+    # ls[i] is True if suffix i is S-type (smaller than suffix i+1)
+    ls = [False] * n
+    for i in range(n-2, -1, -1):
+        ls[i] = ls[i+1] if s[i] == s[i+1] else (s[i] < s[i+1])
+
+    # bucket boundaries
+    sum_l = [0] * (upper + 1)
+    sum_s = [0] * (upper + 1)
+    for i in range(n):
+        if not ls[i]:
+            sum_s[s[i]] += 1
+        else:
+            sum_l[s[i]+1] += 1
+    for i in range(upper + 1):
+        sum_s[i] += sum_l[i]
+        if i < upper:
+            sum_l[i+1] += sum_s[i]
+
+    def induce(lms: List[int]) -> None:
+        for i in range(n):
+            sa[i] = -1
+        buf = sum_s.copy()
+        for d in lms:
+            if d == n:
+                continue
+            sa[buf[s[d]]] = d
+            buf[s[d]] += 1
+        buf = sum_l.copy()
+        sa[buf[s[n-1]]] = n - 1
+        buf[s[n-1]] += 1
+        for i in range(n):
+            v = sa[i]
+            if v >= 1 and not ls[v-1]:
+                sa[buf[s[v-1]]] = v - 1
+                buf[s[v-1]] += 1
+        buf = sum_l.copy()
+        for i in range(n-1, -1, -1):
+            v = sa[i]
+            if v >= 1 and ls[v-1]:
+                buf[s[v-1]+1] -= 1
+                sa[buf[s[v-1]+1]] = v - 1
+
+    lms_map = [-1] * (n + 1)
+    lms: List[int] = []
+    for i in range(1, n):
+        if not ls[i-1] and ls[i]:
+            lms_map[i] = len(lms)
+            lms.append(i)
+    m = len(lms)
+    induce(lms)
+
+    if m > 0:
+        # name the LMS substrings and sort them recursively
+        sorted_lms = [v for v in sa if lms_map[v] != -1]
+        rec_s = [0] * m
+        rec_upper = 0
+        rec_s[lms_map[sorted_lms[0]]] = 0
+        for i in range(1, m):
+            l = sorted_lms[i-1]
+            r = sorted_lms[i]
+            end_l = lms[lms_map[l]+1] if lms_map[l] + 1 < m else n
+            end_r = lms[lms_map[r]+1] if lms_map[r] + 1 < m else n
+            same = True
+            if end_l - l != end_r - r:
+                same = False
+            else:
+                while l < end_l:
+                    if s[l] != s[r]:
+                        break
+                    l += 1
+                    r += 1
+                if l == n or s[l] != s[r]:
+                    same = False
+            if not same:
+                rec_upper += 1
+            rec_s[lms_map[sorted_lms[i]]] = rec_upper
+
+        rec_sa = sa_is(rec_s, rec_upper)
+        for i in range(m):
+            sorted_lms[i] = lms[rec_sa[i]]
+        induce(sorted_lms)
+    return sa
+
+
+def kasai_lcp(s: Sequence[int], sa: Sequence[int]) -> List[int]:
+    """
+        lcp[i] is the length of the longest common prefix of suffixes sa[i-1] and sa[i]. lcp[0] is 0.
+    """
+    n = len(s)
+    rank = [0] * n
+    for i, p in enumerate(sa):
+        rank[p] = i
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        if rank[i] == 0:
+            h = 0
+            continue
+        j = sa[rank[i]-1]
+        while i + h < n and j + h < n and s[i+h] == s[j+h]:
+            h += 1
+        lcp[rank[i]] = h
+        if h > 0:
+            h -= 1
+    return lcp
+
+
+def suffix_range(
+        text: Sequence[int],
+        sa: Sequence[int],
+        lcp: Sequence[int],
+        q: ChordSeq,
+        text_offset: int = 0) -> Tuple[int, int]:
+    """
+        Return [lo, hi) such that sa[lo:hi] are exactly the suffixes starting with q.
+        The text starts at text_offset of the given one, which can be a mmap of a larger file.
+    """
+    m = len(q)
+    n = len(sa)
+    if m == 0:
+        return 0, n
+    # lower bound: first suffix not less than q
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        p = sa[mid] + text_offset
+        # a slice running past the text still stops being equal to q at the last separator
+        if text[p:p+m] < q:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == n or text[sa[lo]+text_offset:sa[lo]+text_offset+m] != q:
+        return lo, lo
+    hi = lo + 1
+    while hi < n and lcp[hi] >= m:
+        hi += 1
+    return lo, hi
+
+
+def suffix_children(
+        text: Sequence[int],
+        sa: Sequence[int],
+        lo: int,
+        hi: int,
+        depth: int,
+        text_offset: int = 0) -> Iterator[Tuple[int, int, int]]:
+    """
+        The suffixes sa[lo:hi] share their first depth chords. Yield (chord, lo, hi) of every group
+        of them sharing the next chord as well, which are the children of [lo, hi) in the trie of all suffixes.
+        Suffixes ending at a separator have no children.
+    """
+    i = lo
+    while i < hi:
+        c = text[sa[i]+depth+text_offset]
+        if c == SEPARATOR:
+            # the separator is the largest symbol, so the rest end here too
+            return
+        # the first suffix after i with a larger chord at depth
+        run_lo, run_hi = i + 1, hi
+        while run_lo < run_hi:
+            mid = (run_lo + run_hi) // 2
+            if text[sa[mid]+depth+text_offset] > c:
+                run_hi = mid
+            else:
+                run_lo = mid + 1
+        yield c, i, run_lo
+        i = run_lo
+
+
+def suffix_approximate_search(
+        text: Sequence[int],
+        sa: Sequence[int],
+        sa_doc: Sequence[int],
+        doc_to_key: Callable[[int], FolksongKey],
+        q: ChordSeq,
+        max_edits: int,
+        top_n: Optional[int],
+        node_budget: Optional[int],
+        text_offset: int = 0) -> List[Tuple[FolksongKey, int]]:
+    """
+        approximate_search over the trie of all suffixes, whose nodes are (lo, hi, depth)
+    """
+    def edges(state):
+        lo, hi, depth = state
+        for c, child_lo, child_hi in suffix_children(text, sa, lo, hi, depth, text_offset):
+            yield (c,), (child_lo, child_hi, depth + 1), child_lo, child_hi
+
+    return approximate_search(
+        q, max_edits, top_n, node_budget,
+        (0, len(sa), 0), (0, len(sa)), sa_doc, doc_to_key, edges
+    )
+
+
+class SuffixArrayIndex:
+    def __init__(self, chord_seqs: Mapping[FolksongKey, ChordSeq]) -> None:
+        self.keys: List[FolksongKey] = []
+        text = bytearray()
+        doc = array('I')
+        for key, chord_seq in chord_seqs.items():
+            if len(chord_seq) == 0:
+                # PATTree never stores a key for an empty sequence either
+                continue
+            doc_id = len(self.keys)
+            self.keys.append(key)
+            text += chord_seq
+            text.append(SEPARATOR)
+            doc.extend([doc_id] * (len(chord_seq) + 1))
+        self.text = bytes(text)
+        sa = sa_is(self.text, SEPARATOR)
+        self.lcp = array('I', kasai_lcp(self.text, sa))
+        self.sa = array('I', sa)
+        # the owner of each suffix, in suffix array order
+        self.sa_doc = array('I', [doc[p] for p in sa])
+
+    def __len__(self) -> int:
+        return len(self.sa)
+
+    def leaf_number(self) -> int:
+        return len(self.keys)
+
+    def search_range(self, chord_seq: ChordSeq) -> Tuple[int, int]:
+        """
+            Return [lo, hi) such that sa[lo:hi] are exactly the suffixes starting with chord_seq
+        """
+        return suffix_range(self.text, self.sa, self.lcp, chord_seq)
+
+    def count(self, chord_seq: ChordSeq) -> int:
+        """
+            Number of occurrences of chord_seq in all indexed sequences
+        """
+        lo, hi = self.search_range(chord_seq)
+        return hi - lo
+
+    def search(self, chord_seq: ChordSeq) -> Set[FolksongKey]:
+        if len(chord_seq) == 0:
+            return set(self.keys)
+        lo, hi = self.search_range(chord_seq)
+        keys = self.keys
+        return {keys[d] for d in set(self.sa_doc[lo:hi])}
+
+    def search_many(self, chord_seqs: List[ChordSeq]) -> List[Set[FolksongKey]]:
+        """
+            search of every chord sequence. Each distinct sequence is searched once,
+            and equal sequences share one result set, which should not be modified.
+        """
+        results = {chord_seq: self.search(chord_seq) for chord_seq in dict.fromkeys(chord_seqs)}
+        return [results[chord_seq] for chord_seq in chord_seqs]
+
+    def search_approximate(
+            self,
+            chord_seq: ChordSeq,
+            max_edits: int,
+            top_n: Optional[int] = 10,
+            node_budget: Optional[int] = DEFAULT_NODE_BUDGET) -> List[Tuple[FolksongKey, int]]:
+        """
+            (key, edit cost) of the top_n songs containing chord_seq with at most max_edits edits.
+            See approximate_search.py
+        """
+        return suffix_approximate_search(
+            self.text, self.sa, self.sa_doc, self.keys.__getitem__,
+            chord_seq, max_edits, top_n, node_budget
+        )